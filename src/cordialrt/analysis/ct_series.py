@@ -0,0 +1,120 @@
+"""
+Header tags of a CT series, read once without the pixel data and checked to be the same on every
+slice. The metadata is kept on the treatment and in the ct_series table, so the CT parameters of a
+treatment are only read from the files again when the CT files change.
+"""
+
+import json
+
+import pydicom
+
+import cordialrt.helpers.exceptions as rtex
+from cordialrt.analysis.ct_volume import files_signature
+
+# Tags read from every slice. SeriesInstanceUID is always read
+CT_SERIES_TAGS = [
+    "SliceThickness",
+    "Manufacturer",
+    "ManufacturerModelName",
+    "KVP",
+    "SoftwareVersions",
+    "PixelSpacing",
+    "ConvolutionKernel",
+    "Rows",
+    "Columns",
+]
+
+
+def plain_tag_value(value):
+    """Converts a pydicom value to a value that can be saved as JSON"""
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "MultiValue":
+        return [plain_tag_value(item) for item in value]
+    if isinstance(value, pydicom.valuerep.DSfloat) or isinstance(value, float):
+        return float(value)
+    if isinstance(value, pydicom.valuerep.IS) or isinstance(value, int):
+        return int(value)
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+class CtSeriesMetadata:
+    """values has the value of each tag on the first slice, tags missing on the first slice are left out.
+    inconsistent_tags lists the tags that differ between slices"""
+
+    def __init__(
+        self,
+        series_instance_uid,
+        values,
+        number_of_slices,
+        inconsistent_tags=None,
+        files_signature=None,
+    ):
+        self.series_instance_uid = series_instance_uid
+        self.values = values
+        self.number_of_slices = number_of_slices
+        self.inconsistent_tags = list() if inconsistent_tags is None else list(inconsistent_tags)
+        self.files_signature = files_signature
+
+    def get(self, tag):
+        """Returns the value of the tag. Raises KeyError if the CTs do not have the tag"""
+        return self.values[tag]
+
+    def is_consistent(self, tag):
+        return tag not in self.inconsistent_tags
+
+    def to_row(self):
+        """Values for CT_SERIES_COLUMNS after treatment_id"""
+        return [
+            self.series_instance_uid,
+            self.number_of_slices,
+            json.dumps(self.values),
+            json.dumps(self.inconsistent_tags),
+            self.files_signature,
+        ]
+
+    @classmethod
+    def from_row(cls, row):
+        """From a ct_series row as a dict"""
+        return cls(
+            row["series_instance_uid"],
+            json.loads(row["tag_values"]),
+            row["number_of_slices"],
+            json.loads(row["inconsistent_tags"]),
+            row["files_signature"],
+        )
+
+
+def read_ct_series_metadata(ct_paths, tags=CT_SERIES_TAGS):
+    """Reads the tags from the headers of all slices and returns a CtSeriesMetadata with the values of the
+    first slice. Tags that differ between slices are listed in inconsistent_tags and printed"""
+    if len(ct_paths) == 0:
+        raise rtex.NoCtsError("No CT files to read the series metadata from")
+
+    read_tags = ["SeriesInstanceUID"] + list(tags)
+    values = None
+    inconsistent_tags = list()
+    for path in ct_paths:
+        header = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=read_tags)
+        slice_values = dict()
+        for tag in read_tags:
+            if tag in header:
+                slice_values[tag] = plain_tag_value(header[tag].value)
+
+        if values is None:
+            values = slice_values
+            continue
+        for tag in read_tags:
+            if tag not in inconsistent_tags and slice_values.get(tag) != values.get(tag):
+                inconsistent_tags.append(tag)
+
+    if len(inconsistent_tags) > 0:
+        print(f"CT series tags differ between slices, the first slice is used: {inconsistent_tags}")
+
+    return CtSeriesMetadata(
+        values.pop("SeriesInstanceUID", None),
+        values,
+        len(ct_paths),
+        inconsistent_tags,
+        files_signature(ct_paths),
+    )
@@ -0,0 +1,306 @@
+"""
+CT series as one z-sorted 3D array of HU values. The volume is assembled once per set of CT files and
+saved as a .npy file named by SeriesInstanceUID and the signature of the files, which is memory mapped
+when it is opened again. Opening a cached volume only reads the small metadata file, and processes
+opening the same volume share the pages of the file. Treatments using different slices of a series get
+their own files, the least recently used are removed when a series has more than
+CT_VOLUME_CACHE_VARIANTS. The cache folder is set with ct_volume_cache_folder in the user config, by
+default a folder in the temp folder.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import pydicom
+
+import cordialrt.helpers.exceptions as rtex
+import cordialrt.helpers.user_config
+
+user_config = cordialrt.helpers.user_config.read_user_config()
+CT_VOLUME_CACHE_FOLDER = user_config.get(
+    "ct_volume_cache_folder",
+    os.path.join(tempfile.gettempdir(), "cordialrt_ct_volumes"),
+)
+
+# Cached volumes kept for each series, e.g. for treatments using different slices of the series
+CT_VOLUME_CACHE_VARIANTS = 4
+
+HU_MIN = np.iinfo(np.int16).min
+HU_MAX = np.iinfo(np.int16).max
+
+HEADER_TAGS = [
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "InstanceNumber",
+    "ImagePositionPatient",
+    "ImageOrientationPatient",
+    "PixelSpacing",
+    "SliceThickness",
+    "KVP",
+    "Rows",
+    "Columns",
+]
+
+
+class CtVolume:
+    """hu is an int16 array indexed [slice, row, column], sorted along the slice normal (z for axial CTs).
+    affine maps (column, row, slice, 1) to patient coordinates in mm"""
+
+    def __init__(
+        self,
+        hu,
+        affine,
+        sop_instance_uids,
+        instance_numbers,
+        pixel_spacing,
+        slice_thickness,
+        kvp=None,
+        series_instance_uid=None,
+    ):
+        self.hu = hu
+        self.affine = affine
+        self.sop_instance_uids = list(sop_instance_uids)
+        self.instance_numbers = list(instance_numbers)
+        self.pixel_spacing = list(pixel_spacing)
+        self.slice_thickness = slice_thickness
+        self.kvp = kvp
+        self.series_instance_uid = series_instance_uid
+        # SOPInstanceUID: slice index
+        self.uid_index = {uid: index for index, uid in enumerate(self.sop_instance_uids)}
+
+    @property
+    def origin(self):
+        """Patient position of the first voxel in mm"""
+        return self.affine[:3, 3]
+
+    @property
+    def spacing(self):
+        """Voxel size in mm as (column, row, slice)"""
+        return np.linalg.norm(self.affine[:3, :3], axis=0)
+
+    def slice_position(self, index):
+        """Patient position of the first pixel of a slice"""
+        return self.affine[:3, 3] + self.affine[:3, 2] * index
+
+    def metadata(self):
+        return {
+            "affine": self.affine.tolist(),
+            "sop_instance_uids": self.sop_instance_uids,
+            "instance_numbers": self.instance_numbers,
+            "pixel_spacing": self.pixel_spacing,
+            "slice_thickness": self.slice_thickness,
+            "kvp": self.kvp,
+            "series_instance_uid": self.series_instance_uid,
+        }
+
+    @classmethod
+    def from_metadata(cls, hu, metadata):
+        return cls(
+            hu,
+            np.array(metadata["affine"]),
+            metadata["sop_instance_uids"],
+            metadata["instance_numbers"],
+            metadata["pixel_spacing"],
+            metadata["slice_thickness"],
+            metadata["kvp"],
+            metadata["series_instance_uid"],
+        )
+
+
+def optional_float(value):
+    if value is None or value == "":
+        return None
+    return float(value)
+
+
+def files_signature(ct_paths):
+    """Hash of the paths, sizes and modification times of the CT files. A cached volume with another
+    signature is assembled again"""
+    signature = hashlib.sha1()
+    for path in sorted(ct_paths):
+        stat = os.stat(path)
+        signature.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return signature.hexdigest()
+
+
+def read_headers(ct_paths):
+    """Returns the headers sorted along the slice normal as a list of (position, path, header)"""
+    headers = list()
+    for path in ct_paths:
+        header = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+        headers.append((path, header))
+
+    orientation = np.array(headers[0][1].ImageOrientationPatient, dtype=float)
+    normal = np.cross(orientation[:3], orientation[3:])
+    sorted_headers = list()
+    for path, header in headers:
+        position = np.dot(normal, np.array(header.ImagePositionPatient, dtype=float))
+        sorted_headers.append((position, path, header))
+    sorted_headers.sort(key=lambda item: item[0])
+    return sorted_headers
+
+
+def volume_affine(sorted_headers):
+    first_header = sorted_headers[0][2]
+    orientation = np.array(first_header.ImageOrientationPatient, dtype=float)
+    # PixelSpacing is (row spacing, column spacing)
+    row_spacing, column_spacing = [float(value) for value in first_header.PixelSpacing]
+    first_position = np.array(first_header.ImagePositionPatient, dtype=float)
+
+    if len(sorted_headers) > 1:
+        last_position = np.array(sorted_headers[-1][2].ImagePositionPatient, dtype=float)
+        slice_step = (last_position - first_position) / (len(sorted_headers) - 1)
+    else:
+        thickness = optional_float(first_header.get("SliceThickness")) or 1.0
+        slice_step = np.cross(orientation[:3], orientation[3:]) * thickness
+
+    affine = np.eye(4)
+    affine[:3, 0] = orientation[:3] * column_spacing
+    affine[:3, 1] = orientation[3:] * row_spacing
+    affine[:3, 2] = slice_step
+    affine[:3, 3] = first_position
+    return affine
+
+
+def assemble_ct_volume(ct_paths, npy_path=None):
+    """Reads the CT slices and returns a CtVolume. With npy_path the array is written slice by slice to
+    that .npy file instead of memory"""
+    if len(ct_paths) == 0:
+        raise rtex.NoCtsError("No CT files to assemble a volume from")
+
+    sorted_headers = read_headers(ct_paths)
+    first_header = sorted_headers[0][2]
+    shape = (len(sorted_headers), int(first_header.Rows), int(first_header.Columns))
+
+    if npy_path is None:
+        hu = np.empty(shape, dtype=np.int16)
+    else:
+        hu = np.lib.format.open_memmap(npy_path, mode="w+", dtype=np.int16, shape=shape)
+
+    for index, (_, path, _) in enumerate(sorted_headers):
+        data_set = pydicom.dcmread(path)
+        slope = float(data_set.get("RescaleSlope", 1))
+        intercept = float(data_set.get("RescaleIntercept", 0))
+        pixels = data_set.pixel_array * slope + intercept
+        hu[index] = np.clip(np.rint(pixels), HU_MIN, HU_MAX)
+
+    if npy_path is not None:
+        hu.flush()
+
+    return CtVolume(
+        hu,
+        volume_affine(sorted_headers),
+        [header.SOPInstanceUID for _, _, header in sorted_headers],
+        [
+            None if header.get("InstanceNumber") in (None, "") else int(header.InstanceNumber)
+            for _, _, header in sorted_headers
+        ],
+        [float(value) for value in first_header.PixelSpacing],
+        optional_float(first_header.get("SliceThickness")),
+        optional_float(first_header.get("KVP")),
+        first_header.get("SeriesInstanceUID"),
+    )
+
+
+def cache_paths(series_instance_uid, signature, cache_folder):
+    base = os.path.join(cache_folder, f"{series_instance_uid}.{signature[:12]}")
+    return (f"{base}.npy", f"{base}.json")
+
+
+def prune_cache_variants(series_instance_uid, cache_folder, keep=CT_VOLUME_CACHE_VARIANTS):
+    """Removes the least recently used cached volumes of the series, so at most keep are left. Volumes
+    memory mapped by another process can not be removed on Windows and are left until the next time"""
+    prefix = f"{series_instance_uid}."
+    json_paths = [
+        os.path.join(cache_folder, file_name)
+        for file_name in os.listdir(cache_folder)
+        if file_name.startswith(prefix) and file_name.endswith(".json")
+    ]
+    if len(json_paths) <= keep:
+        return
+    json_paths.sort(key=lambda path: os.stat(path).st_mtime_ns, reverse=True)
+    for json_path in json_paths[keep:]:
+        # The metadata goes first, a volume without metadata is not used
+        for path in (json_path, f"{json_path[:-len('.json')]}.npy"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def cached_signature(json_path):
+    """Signature in the metadata of a cached volume, None if there is no readable metadata"""
+    try:
+        with open(json_path) as json_file:
+            return json.load(json_file).get("signature")
+    except (OSError, ValueError):
+        return None
+
+
+def load_ct_volume(ct_paths, cache=True, cache_folder=None):
+    """Returns the CtVolume of the CT files. With cache the volume is opened memory mapped from the
+    cache, or assembled and saved there if it is missing or the files have changed"""
+    if not cache:
+        return assemble_ct_volume(ct_paths)
+
+    if len(ct_paths) == 0:
+        raise rtex.NoCtsError("No CT files to assemble a volume from")
+
+    cache_folder = CT_VOLUME_CACHE_FOLDER if cache_folder is None else cache_folder
+    series_instance_uid = pydicom.dcmread(
+        ct_paths[0], stop_before_pixels=True, specific_tags=["SeriesInstanceUID"]
+    ).get("SeriesInstanceUID")
+    if series_instance_uid is None:
+        return assemble_ct_volume(ct_paths)
+
+    signature = files_signature(ct_paths)
+    npy_path, json_path = cache_paths(series_instance_uid, signature, cache_folder)
+
+    if os.path.isfile(npy_path) and cached_signature(json_path) == signature:
+        with open(json_path) as json_file:
+            metadata = json.load(json_file)
+        # The modification time of the metadata marks when the volume was last used
+        try:
+            os.utime(json_path)
+        except OSError:
+            pass
+        return CtVolume.from_metadata(np.load(npy_path, mmap_mode="r"), metadata)
+
+    # Write to temporary files and move them in place, so other processes never open a partial volume.
+    # The metadata is moved last, a volume is only used when its metadata exists
+    os.makedirs(cache_folder, exist_ok=True)
+    temp_paths = list()
+    for suffix in (".npy.tmp", ".json.tmp"):
+        file_descriptor, temp_path = tempfile.mkstemp(
+            suffix=suffix, prefix=f"{series_instance_uid}.", dir=cache_folder
+        )
+        os.close(file_descriptor)
+        temp_paths.append(temp_path)
+    temp_npy_path, temp_json_path = temp_paths
+
+    try:
+        ct_volume = assemble_ct_volume(ct_paths, npy_path=temp_npy_path)
+        metadata = ct_volume.metadata()
+        metadata["signature"] = signature
+        with open(temp_json_path, "w") as json_file:
+            json.dump(metadata, json_file)
+        del ct_volume
+
+        try:
+            os.replace(temp_npy_path, npy_path)
+            os.replace(temp_json_path, json_path)
+        except OSError:
+            # Another process may have written the same volume and have it memory mapped, which makes
+            # the replace fail on Windows. Its volume is used if it is complete
+            if cached_signature(json_path) != signature or not os.path.isfile(npy_path):
+                raise
+    finally:
+        for temp_path in temp_paths:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    prune_cache_variants(series_instance_uid, cache_folder)
+    return CtVolume.from_metadata(np.load(npy_path, mmap_mode="r"), metadata)
@@ -1,10 +1,17 @@
+import numbers
+import time
+
+import numpy as np
+
 from cordialrt.analysis.treatments_from_collection import init_treatments_from_collection
+import cordialrt.database.database as rtdb
 import cordialrt.helpers.exceptions as crtex
 
 
 #Move to user config?
 NON_DVH_ROI_DATAPOINT_SURFIXES = ['synonyms_found','calculation_time']
 
+# Data point: CT tag. The tags are read by cordialrt.analysis.ct_series and must be in CT_SERIES_TAGS
 CT_PARAMETERS = {'ct_slice_thickness' : 'SliceThickness',
                     'ct_manufacturer': 'Manufacturer',
                     'ct_kvp': 'KVP', 
@@ -130,7 +137,7 @@ def extract_data_from_patient(
         treatment = treatments[0]
    
     if len(treatment.dose_paths) == 0:
-        raise Exception
+        raise crtex.DataExtractionFailed(f'No dose files for {patient_id}')
 
     # check if augmented structure set is to be used
     if structure_collection_id is None:
@@ -181,14 +188,14 @@ def extract_data_from_patient(
                     data_point.value = treatment.get_max_dose()
                 except MemoryError:
                     print(f'Memory Error with max_dose. Skipped treatment for {treatment.patient_id}')
-                    raise Exception
+                    raise crtex.DataExtractionFailed(f'Memory Error with max_dose for {treatment.patient_id}')
 
             elif data_point.parameter  == 'laterality':
                 try:
                     data_point.value = treatment.get_latterality()
                 except MemoryError:
                     print(f'Memory Error with laterality. Skipped treatment for {treatment.patient_id}')
-                    raise Exception
+                    raise crtex.DataExtractionFailed(f'Memory Error with laterality for {treatment.patient_id}')
             
             elif data_point.parameter == 'left_right_dose_ratio':
                 data_point.value = treatment.left_right_dose_ratio
@@ -198,9 +205,9 @@ def extract_data_from_patient(
             elif data_point.parameter in CT_PARAMETERS.keys():
  
                 try:
-                    treatment.load_first_ct_data()
-                    data_point.value = treatment.first_ct.ds[CT_PARAMETERS[data_point.parameter]].value
-                except (MemoryError, KeyError):
+                    ct_series_metadata = treatment.get_ct_series_metadata()
+                    data_point.value = ct_series_metadata.get(CT_PARAMETERS[data_point.parameter])
+                except (MemoryError, crtex.NoCtsError, KeyError):
                     print(f'Failed for {CT_PARAMETERS[data_point.parameter]}')
                     data_point.value = None
             else:
@@ -230,4 +237,115 @@ def extract_data_from_patient(
 
                 data_point = roi.get_value_for_dvh_data_point(data_point, prioritize_roi_name = prioritize_roi_name) 
 
-    return(data_points)
\ No newline at end of file
+    return(data_points)
+
+
+def data_point_type(data_point):
+    if type(data_point) == DvhDataPoint:
+        return('roi_dvh')
+    elif type(data_point) == RoiDataPoint:
+        return('roi_other')
+    return('generic')
+
+def data_point_row(patient_id, data_point):
+    """ Row for DatabaseCall.insert_data_points. Numbers are stored in data_point_value_num,
+    other values as strings in data_point_value_string """
+    value = data_point.get_value()
+    value_num = None
+    value_string = None
+
+    if isinstance(value, (numbers.Number, np.number)) and not isinstance(value, (bool, np.bool_)):
+        value_num = float(value)
+    elif value is not None:
+        value_string = str(value)
+
+    return([patient_id, data_point.name, value_num, value_string, data_point_type(data_point),
+            getattr(data_point, 'roi_standard_name', None)])
+
+class DataPointWriter():
+    """ Buffers extracted data points and inserts them batch_size rows at a time, each batch in one
+    transaction. The buffer is flushed when the with block ends. Use writer = QueuedRows from
+    cordialrt.database.queued_writer to send the rows to a writer thread instead """
+    def __init__(self, data_extraction_id, batch_size = 5000, writer = None):
+        self.data_extraction_id = data_extraction_id
+        self.batch_size = batch_size
+        self.writer = writer
+        self.rows = list()
+        self.rows_written = 0
+        self.start_time = None
+        self.seconds = 0
+
+    def write(self, patient_id, data_points):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        for data_point in data_points:
+            self.rows.append(data_point_row(patient_id, data_point))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        if self.writer is None:
+            with rtdb.DatabaseCall() as db:
+                db.insert_data_points(self.data_extraction_id, self.rows)
+        else:
+            self.writer.insert_data_points(self.data_extraction_id, self.rows)
+        self.rows_written = self.rows_written + len(self.rows)
+        self.rows = list()
+
+    @property
+    def rows_per_second(self):
+        if self.seconds > 0:
+            return(self.rows_written / self.seconds)
+        return(None)
+
+    def close(self):
+        self.flush()
+        if self.start_time is not None:
+            self.seconds = time.perf_counter() - self.start_time
+            self.start_time = None
+        if self.rows_per_second is not None:
+            print(f'Wrote {self.rows_written} data points in {self.seconds:.1f} s ({self.rows_per_second:.0f} rows/s)')
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exception_type, exception_val, trace):
+        # Data points extracted before an error are kept
+        self.close()
+
+def extract_data_to_dataset(
+        dataset_id,
+        data_points,
+        patient_ids=None,
+        log_path=None,
+        structure_collection_id=None,
+        batch_size=5000,
+        writer=None):
+
+    """ Extracts the data points for all patients (or patient_ids) in the treatment collection of the
+    dataset and saves them in a new data extraction. Returns the data_extraction_id """
+    with rtdb.DatabaseCall() as db:
+        collection_id = db.get_dataset_treatment_collection_id(dataset_id)[0]
+        if patient_ids is None:
+            patient_ids = db.get_patient_id_from_collection(collection_id)
+        data_extraction_id = db.new_data_extraction(dataset_id)
+
+    failed_patients = list()
+    with DataPointWriter(data_extraction_id, batch_size = batch_size, writer = writer) as data_point_writer:
+        for patient_id in patient_ids:
+            try:
+                data_points_output = extract_data_from_patient(collection_id, patient_id, data_points,
+                                                              log_path = log_path,
+                                                              structure_collection_id = structure_collection_id)
+            except (crtex.DataExtractionFailed, crtex.AugmentedStructureMissing, crtex.InitError,
+                    crtex.SumDoseError, crtex.NoCtsError, MemoryError) as e:
+                print(f'Extraction failed for {patient_id}: {e}')
+                failed_patients.append(patient_id)
+                continue
+            data_point_writer.write(patient_id, data_points_output)
+
+    if len(failed_patients) > 0:
+        print(f'Extraction failed for {len(failed_patients)} of {len(patient_ids)} patients')
+    return(data_extraction_id)
@@ -0,0 +1,106 @@
+"""
+Process wide LRU cache of parsed DICOM files. Structure, dose and plan files are parsed once and the
+DicomParser is shared by all treatments, ROIs and analysis functions reading the same file. Entries
+are keyed by (path, mtime, size), so a file changed on disk is parsed again. The least recently used
+files are evicted when the total size passes dicom_cache_size_mb from the user config (default 1024).
+The size of a parsed file is approximated by its size on disk.
+
+The parsers are shared, do not change their datasets.
+"""
+
+import collections
+import os
+import threading
+
+from dicompylercore import dicomparser
+
+import cordialrt.helpers.user_config
+
+user_config = cordialrt.helpers.user_config.read_user_config()
+DICOM_CACHE_SIZE_MB = float(user_config.get("dicom_cache_size_mb", 1024))
+
+
+class DicomCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # path: (mtime_ns, size, DicomParser), least recently used first
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Returns the DicomParser of the file, parsed now or taken from the cache"""
+        stat = os.stat(path)
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is not None:
+                if entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+                    self.entries.move_to_end(path)
+                    self.hits = self.hits + 1
+                    return entry[2]
+                self._remove(path)
+
+        # Parse outside the lock, two threads may parse the same file but the result is the same
+        parser = dicomparser.DicomParser(path)
+
+        with self._lock:
+            self.misses = self.misses + 1
+            if stat.st_size > self.max_bytes:
+                return parser
+            if path in self.entries:
+                self._remove(path)
+            self.entries[path] = (stat.st_mtime_ns, stat.st_size, parser)
+            self.bytes = self.bytes + stat.st_size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.evictions = self.evictions + 1
+        return parser
+
+    def _remove(self, path):
+        _, size, _ = self.entries.pop(path)
+        self.bytes = self.bytes - size
+
+    def discard(self, path):
+        with self._lock:
+            if path in self.entries:
+                self._remove(path)
+
+    def clear(self):
+        with self._lock:
+            self.entries = collections.OrderedDict()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups > 0 else None,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "megabytes": self.bytes / 1e6,
+                "max_megabytes": self.max_bytes / 1e6,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+
+DICOM_CACHE = DicomCache(DICOM_CACHE_SIZE_MB * 1e6)
+
+
+def get_dicom(path):
+    """Returns the DicomParser of the file from the process wide cache"""
+    return DICOM_CACHE.get(path)
+
+
+def cache_stats():
+    """Hits, misses, evictions and size of the process wide cache"""
+    return DICOM_CACHE.stats()
@@ -0,0 +1,99 @@
+"""
+Memory budget for the DICOM data loaded by treatments. A treatment reports to the budget each time
+it loads structure, dose, plan or CT data, and when the loaded data of all treatments passes the
+budget, the treatments used least recently are unloaded until it fits again. Unloaded data is
+loaded again the next time it is used. The budget is set with treatment_memory_budget_mb in the user
+config (default 4096).
+
+Sizes are approximated by the sizes of the files on disk and the CT volumes held in memory, measured
+when the data is loaded. Unloading a treatment also removes its parsed files from the DICOM cache
+(dicom_cache.py), so their memory is freed once no other treatment uses them.
+"""
+
+import collections
+import threading
+import weakref
+
+import cordialrt.helpers.user_config
+
+user_config = cordialrt.helpers.user_config.read_user_config()
+TREATMENT_MEMORY_BUDGET_MB = float(user_config.get("treatment_memory_budget_mb", 4096))
+
+
+class MemoryBudget:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # id(treatment): (weak reference, bytes), least recently used first
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def touch(self, treatment):
+        """Marks the treatment as most recently used"""
+        with self._lock:
+            if id(treatment) in self.entries:
+                self.entries.move_to_end(id(treatment))
+
+    def update(self, treatment):
+        """Marks the treatment as most recently used after it loaded data, updates its size and unloads
+        other treatments if the budget is exceeded. The treatment itself is never unloaded here"""
+        key = id(treatment)
+        size = treatment.loaded_bytes()
+        with self._lock:
+            self._remove(key)
+            if size == 0:
+                return
+            self.entries[key] = (weakref.ref(treatment, self._forget(key)), size)
+            self.bytes = self.bytes + size
+
+            evict = list()
+            remaining_bytes = self.bytes
+            for other_key, (_, other_size) in self.entries.items():
+                if remaining_bytes <= self.max_bytes:
+                    break
+                if other_key != key:
+                    evict.append(other_key)
+                    remaining_bytes = remaining_bytes - other_size
+
+            treatments = [self.entries[k][0]() for k in evict]
+            for other_key in evict:
+                self._remove(other_key)
+            self.evictions = self.evictions + len(evict)
+
+        # unload calls release, so it runs after the entries are updated
+        for other_treatment in treatments:
+            if other_treatment is not None:
+                other_treatment.unload()
+
+    def release(self, treatment):
+        """Removes an unloaded treatment from the budget"""
+        with self._lock:
+            self._remove(id(treatment))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes = self.bytes - entry[1]
+
+    def _forget(self, key):
+        # Called when a treatment is garbage collected without being unloaded
+        def callback(reference):
+            with self._lock:
+                entry = self.entries.get(key)
+                if entry is not None and entry[0] is reference:
+                    self._remove(key)
+
+        return callback
+
+    def stats(self):
+        with self._lock:
+            return {
+                "treatments": len(self.entries),
+                "megabytes": self.bytes / 1e6,
+                "max_megabytes": self.max_bytes / 1e6,
+                "evictions": self.evictions,
+            }
+
+
+MEMORY_BUDGET = MemoryBudget(TREATMENT_MEMORY_BUDGET_MB * 1e6)
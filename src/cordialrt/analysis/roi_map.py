@@ -0,0 +1,96 @@
+"""
+Builds the roi_map table: the structure chosen for each ROI standard name of each treatment in a
+collection, with the synonym and the reason it was chosen. Roi.get_priority_synonym reads the map
+instead of parsing the structure file, as long as the structure file and the synonyms of the
+standard name are unchanged since the row was made. Running build_roi_map again only maps the
+treatments and standard names whose structure file or synonyms changed.
+"""
+
+import cordialrt.analysis.treatment_class as rtclass
+import cordialrt.database.database as rtdb
+import cordialrt.helpers.exceptions as rtex
+from cordialrt.analysis.treatments_from_collection import init_treatments_from_collection
+
+
+def roi_map_row(roi, structure_file_path, structure_file_mtime, synonyms_fingerprint):
+    """Finds the priority synonym of the roi in the structure file and returns the roi_map row"""
+    structure, reason = roi.choose_priority_synonym(roi.find_synonyms())
+    if structure is None:
+        structure = {"name": None, "structure_id": None, "priority_count": None, "laterality": None}
+
+    return [
+        roi.treatment.treatment_id,
+        roi.standard_name,
+        structure["structure_id"],
+        structure["name"],
+        structure["priority_count"],
+        structure["laterality"],
+        reason,
+        structure_file_path,
+        structure_file_mtime,
+        synonyms_fingerprint,
+    ]
+
+
+def build_roi_map(treatment_collection_id, standard_names, treatments=None, rebuild=False,
+                  batch_size=500, **init_kwargs):
+    """Maps the standard names to structures for all treatments in the collection and saves the rows
+    in roi_map. Treatments are initialised with init_treatments_from_collection(**init_kwargs) unless
+    given. Rows that are up to date are kept, use rebuild to map all treatments again.
+    Returns a dict with the number of rows kept, mapped, not found and failed"""
+    if treatments is None:
+        treatments = init_treatments_from_collection(treatment_collection_id, **init_kwargs)
+
+    with rtdb.DatabaseCall() as db:
+        synonym_index = db.get_synonym_index(treatment_collection_id)
+        if rebuild:
+            roi_map = dict()
+        else:
+            roi_map = db.get_roi_map_from_collection(treatment_collection_id, standard_names)
+
+    fingerprints = {name: synonym_index.fingerprint(name) for name in standard_names}
+    counts = {"kept": 0, "mapped": 0, "not_found": 0, "failed": 0}
+    rows = list()
+
+    def save(rows):
+        with rtdb.DatabaseCall() as db:
+            db.save_roi_map_rows(rows)
+
+    for treatment in treatments:
+        structure_file_path, structure_file_mtime = rtclass.structure_file_state(treatment.structure_path)
+        structure_loaded = treatment.structure is not None
+
+        for standard_name in standard_names:
+            row = roi_map.get((treatment.treatment_id, standard_name))
+            if rtclass.roi_map_row_is_current(row, structure_file_path, structure_file_mtime,
+                                              fingerprints[standard_name]):
+                counts["kept"] = counts["kept"] + 1
+                continue
+
+            roi = rtclass.Roi(standard_name, treatment)
+            try:
+                row = roi_map_row(roi, structure_file_path, structure_file_mtime, fingerprints[standard_name])
+            except (rtex.NoCtsError, ValueError, OSError) as e:
+                # Laterality or structure file could not be read, the roi is mapped again next time
+                print(f"Roi map failed for patient {treatment.patient_id}, {standard_name}: {e}")
+                counts["failed"] = counts["failed"] + 1
+                continue
+
+            if row[2] is None:
+                counts["not_found"] = counts["not_found"] + 1
+            else:
+                counts["mapped"] = counts["mapped"] + 1
+            rows.append(row)
+
+        # Only the structure names were needed, do not keep the parsed file for every treatment
+        if not structure_loaded:
+            treatment.unload()
+
+        if len(rows) >= batch_size:
+            save(rows)
+            rows = list()
+
+    save(rows)
+    print(f"Roi map for collection {treatment_collection_id}: {counts['mapped']} mapped, "
+          f"{counts['not_found']} not found, {counts['kept']} unchanged, {counts['failed']} failed")
+    return counts
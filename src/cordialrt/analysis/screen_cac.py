@@ -2,11 +2,11 @@ import pandas as pd
 import numpy as np
 import glob
 import cv2
-import gc
 import datetime
 import math
 from cordialrt.analysis.treatments_from_collection import init_treatments_from_collection
 import cordialrt.database.database as rtdb 
+from cordialrt.database.parquet_export import export_table, partition_folder
 
 class StructError(Exception):
     """Base class for other exceptions"""
@@ -22,6 +22,12 @@ def patients_already_screened(center, screen_files_folder_path):
         df_excel = pd.read_excel(path)
         screened_patient_ids = screened_patient_ids + df_excel.patient_id.unique().tolist()
 
+    # Results saved with file_format = 'parquet'
+    cac_status_folder = partition_folder(f'{screen_files_folder_path}/cac_status', [('centre', center)])
+    for path in glob.glob(f'{cac_status_folder}/*.parquet'):
+        df_parquet = pd.read_parquet(path, columns = ['patient_id'])
+        screened_patient_ids = screened_patient_ids + df_parquet.patient_id.unique().tolist()
+
     #keep only the unique
     screened_patient_ids = list(set(screened_patient_ids))    
     print(f'Patients screened from {center}:', len(screened_patient_ids))
@@ -78,16 +84,17 @@ def heart_contour_info(treatment, heart_struct, deep_learning_collection_id, dee
 
     return(ct_heart_slices)
 
-def crop_ct_to_heart(ct, ct_heart_slice): 
-   
-    ct_pixels = ct.ds.pixel_array
+def crop_ct_to_heart(ct_volume, index, ct_heart_slice): 
+    """Crops slice index of the CtVolume to a box around the heart, HU outside the heart are set to -1024"""
+    ct_pixels = ct_volume.hu[index]
+    slice_position = ct_volume.slice_position(index)
     # The coordinates to match the slice
     xs = ct_heart_slice[0]
     ys = ct_heart_slice[1]
 
     # remember to take patient orientation into acocunt. May differ 
-    xs = [(x -ct.ds.ImagePositionPatient[0])/ct.ds.PixelSpacing[0] for x in xs]
-    ys = [(y -ct.ds.ImagePositionPatient[1])/ct.ds.PixelSpacing[0]for y in ys]
+    xs = [(x -slice_position[0])/ct_volume.pixel_spacing[0] for x in xs]
+    ys = [(y -slice_position[1])/ct_volume.pixel_spacing[0]for y in ys]
 
     xy_set = list()
     for i, x in enumerate(xs):
@@ -98,7 +105,7 @@ def crop_ct_to_heart(ct, ct_heart_slice):
     heart_mask = np.zeros(ct_pixels.shape, np.uint8)
     cv2.drawContours(heart_mask,[heart_contour], 0, (255,255,255), -1)
     heart_mask_bool = np.array(heart_mask, dtype = bool)
-    ct_pix_crop= np.where(heart_mask_bool , ct_pixels, 0)
+    ct_pix_crop= np.where(heart_mask_bool , ct_pixels, -1024)
 
     # Crop the ct to a box around the heart
     first_pix_y = int(round(min(ys),0))
@@ -111,10 +118,7 @@ def crop_ct_to_heart(ct, ct_heart_slice):
     pixels_in_heart_slice = heart_mask_bool.sum()
     return(ct_pix_crop, pixels_in_heart_slice)
 
-def create_cac_mask(ct, ct_cropped):
-    # Create a houndsfield (HU) unit version of the CT
-    hu_pix_crop = ct_cropped * ct.ds.RescaleSlope + ct.ds.RescaleIntercept
-
+def create_cac_mask(hu_pix_crop):
     # Create a mask of HU abover 130
     cac_mask = (hu_pix_crop >= 130) & (hu_pix_crop < 1300)
     cac_in_heart_mask = np.zeros_like(hu_pix_crop)
@@ -123,7 +127,7 @@ def create_cac_mask(ct, ct_cropped):
 
     return(cac_in_heart_mask)
 
-def conutour_and_get_cac_data(patient_id, ct, ct_cropped, cac_in_heart_mask):
+def conutour_and_get_cac_data(patient_id, ct_volume, index, hu_pix_crop, cac_in_heart_mask):
     d = list()
     contours = list()
     ret, thresh = cv2.threshold(cac_in_heart_mask, 0, 1, cv2.THRESH_BINARY)
@@ -131,17 +135,17 @@ def conutour_and_get_cac_data(patient_id, ct, ct_cropped, cac_in_heart_mask):
 
     for contour in contours:
         if cv2.contourArea(contour) > 1: # exclude ares of 1 pixel
-            if (cv2.contourArea(contour)* ct.ds.PixelSpacing[0] * ct.ds.PixelSpacing[1]) >= 1: # exclude areas <1mm
+            if (cv2.contourArea(contour)* ct_volume.pixel_spacing[0] * ct_volume.pixel_spacing[1]) >= 1: # exclude areas <1mm
                 data = dict()
                 data['patient_id'] = patient_id
-                data['ct_uid'] = ct.ds.SOPInstanceUID
-                data['ct_number'] = ct.ds.InstanceNumber
+                data['ct_uid'] = ct_volume.sop_instance_uids[index]
+                data['ct_number'] = ct_volume.instance_numbers[index]
                 data['cac_area'] = cv2.contourArea(contour)
-                data['slice_thickness'] = ct.ds.SliceThickness
-                data['pixel_spacing_1'] = ct.ds.PixelSpacing[0]
-                data['pixel_spacing_2'] = ct.ds.PixelSpacing[1]
+                data['slice_thickness'] = ct_volume.slice_thickness
+                data['pixel_spacing_1'] = ct_volume.pixel_spacing[0]
+                data['pixel_spacing_2'] = ct_volume.pixel_spacing[1]
                 data['croped_slice_shape'] = cac_in_heart_mask.shape
-                data['energy'] = ct.ds.KVP
+                data['energy'] = ct_volume.kvp
 
                 #minimum enclosing circle
                 (x,y),radius = cv2.minEnclosingCircle(contour)
@@ -156,7 +160,6 @@ def conutour_and_get_cac_data(patient_id, ct, ct_cropped, cac_in_heart_mask):
                 d.append(data)
 
                 # evalaute pixel values
-                hu_pix_crop = ct_cropped * ct.ds.RescaleSlope + ct.ds.RescaleIntercept
                 pixel_values = list()
                 x_y_pixel_values = list()
                 # Iterate over each point in the contour
@@ -173,21 +176,31 @@ def conutour_and_get_cac_data(patient_id, ct, ct_cropped, cac_in_heart_mask):
                 data['x_y_pixel_values_hu'] = x_y_pixel_values
     return(d)
 
-def save_data_to_files(cac_slice_data_center, cac_status_center,center, screen_files_folder_path):
+def save_data_to_files(cac_slice_data_center, cac_status_center,center, screen_files_folder_path, file_format = 'xlsx'):
+    """Saves the results as Excel files, or with file_format = 'parquet' as Parquet files in
+    screen_files_folder_path/cac_slices/centre=center/ and screen_files_folder_path/cac_status/centre=center/"""
     time_stamp = f'{datetime.datetime.now().date()}_{datetime.datetime.now().hour}_{datetime.datetime.now().minute}'
 
     if len(cac_slice_data_center) > 0:
         df_cac_slices = pd.DataFrame(cac_slice_data_center)
-        df_cac_slices.to_excel(f'{screen_files_folder_path}/cac_slices_{center}_{time_stamp}.xlsx')
+        if file_format == 'parquet':
+            export_table(df_cac_slices, f'{screen_files_folder_path}/cac_slices', [('centre', center)], name = 'cac_slices')
+        else:
+            df_cac_slices.to_excel(f'{screen_files_folder_path}/cac_slices_{center}_{time_stamp}.xlsx')
 
     if len(cac_status_center) > 0:   
         df_cac_status = pd.DataFrame(cac_status_center)
-        df_cac_status.to_excel(f'{screen_files_folder_path}/cac_status_{center}_{time_stamp}.xlsx')
+        if file_format == 'parquet':
+            export_table(df_cac_status, f'{screen_files_folder_path}/cac_status', [('centre', center)], name = 'cac_status')
+        else:
+            df_cac_status.to_excel(f'{screen_files_folder_path}/cac_status_{center}_{time_stamp}.xlsx')
 
 def main(center:str, screen_files_folder_path:str, heart_struct:str,select_patients:list,
         max_number_of_patients = None, 
         deep_learning_collection_id = None, 
-        deep_learning_structure_name = None, ):
+        deep_learning_structure_name = None,
+        treatment_collection_id = 54,
+        file_format = 'xlsx', ):
 
     cac_status_center = list()
     cac_slice_data_center = list()
@@ -204,50 +217,44 @@ def main(center:str, screen_files_folder_path:str, heart_struct:str,select_patie
         cac_status_patient = dict()
         pixels_in_the_heart = 0 
 
-        treatments = init_treatments_from_collection(54, departments= [center], 
+        treatments = init_treatments_from_collection(treatment_collection_id, departments= [center], 
         select_patients= [patient_id])    
 
         for treatment in treatments:
-            treatment.load_ct_data()
-            try:
-                ct_heart_slices = heart_contour_info(treatment, heart_struct, deep_learning_collection_id, deep_learning_structure_name)
-            except StructError as e:
-                print(e)
-                continue
-            
-            ct_numbers_in_heart = list()
-            for ct in treatment.cts:
-                if ct.ds.SOPInstanceUID in ct_heart_slices.keys():
-                    ct_numbers_in_heart.append(ct.ds.InstanceNumber)
-                    ct_cropped, pixels_in_heart_slice = crop_ct_to_heart(ct, ct_heart_slices[ct.ds.SOPInstanceUID]) 
-                    cac_in_heart_mask = create_cac_mask(ct, ct_cropped)
+            # The structure, CT volume and other DICOM data of the treatment are unloaded when the block ends
+            with treatment.loaded():
+                try:
+                    ct_heart_slices = heart_contour_info(treatment, heart_struct, deep_learning_collection_id, deep_learning_structure_name)
+                except StructError as e:
+                    print(e)
+                    continue
+
+                # The CTs as one memory mapped HU volume, the slices are read from the cache as they are used
+                ct_volume = treatment.get_ct_volume()
+                heart_indexes = sorted(ct_volume.uid_index[uid] for uid in ct_heart_slices.keys() if uid in ct_volume.uid_index)
+
+                ct_numbers_in_heart = list()
+                for index in heart_indexes:
+                    ct_numbers_in_heart.append(ct_volume.instance_numbers[index])
+                    hu_pix_crop, pixels_in_heart_slice = crop_ct_to_heart(ct_volume, index, ct_heart_slices[ct_volume.sop_instance_uids[index]]) 
+                    cac_in_heart_mask = create_cac_mask(hu_pix_crop)
                     pixels_in_the_heart = pixels_in_the_heart + pixels_in_heart_slice
                     if cac_in_heart_mask.sum() == 0:
                         continue
                     else:
-                        cac_slice_data = conutour_and_get_cac_data(treatment.patient_id, ct, ct_cropped, cac_in_heart_mask)       
+                        cac_slice_data = conutour_and_get_cac_data(treatment.patient_id, ct_volume, index, hu_pix_crop, cac_in_heart_mask)       
                         cac_slice_data_patient = cac_slice_data_patient + cac_slice_data
 
-            # Data for patient cac status
-            cac_status_patient['patient_id'] = treatment.patient_id
-            cac_status_patient['heart_volume'] = pixels_in_the_heart*ct.ds.PixelSpacing[0]*ct.ds.PixelSpacing[1]*ct.ds.SliceThickness/1000
-            cac_status_patient['non_zero_cac_slices'] = len(cac_slice_data_patient)
-            cac_status_patient['ct_numbers_in_heart'] = ct_numbers_in_heart
-            
-            del(ct)
-            gc.collect()
+                # Data for patient cac status
+                cac_status_patient['patient_id'] = treatment.patient_id
+                cac_status_patient['heart_volume'] = pixels_in_the_heart*ct_volume.pixel_spacing[0]*ct_volume.pixel_spacing[1]*ct_volume.slice_thickness/1000
+                cac_status_patient['non_zero_cac_slices'] = len(cac_slice_data_patient)
+                cac_status_patient['ct_numbers_in_heart'] = ct_numbers_in_heart
                         
         cac_slice_data_center = cac_slice_data_center + cac_slice_data_patient
         
         if cac_status_patient: #check if empty
             cac_status_center.append(cac_status_patient) 
-
-        try:
-            del(treatments)
-            del(treatment)
-            gc.collect()
-        except UnboundLocalError:
-            pass
     
-    save_data_to_files(cac_slice_data_center,cac_status_center,center, screen_files_folder_path)
+    save_data_to_files(cac_slice_data_center,cac_status_center,center, screen_files_folder_path, file_format = file_format)
 
@@ -1,12 +1,12 @@
 import datetime
 import os
 
-from dicompylercore import dicomparser
 from dicompylercore import dose as dc_dose
 
 import cordialrt.helpers.user_config
 import cordialrt.database.database as rtdb
 import cordialrt.helpers.exceptions as rtex
+from cordialrt.analysis.dicom_cache import DICOM_CACHE, get_dicom
 
 user_config = cordialrt.helpers.user_config.read_user_config()
 DICOM_FOLDER = user_config["dicom_file_parent_folder"]
@@ -141,9 +141,7 @@ def prepare_dose_sum_files_dbcg01(
 
                 fractions_dose_paths = list()
                 for dose_path in dose_paths:
-                    ref_plan_uid = dicomparser.DicomParser(
-                        dose_path
-                    ).GetReferencedRTPlan()
+                    ref_plan_uid = get_dicom(dose_path).GetReferencedRTPlan()
 
                     for plan in fractions_plan_uid:
                         if plan[1] == ref_plan_uid:
@@ -230,8 +228,10 @@ def save_sum_dose_file(
 
     # save the file:
     summed_dose_dicom_file.save_dcm(local_sum_dose_path)
-    # load the saved file:
-    summed_dose_dicom_file = dicomparser.DicomParser(local_sum_dose_path)
+    # load the saved file. A file written again with the same size can keep its mtime on shares with
+    # coarse timestamps, so the cache would return the parser of the old file
+    DICOM_CACHE.discard(local_sum_dose_path)
+    summed_dose_dicom_file = get_dicom(local_sum_dose_path)
 
     with open(
         f"{local_folder_path}/log_treatment_{treatment_id}.txt", "w", encoding="utf-8"
@@ -281,7 +281,7 @@ def sum_doses(dose_path_scale_pairs, patient_id):
                 )
 
             # check max dose to skip files without dose
-            dose_data = dicomparser.DicomParser(path).GetDoseData()
+            dose_data = get_dicom(path).GetDoseData()
             max_dose = dose_data["dosegridscaling"] * dose_data["dosemax"]
 
             # The lowest doses are dose per beam,
@@ -306,7 +306,7 @@ def sum_doses(dose_path_scale_pairs, patient_id):
                 ) from exc
 
             # check max dose to skip files without dose
-            dose_data = dicomparser.DicomParser(path).GetDoseData()
+            dose_data = get_dicom(path).GetDoseData()
             max_dose = dose_data["dosegridscaling"] * dose_data["dosemax"]
 
             if max_dose > 1:
@@ -1,10 +1,15 @@
 import numpy as np
 import os
+from contextlib import contextmanager
 from dicompylercore import dicomparser, dvh, dvhcalc
 import pandas as pd
 
 import cordialrt.database.database as rtdb
 import cordialrt.analysis.sum_dose as rtsum
+import cordialrt.analysis.ct_volume as rtct
+from cordialrt.analysis.ct_series import CtSeriesMetadata, read_ct_series_metadata
+from cordialrt.analysis.dicom_cache import DICOM_CACHE, get_dicom
+from cordialrt.analysis.memory_budget import MEMORY_BUDGET
 import cordialrt.helpers.exceptions as rtex
 from Levenshtein import ratio
 
@@ -14,6 +19,46 @@ user_config = cordialrt.helpers.user_config.read_user_config()
 DICOM_FOLDER_PATH = user_config["dicom_file_parent_folder"]
 
 
+# Reasons recorded when choosing the structure for a ROI, see Roi.choose_priority_synonym
+REASON_IPSILATERAL = "ipsilateral synonym"
+REASON_LEFT = "left synonym, left sided treatment"
+REASON_RIGHT = "right synonym, right sided treatment"
+REASON_PRIORITY_COUNT = "highest priority count"
+REASON_NOT_FOUND = "no synonym found"
+
+
+def files_size(paths):
+    """Bytes of the files on disk, files that do not exist are left out"""
+    return sum(
+        os.path.getsize(path)
+        for path in paths
+        if path is not None and os.path.isfile(path)
+    )
+
+
+def structure_file_state(structure_path):
+    """Returns the structure file path relative to the DICOM folder and its modification time in ns.
+    Used to tell if a roi_map row was made from the current structure file"""
+    relative_path = structure_path
+    if structure_path.startswith(DICOM_FOLDER_PATH):
+        relative_path = structure_path[len(DICOM_FOLDER_PATH) :]
+    try:
+        mtime = os.stat(structure_path).st_mtime_ns
+    except OSError:
+        mtime = None
+    return (relative_path, mtime)
+
+
+def roi_map_row_is_current(row, structure_file_path, structure_file_mtime, synonyms_fingerprint):
+    """True if the roi_map row was made from this structure file and these synonyms"""
+    return (
+        row is not None
+        and row["structure_file_path"] == structure_file_path
+        and row["structure_file_mtime"] == structure_file_mtime
+        and row["synonyms_fingerprint"] == synonyms_fingerprint
+    )
+
+
 class Treatment:
     def __init__(self, treatment_id, patient_id, treatment_collection_id):
         self.treatment_id = treatment_id
@@ -47,6 +92,10 @@ class Treatment:
         self.dose = None
         self.cts = list()
         self.first_ct = None
+        self.ct_volume = None
+        self.ct_series_metadata = None
+        # Approximate bytes of each kind of loaded data, measured when it is loaded
+        self.loaded_sizes = dict()
 
         # Other properties
         self.treatment_place = None
@@ -127,6 +176,7 @@ class Treatment:
                     )
                 else:
                     self.dose_path = self.sum_dose_path
+                    self.track_loaded("dose", files_size([self.dose_path]))
 
         # If the doses have already been summed
         elif len(self.sum_dose_paths) == 1:
@@ -158,6 +208,7 @@ class Treatment:
                     )
                 else:
                     self.dose_path = self.sum_dose_path
+                    self.track_loaded("dose", files_size([self.dose_path]))
         else:
             raise rtex.InitError(
                 f"Failed for patinet: {self.patient_id} More than one sum_dose for patienttreatment {self.treatment_id}"
@@ -183,20 +234,29 @@ class Treatment:
     def get_structure(self):
         """Returns the structure data"""
         if self.structure is None:
-            self.structure = dicomparser.DicomParser(self.structure_path)
+            self.structure = get_dicom(self.structure_path)
+            self.track_loaded("structure", files_size([self.structure_path]))
+        else:
+            MEMORY_BUDGET.touch(self)
         return self.structure
 
     def get_dose(self):
         """Returns the dose data"""
         if self.dose is None:
-            self.dose = dicomparser.DicomParser(self.dose_path)
+            self.dose = get_dicom(self.dose_path)
+            self.track_loaded("dose", files_size([self.dose_path]))
+        else:
+            MEMORY_BUDGET.touch(self)
         return self.dose
 
     def get_plans(self):
         """Returns a list of plan data"""
         if len(self.plans) == 0 and len(self.plan_paths) != 0:
             for path in self.plan_paths:
-                self.plans.append(dicomparser.DicomParser(path))
+                self.plans.append(get_dicom(path))
+            self.track_loaded("plans", files_size(self.plan_paths))
+        else:
+            MEMORY_BUDGET.touch(self)
         return self.plans
 
     def get_study_date(self):
@@ -230,13 +290,13 @@ class Treatment:
 
         if self.image_data is None:
             try:
-                self.image_data = dicomparser.DicomParser(
-                    self.ct_paths[0]
-                ).GetImageData()
+                self.image_data = get_dicom(self.ct_paths[0]).GetImageData()
             except IndexError:
                 raise rtex.NoCtsError(
                     f"{self.patient_id} has no cts. get_ct_image_data failed"
                 )
+            # The parsed CT file is kept in the DICOM cache
+            self.track_loaded("image_data", files_size(self.ct_paths[:1]))
         return self.image_data
 
     def get_max_dose(self):
@@ -339,8 +399,10 @@ class Treatment:
 
     def load_file_paths(self):
         """Loads the file paths from the db to the treatment"""
-        file_rows = self.get_file_paths()
+        self.load_file_rows(self.get_file_paths())
 
+    def load_file_rows(self, file_rows):
+        """Loads the file paths from dicom_files rows already read from the db"""
         for file_row in file_rows:
             local_path = f"{DICOM_FOLDER_PATH}{file_row[3]}"
             if file_row[2] == "ct":
@@ -361,10 +423,47 @@ class Treatment:
         self.cts = list()
         for path in self.ct_paths:
             self.cts.append(dicomparser.DicomParser(path))
+        self.track_loaded("cts", files_size(self.ct_paths))
 
     def load_first_ct_data(self):
         """Load the first CT-DICOM file"""
-        self.first_ct = dicomparser.DicomParser(self.ct_paths[0])
+        self.first_ct = get_dicom(self.ct_paths[0])
+        self.track_loaded("first_ct", files_size(self.ct_paths[:1]))
+
+    def get_ct_series_metadata(self):
+        """Returns the CtSeriesMetadata of the CTs. It is read from the ct_series table if the CT files are
+        unchanged since it was saved, otherwise from the CT headers and saved"""
+        if self.ct_series_metadata is None:
+            if len(self.ct_paths) == 0:
+                raise rtex.NoCtsError(f"No CTs for treatment {self.treatment_id}")
+
+            with rtdb.DatabaseCall() as db:
+                row = db.get_ct_series_row(self.treatment_id)
+            if row is not None and row["files_signature"] == rtct.files_signature(self.ct_paths):
+                self.ct_series_metadata = CtSeriesMetadata.from_row(row)
+            else:
+                self.ct_series_metadata = read_ct_series_metadata(self.ct_paths)
+                with rtdb.DatabaseCall() as db:
+                    db.save_ct_series_row(
+                        [self.treatment_id] + self.ct_series_metadata.to_row()
+                    )
+        return self.ct_series_metadata
+
+    def get_ct_volume(self, cache=True):
+        """Returns the CTs as a CtVolume, a z-sorted int16 HU array with its affine and SOPInstanceUID
+        index. With cache the array is memory mapped from the CT volume cache"""
+        if self.ct_volume is None:
+            if len(self.ct_paths) == 0:
+                raise rtex.NoCtsError(f"No CTs for treatment {self.treatment_id}")
+            self.ct_volume = rtct.load_ct_volume(self.ct_paths, cache=cache)
+            # Memory mapped volumes are paged in and out by the OS
+            if isinstance(self.ct_volume.hu, np.memmap):
+                self.track_loaded("ct_volume", 0)
+            else:
+                self.track_loaded("ct_volume", self.ct_volume.hu.nbytes)
+        else:
+            MEMORY_BUDGET.touch(self)
+        return self.ct_volume
 
     def load_all_dicom_data(self):
         """Load all dicom file data into the treatment"""
@@ -373,6 +472,53 @@ class Treatment:
         self.get_plans()
         self.get_dose()
 
+    def track_loaded(self, kind, size):
+        """Records the bytes of newly loaded data and reports the treatment to the memory budget"""
+        self.loaded_sizes[kind] = size
+        MEMORY_BUDGET.update(self)
+
+    def loaded_bytes(self):
+        """Approximate bytes of the loaded DICOM data: the sizes of the loaded files and of CT volumes
+        held in memory"""
+        return sum(self.loaded_sizes.values())
+
+    def unload(self):
+        """Drops the loaded DICOM data and removes the parsed files from the DICOM cache. The data is
+        loaded again when it is used. Paths, doses, ROIs and other attributes are kept"""
+        cached_paths = list()
+        if self.structure is not None:
+            cached_paths.append(self.structure_path)
+        if self.dose is not None:
+            cached_paths.append(self.dose_path)
+        if len(self.plans) > 0:
+            cached_paths.extend(self.plan_paths)
+        if self.first_ct is not None or self.image_data is not None:
+            cached_paths.extend(self.ct_paths[:1])
+        for path in cached_paths:
+            DICOM_CACHE.discard(path)
+
+        self.structure = None
+        self.dose = None
+        self.plans = list()
+        self.cts = list()
+        self.first_ct = None
+        self.image_data = None
+        self.ct_volume = None
+        self.loaded_sizes = dict()
+        MEMORY_BUDGET.release(self)
+
+    @contextmanager
+    def loaded(self):
+        """Unloads the DICOM data when the block ends
+
+        with treatment.loaded():
+            ...
+        """
+        try:
+            yield self
+        finally:
+            self.unload()
+
     # Functionality for augmented structures
 
     def get_augmented_structures_for_patient(self, structure_collection_id=None):
@@ -393,7 +539,11 @@ class Treatment:
         self.slice_thickness = None
         self.structure_id = None
         self.rois = list()
-        self.structure = None
+        if self.structure is not None:
+            DICOM_CACHE.discard(self.structure_path)
+            self.structure = None
+            self.loaded_sizes.pop("structure", None)
+            MEMORY_BUDGET.update(self)
 
     def change_structure_for_treatment(self, struct_path):
         """changes the structure used and resets all DVHs"""
@@ -440,14 +590,14 @@ class Treatment:
         #       Input:         treatment and the skagen name of the structure of interest
         #       Output: the coordinateset set for the chosen structure in this format: [[x,y,z],...,[xn,yn,z]],...[[x,y,zn],...,[xn,yn,zn]
         with rtdb.DatabaseCall() as db:
-            synonym_list = db.get_synonyms_from_standard_name(
-                standard_name, self.treatment_collection_id
-            )
+            synonym_index = db.get_synonym_index(self.treatment_collection_id)
 
         structures = self.get_structure()
         roi_names = structures.GetStructures()
         for index, roi in roi_names.items():
-            if (roi["name"].lower() in synonym_list) and not (roi["empty"]):
+            if (synonym_index.lookup(roi["name"], standard_name) is not None) and not (
+                roi["empty"]
+            ):
                 coordinate_list = list()
                 planes = structures.GetStructureCoordinates(roi["id"])
                 self.plane_list = planes.keys()
@@ -508,65 +658,31 @@ class Roi:
 
         self.dvh_priority = None
         self.priority_synonym = None
+        self.priority_synonym_reason = None
         self.synonyms_found = list()
 
     def find_synonyms(self):
         """Get all synonyms linked to the ROI standard name"""
         self.synonyms_found = list()
-        synonyms_standard = list()
 
         with rtdb.DatabaseCall() as db:
-            row_data = db.get_synonyms_from_standard_name(
-                self.standard_name,
-                self.treatment.treatment_collection_id,
-                priority=True,
-            )
-
-        for row in row_data:
-            if row[2] == None:
-                laterality = "x"
-            else:
-                laterality = row[2]
-
-            if row[1] == None:
-                priority_count = 0
-            else:
-                priority_count = row[1]
-
-            synonyms_standard.append(
-                {
-                    "name": row[0],
-                    "priority_count": priority_count,
-                    "laterality": laterality,
-                }
+            synonym_index = db.get_synonym_index(
+                self.treatment.treatment_collection_id
             )
 
         structures_in_file = self.treatment.get_structure().GetStructures()
 
         for key, structure in structures_in_file.items():
-            if any(
-                d["name"] == structure["name"].lower() for d in synonyms_standard
-            ) and not (structure["empty"]):
+            if structure["empty"]:
+                continue
+            synonym = synonym_index.lookup(structure["name"], self.standard_name)
+            if synonym is not None:
                 self.synonyms_found.append(
                     {
                         "name": structure["name"],
                         "structure_id": structure["id"],
-                        "priority_count": next(
-                            (
-                                item.get("priority_count")
-                                for item in synonyms_standard
-                                if item["name"].lower() == structure["name"].lower()
-                            ),
-                            False,
-                        ),
-                        "laterality": next(
-                            (
-                                item.get("laterality")
-                                for item in synonyms_standard
-                                if item["name"].lower() == structure["name"].lower()
-                            ),
-                            False,
-                        ),
+                        "priority_count": synonym.priority_count,
+                        "laterality": synonym.laterality,
                     }
                 )
 
@@ -578,8 +694,9 @@ class Roi:
 
     def calculate_dvh(self, structure_id):
         """Calculate the DVH for the structure using the main reference dose for relative dose calculation"""
+        # The parsed files come from the DICOM cache, get_dvh would read them again from the paths
         calcdvh = dvhcalc.get_dvh(
-            self.treatment.structure_path, self.treatment.dose_path, structure_id
+            self.treatment.get_structure().ds, self.treatment.get_dose().ds, structure_id
         )
         calcdvh.rx_dose = self.treatment.main_reference_dose
         return calcdvh
@@ -595,37 +712,74 @@ class Roi:
 
         return None
 
-    def get_priority_synonym(self):
-        """Get the synonym with the highest priority (laterality, count)"""
-
-        if self.priority_synonym is None:
-            synonyms = self.find_synonyms()
-            priority_structure = None
+    def choose_priority_synonym(self, synonyms):
+        """Returns the synonym with the highest priority (laterality, count) among synonyms sorted as in
+        find_synonyms, and the reason it was chosen"""
+        if len(synonyms) == 0:
+            return (None, REASON_NOT_FOUND)
+
+        for structure in synonyms:
+            if structure["laterality"] == "i":  # ipsilateral"
+                return (structure, REASON_IPSILATERAL)
+            if (
+                structure["laterality"] == "l"
+                and self.treatment.get_latterality() == "left"
+            ):
+                return (structure, REASON_LEFT)
+            elif (
+                structure["laterality"] == "r"
+                and self.treatment.get_latterality() == "right"
+            ):
+                return (structure, REASON_RIGHT)
+
+        return (synonyms[0], REASON_PRIORITY_COUNT)
+
+    def get_roi_map_row(self):
+        """Returns the roi_map row of the ROI if it was made from the current structure file and
+        synonyms, otherwise None"""
+        if self.treatment.treatment_id is None or self.treatment.structure_path is None:
+            return None
 
-            if len(synonyms) == 0:
+        with rtdb.DatabaseCall() as db:
+            row = db.get_roi_map_row(self.treatment.treatment_id, self.standard_name)
+            if row is None:
                 return None
+            synonym_index = db.get_synonym_index(
+                self.treatment.treatment_collection_id
+            )
 
-            for structure in synonyms:
-                if structure["laterality"] == "i":  # ipsilateral"
-                    priority_structure = structure
-                    break
-                if (
-                    structure["laterality"] == "l"
-                    and self.treatment.get_latterality() == "left"
-                ):
-                    priority_structure = structure
-                    break
-                elif (
-                    structure["laterality"] == "r"
-                    and self.treatment.get_latterality() == "right"
-                ):
-                    priority_structure = structure
-                    break
-
-            if priority_structure == None:
-                priority_structure = synonyms[0]
-
-            self.priority_synonym = priority_structure
+        structure_file_path, structure_file_mtime = structure_file_state(
+            self.treatment.structure_path
+        )
+        if not roi_map_row_is_current(
+            row,
+            structure_file_path,
+            structure_file_mtime,
+            synonym_index.fingerprint(self.standard_name),
+        ):
+            return None
+        return row
+
+    def get_priority_synonym(self):
+        """Get the synonym with the highest priority (laterality, count). Taken from the roi_map table if
+        it is up to date, otherwise found in the structure file"""
+
+        if self.priority_synonym is None and self.priority_synonym_reason is None:
+            row = self.get_roi_map_row()
+            if row is not None:
+                if row["structure_number"] is not None:
+                    self.priority_synonym = {
+                        "name": row["structure_name"],
+                        "structure_id": row["structure_number"],
+                        "priority_count": row["priority_count"],
+                        "laterality": row["laterality"],
+                    }
+                self.priority_synonym_reason = row["reason"]
+            else:
+                (
+                    self.priority_synonym,
+                    self.priority_synonym_reason,
+                ) = self.choose_priority_synonym(self.find_synonyms())
 
         return self.priority_synonym
 
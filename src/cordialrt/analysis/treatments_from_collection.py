@@ -1,4 +1,5 @@
 import datetime 
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 
 import cordialrt.analysis.treatment_class as rtclass
@@ -9,43 +10,66 @@ import cordialrt.helpers.user_config
 user_config = cordialrt.helpers.user_config.read_user_config()
 DICOM_FOLDER_PATH = user_config['dicom_file_parent_folder']
 
+def init_treatment(treatment_collection_id, treatment_row, file_rows):
+    """Creates the treatment from its database rows and runs the init check. Returns (treatment, None), or
+    (None, error) if the check failed"""
+    treatment = rtclass.Treatment(treatment_row[0],treatment_row[1],treatment_collection_id)
+    treatment.treatment_place = treatment_row[3]
+    treatment.main_dose_scale_factor = treatment_row[4]
+    treatment.main_reference_dose = treatment_row[5]
+    treatment.boost_reference_dose = treatment_row[6]
+    treatment.boost_dose_scale_factor = treatment_row[7]
+
+    treatment.load_file_rows(file_rows)
+
+    try:
+        if treatment.init_check():
+            return(treatment, None)
+    except (rtex.SumDoseError, rtex.InitError) as e:
+        return(None, e)
+    return(None, None)
+
+def init_treatment_in_worker(item):
+    """init_treatment in a worker process. The parsed DICOM files are dropped, so only the paths and
+    scalar attributes are sent back. They are parsed again when used."""
+    treatment, error = init_treatment(*item)
+    if treatment is not None:
+        treatment.unload()
+    return(treatment, error)
+
 def init_treatments_from_collection(treatment_collection_id, treatment_limit = None, departments =None, 
-                                    exclude_patients = None, select_patients = None, log_failed_path = False):   
+                                    exclude_patients = None, select_patients = None, log_failed_path = False,
+                                    workers = None):   
 
     """Initialse treatment objectives from the database and performs initialization checks. Set log_fail_path to a .txt file 
-    to log errors. """                                
+    to log errors. Use workers > 1 to run the checks and dose summations in a process pool, the treatments are
+    returned in the same order as without workers."""                                
+    # All treatments and their file rows in one query. Use treatment limit if you only want some of the 
+    # treatements for testing
     with rtdb.DatabaseCall() as db:
-        treatment_rows = db.get_treatments_from_collection(treatment_collection_id, departments, exclude_patients, select_patients)
+        treatment_file_rows = db.get_treatments_with_files_from_collection(treatment_collection_id, departments,
+                                                                            exclude_patients, select_patients,
+                                                                            treatment_limit = treatment_limit)
    
     treatments = list()
     log = list()
     log.append(f'collection_id: {treatment_collection_id}, treatment_limit: {treatment_limit}, departments: {departments}')
 
-    # use treatment limit if you only want some of the treatements for testing
-    if treatment_limit is None:
-        limit = len(treatment_rows)
+    items = [(treatment_collection_id, treatment_row, file_rows) for treatment_row, file_rows in treatment_file_rows]
+    if workers is None or workers <= 1:
+        results = [init_treatment(*item) for item in items]
     else:
-        limit = treatment_limit
-
-    for treatment_row in treatment_rows[0:limit]:
-        treatment = rtclass.Treatment(treatment_row[0],treatment_row[1],treatment_collection_id)
-        treatment.treatment_place = treatment_row[3]
-        treatment.main_dose_scale_factor = treatment_row[4]
-        treatment.main_reference_dose = treatment_row[5]
-        treatment.boost_reference_dose = treatment_row[6]
-        treatment.boost_dose_scale_factor = treatment_row[7]
-      
-        treatment.load_file_paths()
-
-        try:
-            if treatment.init_check():
-                treatments.append(treatment)
-
-        except (rtex.SumDoseError, rtex.InitError) as e:
-            print(e)
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            results = list(executor.map(init_treatment_in_worker, items))
+
+    for (_, treatment_row, _), (treatment, error) in zip(items, results):
+        if treatment is not None:
+            treatments.append(treatment)
+        elif error is not None:
+            print(error)
             if log_failed_path:
                 # patient_id;treatment_id;error_message
-                log.append(f'{treatment_row[1]};{treatment_row[0]};{e}')
+                log.append(f'{treatment_row[1]};{treatment_row[0]};{error}')
     
     if log_failed_path:
         with open(f'{log_failed_path}', 'a+') as f:
@@ -1,7 +1,7 @@
 import pandas as pd
 import cordialrt.database.database as rtdb
 from Levenshtein import ratio
-from dicompylercore import dicomparser
+from cordialrt.analysis.dicom_cache import get_dicom
 import cordialrt.helpers.user_config
 
 user_config = cordialrt.helpers.user_config.read_user_config()
@@ -83,7 +83,7 @@ def get_structure_names_from_id(patient_ids, collection_id):
         
         for file in files: 
             if file[2] == 'structure':
-                structure = dicomparser.DicomParser(DICOM_FOLDER_PATH + file[3]) 
+                structure = get_dicom(DICOM_FOLDER_PATH + file[3]) 
                 struct_info = structure.GetStructures()
 
                 for key, value in struct_info.items():
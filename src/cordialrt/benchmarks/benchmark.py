@@ -0,0 +1,282 @@
+"""
+Benchmark suite run on synthetic phantom cohorts (see phantom.py).
+
+Times the screening, treatment initialisation, dose summation, DVH, CAC screening and
+tube structure steps for each cohort size and reports the throughput and the peak Python
+memory (tracemalloc, which includes numpy arrays).
+
+The command line runs the suite in a subprocess with a temporary user_config.txt, whose DICOM
+folder, database and CT volume cache are in a temporary folder that is removed afterwards, so the
+configured database and DICOM archive are never touched. The phantoms and treatments are handled
+the same way as clinical data in there.
+
+Usage: python -m cordialrt.benchmarks.benchmark 5 20 --workers 4
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+import cordialrt.helpers.user_config
+import cordialrt.database.database as rtdb
+import cordialrt.analysis.sum_dose as rtsum
+from cordialrt.analysis.dicom_cache import cache_stats
+from cordialrt.analysis.memory_budget import MEMORY_BUDGET
+from cordialrt.analysis.roi_map import build_roi_map
+from cordialrt.analysis.treatments_from_collection import init_treatments_from_collection
+from cordialrt.benchmarks.phantom import MAIN_PLAN, BOOST_PLAN, create_phantom_cohort
+from cordialrt.screen_files.dicom_files_dataframe import open_dicom_files
+
+user_config = cordialrt.helpers.user_config.read_user_config()
+DICOM_FOLDER_PATH = user_config["dicom_file_parent_folder"]
+
+# Synonyms for the phantom ROI names, added to every benchmark collection
+BENCHMARK_SYNONYMS = {"heart": "heart", "ladca": "ladca", "lung_l": "lung_l", "lung_r": "lung_r"}
+
+REPORT_COLUMNS = ["benchmark", "n_patients", "items", "seconds", "items_per_second",
+                  "peak_memory_mb", "status"]
+
+
+def measure(benchmark, n_patients, function, items=None, trace_memory=True):
+    """Runs function and returns (result, report row). items is the number of items processed
+    (defaults to n_patients). Missing optional dependencies are reported as skipped."""
+    if items is None:
+        items = n_patients
+    if trace_memory:
+        tracemalloc.start()
+
+    status = "ok"
+    result = None
+    start_time = time.perf_counter()
+    try:
+        result = function()
+    except ImportError as e:
+        status = f"skipped: {e}"
+    seconds = time.perf_counter() - start_time
+
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+
+    row = {
+        "benchmark": benchmark,
+        "n_patients": n_patients,
+        "items": items,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds > 0 else None,
+        "peak_memory_mb": peak_memory,
+        "status": status,
+    }
+    print(f"{benchmark} ({n_patients} patients): {seconds:.2f} s, {status}")
+    return (result, row)
+
+
+def create_benchmark_cohort(n_patients, centre, **phantom_kwargs):
+    """Writes a phantom cohort to DICOM_FOLDER_PATH/centre (replacing an earlier one) and creates
+    the centre_dose_sum folder used for the summed doses. Returns the cohort folder"""
+    cohort_folder = os.path.join(DICOM_FOLDER_PATH, centre)
+    remove_benchmark_cohort(centre)
+    create_phantom_cohort(DICOM_FOLDER_PATH, n_patients, centre=centre, **phantom_kwargs)
+    os.makedirs(os.path.join(DICOM_FOLDER_PATH, f"{centre}_dose_sum"), exist_ok=True)
+    return cohort_folder
+
+
+def remove_benchmark_cohort(centre):
+    for folder in [centre, f"{centre}_dose_sum"]:
+        path = os.path.join(DICOM_FOLDER_PATH, folder)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+
+def create_benchmark_collection(data_frame, centre):
+    """Creates a treatment collection with a synonym collection for the phantom ROIs and adds a
+    treatment for each screened phantom patient. Returns the collection_id"""
+    collection_name = f"{centre} {datetime.datetime.now()}"
+    with rtdb.DatabaseCall() as db:
+        collection_id = db.create_treatment_collection(collection_name)
+        synonym_collection_id = db.create_synonym_collection(collection_name)
+        db.associate_synonym_collection_with_treatment_colection(synonym_collection_id, collection_id)
+        for synonym, standard_name in BENCHMARK_SYNONYMS.items():
+            db.add_synoym_to_synonym_colection(synonym_collection_id, synonym, standard_name)
+
+        for patient, plan_names in zip(data_frame.patient_object, data_frame.plan_names):
+            boost_reference_dose = BOOST_PLAN["dose"] if BOOST_PLAN["label"] in plan_names else 0
+            status, error_log = db.add_new_treatment_to_collection_from_plan_names(
+                patient, centre, collection_id, plan_names, MAIN_PLAN["dose"], boost_reference_dose
+            )
+            if not status:
+                print(error_log)
+    return collection_id
+
+
+def sum_treatment_doses(treatments):
+    """Sums the dose files of each treatment without saving the result"""
+    for treatment in treatments:
+        rtsum.sum_doses([[path, 1] for path in treatment.dose_paths], treatment.patient_id)
+
+
+def calculate_dvhs(treatments, roi_names):
+    """Calculates the DVH of each roi through the synonyms. Returns the number of DVHs"""
+    number_of_dvhs = 0
+    for treatment in treatments:
+        for roi_name in roi_names:
+            if treatment.roi_by_name(roi_name) is None:
+                treatment.add_new_roi(roi_name)
+            if treatment.roi_by_name(roi_name).get_dvh_priority_synonym() is not None:
+                number_of_dvhs = number_of_dvhs + 1
+    return number_of_dvhs
+
+
+def tube_widths(treatments, roi_name="ladca"):
+    """Runs the tube structure width analysis on the roi of each treatment"""
+    from cordialrt.analysis.tube_structure_analysis import tube_structure_analysis
+
+    widths = list()
+    for treatment in treatments:
+        if treatment.get_structure_information(roi_name) is None:
+            continue
+        widths.append(tube_structure_analysis(roi_name, treatment).get_width()[0])
+    return widths
+
+
+def run_screen_cac(collection_id, centre, patient_ids, output_folder):
+    import cordialrt.analysis.screen_cac as screen_cac
+
+    screen_cac.main(centre, output_folder, "treatment", patient_ids,
+                    treatment_collection_id=collection_id)
+
+
+def run_benchmarks(cohort_sizes=(5,), workers=None, n_slices=40, matrix_size=128,
+                   dvh_rois=("heart", "lung_l"), trace_memory=True, keep_files=False):
+    """Runs the benchmark suite for each cohort size and returns a dataframe with the report. Uses the
+    DICOM folder and database of the user config in the working directory, see run_isolated"""
+    rows = list()
+
+    for n_patients in cohort_sizes:
+        centre = f"benchmark_{n_patients}"
+        _, row = measure("create_phantom_cohort", n_patients,
+                         lambda: create_benchmark_cohort(n_patients, centre, n_slices=n_slices,
+                                                         matrix_size=matrix_size),
+                         trace_memory=trace_memory)
+        rows.append(row)
+        cohort_folder = os.path.join(DICOM_FOLDER_PATH, centre)
+
+        (data_frame, error_messages), row = measure(
+            "open_dicom_files", n_patients, lambda: open_dicom_files(cohort_folder, workers=workers),
+            trace_memory=trace_memory)
+        rows.append(row)
+
+        collection_id, row = measure("add_treatments_to_collection", n_patients,
+                                     lambda: create_benchmark_collection(data_frame, centre),
+                                     trace_memory=trace_memory)
+        rows.append(row)
+
+        # Includes summing and saving the primary and boost doses of each treatment
+        treatments, row = measure("init_treatments_from_collection", n_patients,
+                                  lambda: init_treatments_from_collection(collection_id, workers=workers),
+                                  trace_memory=trace_memory)
+        rows.append(row)
+
+        _, row = measure("sum_doses", n_patients, lambda: sum_treatment_doses(treatments),
+                         trace_memory=trace_memory)
+        rows.append(row)
+
+        _, row = measure("dvh", n_patients, lambda: calculate_dvhs(treatments, dvh_rois),
+                         items=n_patients * len(dvh_rois), trace_memory=trace_memory)
+        rows.append(row)
+
+        _, row = measure("build_roi_map", n_patients,
+                         lambda: build_roi_map(collection_id, list(dvh_rois), treatments=treatments),
+                         items=n_patients * len(dvh_rois), trace_memory=trace_memory)
+        rows.append(row)
+
+        _, row = measure("tube_structure_analysis.get_width", n_patients,
+                         lambda: tube_widths(treatments), trace_memory=trace_memory)
+        rows.append(row)
+
+        with tempfile.TemporaryDirectory() as output_folder:
+            _, row = measure("screen_cac.main", n_patients,
+                             lambda: run_screen_cac(collection_id, centre, data_frame.patient_id.tolist(),
+                                                    output_folder),
+                             trace_memory=trace_memory)
+            rows.append(row)
+
+        if not keep_files:
+            with rtdb.DatabaseCall() as db:
+                db.delete_treatment_from_collection(data_frame.patient_id.tolist(), collection_id)
+            remove_benchmark_cohort(centre)
+
+    report = pd.DataFrame(rows, columns=REPORT_COLUMNS)
+    print(report.to_string(index=False))
+    print(f"DICOM cache: {cache_stats()}")
+    print(f"Treatment memory budget: {MEMORY_BUDGET.stats()}")
+    return report
+
+
+def isolated_user_config(folder):
+    """Lines of a user_config.txt with the settings of the current config, but the DICOM folder,
+    database and CT volume cache in folder"""
+    config = dict(user_config)
+    dicom_folder = os.path.join(folder, "dicom")
+    # Paths from the database are appended to the DICOM folder as they are
+    if config["dicom_file_parent_folder"].endswith(("/", "\\")):
+        dicom_folder = dicom_folder + os.sep
+    config["dicom_file_parent_folder"] = dicom_folder
+    config["database_path"] = os.path.join(folder, "benchmark.db")
+    config["ct_volume_cache_folder"] = os.path.join(folder, "ct_volumes")
+    return [f"{key}={value}\n" for key, value in config.items()]
+
+
+def run_isolated(arguments):
+    """Runs the benchmark command line with arguments in a subprocess, with a temporary folder as working
+    directory and a user config pointing to it. Returns the exit code"""
+    source_folder = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(
+        [source_folder] + [path for path in [environment.get("PYTHONPATH")] if path]
+    )
+
+    with tempfile.TemporaryDirectory() as folder:
+        os.makedirs(os.path.join(folder, "dicom"))
+        with open(os.path.join(folder, "user_config.txt"), "w") as config_file:
+            config_file.writelines(isolated_user_config(folder))
+        process = subprocess.run(
+            [sys.executable, "-m", "cordialrt.benchmarks.benchmark", "--isolated"] + arguments,
+            cwd=folder, env=environment)
+    return process.returncode
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the cordialrt benchmarks on phantom cohorts")
+    parser.add_argument("cohort_sizes", nargs="*", type=int, default=[5])
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--slices", type=int, default=40)
+    parser.add_argument("--matrix-size", type=int, default=128)
+    parser.add_argument("--no-memory", action="store_true", help="Do not trace memory (faster)")
+    parser.add_argument("--keep-files", action="store_true")
+    parser.add_argument("--output", default=None, help="Save the report to this csv file")
+    # Set by run_isolated in the subprocess that runs in the temporary folder
+    parser.add_argument("--isolated", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.isolated:
+        arguments = sys.argv[1:]
+        if args.output:
+            # The subprocess runs in the temporary folder
+            arguments = arguments + ["--output", os.path.abspath(args.output)]
+        sys.exit(run_isolated(arguments))
+
+    report = run_benchmarks(args.cohort_sizes, workers=args.workers, n_slices=args.slices,
+                            matrix_size=args.matrix_size, trace_memory=not args.no_memory,
+                            keep_files=args.keep_files)
+    if args.output:
+        report.to_csv(args.output, index=False)
@@ -0,0 +1,150 @@
+"""
+Benchmark of the hot database queries with and without the indexes from cordialrt.database.schema.
+
+A synthetic database is created at schema version 1 (tables only), filled with treatments,
+files, synonyms, augmented structures and data points, and the queries are timed. The database
+is then upgraded to the latest schema in place and the queries are timed again.
+
+Usage: python -m cordialrt.benchmarks.index_benchmark --treatments 8000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+import pandas as pd
+
+from cordialrt.database import schema
+
+EDIT = ["2024-01-01 00:00:00", "benchmark"]
+
+
+def fill_database(connection, n_treatments, n_collections=4, files_per_treatment=150,
+                  n_synonym_collections=10, synonyms_per_collection=400, data_points_per_patient=40,
+                  n_extractions=4):
+    """Inserts a synthetic collection of the given size"""
+    random.seed(0)
+    cursor = connection.cursor()
+
+    treatment_rows = list()
+    for treatment_id in range(1, n_treatments + 1):
+        collection_id = treatment_id % n_collections + 1
+        treatment_rows.append([treatment_id, f"patient_{treatment_id:06d}", collection_id,
+                               f"Centre {treatment_id % 7}", 1, 50, 10, 1] + EDIT)
+    cursor.executemany("INSERT INTO treatments VALUES (?,?,?,?,?,?,?,?,?,?)", treatment_rows)
+
+    file_rows = list()
+    for treatment_id in range(1, n_treatments + 1):
+        for number in range(files_per_treatment):
+            file_type = "ct" if number > 4 else ["plan", "structure", "dose", "dose", "plan"][number]
+            file_rows.append([treatment_id, file_type, f"/Centre/patient_{treatment_id:06d}/{number}.dcm",
+                              f"1.2.3.{treatment_id}.{number}"] + EDIT)
+    # Files are added per patient folder, so the rows of a treatment are spread over the table
+    random.shuffle(file_rows)
+    cursor.executemany("""INSERT INTO dicom_files (treatment_id, file_type, file_path, file_uid, edit_date,
+                       edit_user) VALUES (?,?,?,?,?,?)""", file_rows)
+
+    synonym_rows = list()
+    for synonym_collection_id in range(1, n_synonym_collections + 1):
+        for number in range(synonyms_per_collection):
+            synonym_rows.append([synonym_collection_id, f"standard_{number % 40}", f"synonym_{number}", "",
+                                 number] + EDIT)
+        cursor.execute("INSERT INTO synonyms_for_treatment_collections VALUES (?,?,?,?)",
+                       [synonym_collection_id, synonym_collection_id % n_collections + 1] + EDIT)
+    cursor.executemany("INSERT INTO synonyms VALUES (?,?,?,?,?,?,?)", synonym_rows)
+
+    structure_rows = list()
+    for treatment_id in range(1, n_treatments + 1):
+        for structure_collection_id in range(1, 4):
+            structure_rows.append([structure_collection_id, treatment_id, f"patient_{treatment_id:06d}"] + EDIT)
+    cursor.executemany("""INSERT INTO structures (structure_collection_id, dicom_file_id, patient_id, edit_date,
+                       edit_user) VALUES (?,?,?,?,?)""", structure_rows)
+
+    data_point_rows = list()
+    for data_extraction_id in range(1, n_extractions + 1):
+        cursor.execute("INSERT INTO data_extractions VALUES (?,?,?,?)", [data_extraction_id, 1] + EDIT)
+        for treatment_id in range(1, n_treatments + 1):
+            for number in range(data_points_per_patient):
+                data_point_rows.append([data_extraction_id, f"patient_{treatment_id:06d}", f"point_{number}",
+                                        number, None, "roi_dvh", "heart"] + EDIT)
+    cursor.executemany("""INSERT INTO data_points (data_extraction_id, patient_id, data_point_name,
+                       data_point_value_num, data_point_value_string, data_point_type, roi_standard_name,
+                       edit_date, edit_user) VALUES (?,?,?,?,?,?,?,?,?)""", data_point_rows)
+    connection.commit()
+
+
+def hot_queries(n_treatments):
+    """(name, sql, list of parameters) for the queries run per treatment, roi and data point"""
+    treatment_ids = random.sample(range(1, n_treatments + 1), min(200, n_treatments))
+    patient_ids = [f"patient_{treatment_id:06d}" for treatment_id in treatment_ids]
+    return [
+        ("treatments by collection", "SELECT * FROM treatments WHERE collection_id = ?",
+         [[collection_id] for collection_id in range(1, 5)]),
+        ("treatments by patient", "SELECT * FROM treatments WHERE collection_id = ? AND patient_id = ?",
+         [[treatment_id % 4 + 1, patient_id] for treatment_id, patient_id in zip(treatment_ids, patient_ids)]),
+        ("dicom_files by treatment", "SELECT * FROM dicom_files WHERE treatment_id = ?",
+         [[treatment_id] for treatment_id in treatment_ids]),
+        ("synonyms by standard name", """SELECT synonym, priority_count, laterality FROM synonyms
+                                         WHERE standard_name = ? AND synonym_collection_id = ?""",
+         [[f"standard_{number % 40}", number % 10 + 1] for number in range(200)]),
+        ("structures by patient", """SELECT dicom_file_id, structure_collection_id FROM structures
+                                     WHERE patient_id = ? AND structure_collection_id = ?""",
+         [[patient_id, 2] for patient_id in patient_ids]),
+        ("data_points by extraction and patient", """SELECT * FROM data_points
+                                                     WHERE data_extraction_id = ? AND patient_id = ?""",
+         [[2, patient_id] for patient_id in patient_ids]),
+    ]
+
+
+def time_queries(connection, queries):
+    times = dict()
+    for name, sql_string, parameters in queries:
+        start_time = time.perf_counter()
+        for variables in parameters:
+            connection.execute(sql_string, variables).fetchall()
+        times[name] = (time.perf_counter() - start_time) / len(parameters) * 1000
+    return times
+
+
+def run_index_benchmark(n_treatments=8000, database_path=None, **fill_kwargs):
+    """Returns a dataframe with the mean query time in ms before and after the schema upgrade"""
+    with tempfile.TemporaryDirectory() as folder:
+        if database_path is None:
+            database_path = os.path.join(folder, "index_benchmark.db")
+        schema.upgrade_database(database_path, target_version=1)
+
+        connection = sqlite3.connect(database_path)
+        try:
+            start_time = time.perf_counter()
+            fill_database(connection, n_treatments, **fill_kwargs)
+            print(f"Filled database with {n_treatments} treatments in {time.perf_counter() - start_time:.1f} s")
+
+            queries = hot_queries(n_treatments)
+            without_indexes = time_queries(connection, queries)
+
+            start_time = time.perf_counter()
+            schema.upgrade_connection(connection)
+            print(f"Upgraded schema in {time.perf_counter() - start_time:.1f} s")
+            with_indexes = time_queries(connection, queries)
+        finally:
+            connection.close()
+
+    report = pd.DataFrame({
+        "query": list(without_indexes.keys()),
+        "ms_without_indexes": list(without_indexes.values()),
+        "ms_with_indexes": list(with_indexes.values()),
+    })
+    report["speedup"] = report.ms_without_indexes / report.ms_with_indexes
+    print(report.to_string(index=False))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the database indexes on a synthetic database")
+    parser.add_argument("--treatments", type=int, default=8000)
+    parser.add_argument("--files-per-treatment", type=int, default=150)
+    args = parser.parse_args()
+    run_index_benchmark(args.treatments, files_per_treatment=args.files_per_treatment)
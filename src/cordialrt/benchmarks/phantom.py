@@ -0,0 +1,388 @@
+"""
+Generator for synthetic DICOM-RT phantom patients.
+
+Each phantom patient consists of a CT series, an RTSTRUCT with heart, LADCA, lung and
+breast ROIs, a primary and a boost RTPLAN and one RTDOSE for each plan. All files are
+UID-linked the same way as clinical exports, so they can be screened, added to a
+treatment collection and analysed without sharing patient data.
+"""
+
+import datetime
+import math
+import os
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+RT_DOSE_STORAGE = "1.2.840.10008.5.1.4.1.1.481.2"
+RT_STRUCTURE_SET_STORAGE = "1.2.840.10008.5.1.4.1.1.481.3"
+RT_PLAN_STORAGE = "1.2.840.10008.5.1.4.1.1.481.5"
+
+# Phantom anatomy in patient coordinates (mm). Positive x is the patient's left side.
+BODY = {"center": (0.0, 0.0), "axes": (160.0, 110.0), "hu": 0}
+LUNG_L = {"center": (70.0, 0.0), "axes": (50.0, 60.0), "hu": -800}
+LUNG_R = {"center": (-70.0, 0.0), "axes": (50.0, 60.0), "hu": -800}
+HEART = {"center": (20.0, -10.0), "axes": (40.0, 35.0), "hu": 40}
+BREAST_L = {"center": (80.0, -85.0), "axes": (45.0, 22.0), "hu": 20}
+BREAST_R = {"center": (-80.0, -85.0), "axes": (45.0, 22.0), "hu": 20}
+LADCA_RADIUS = 3.0
+CALCIFICATION_HU = 500
+
+# Standard DBCG fractionation, matching the reference doses handled by sum_dose.
+MAIN_PLAN = {"label": "Breast 50Gy", "fractions": 25, "dose": 50.0}
+BOOST_PLAN = {"label": "Boost 10Gy", "fractions": 5, "dose": 10.0}
+
+
+def _new_dataset(file_path, sop_class_uid, sop_instance_uid, patient, modality):
+    """Returns a FileDataset with file meta, patient and study information filled in"""
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = sop_class_uid
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+
+    ds = FileDataset(file_path, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = sop_instance_uid
+    ds.Modality = modality
+    ds.PatientID = patient["patient_id"]
+    ds.PatientName = f"Phantom^{patient['patient_id']}"
+    ds.PatientSex = "F"
+    ds.StudyInstanceUID = patient["study_uid"]
+    ds.StudyDate = patient["study_date"]
+    ds.StudyTime = "120000"
+    ds.StudyID = "1"
+    ds.FrameOfReferenceUID = patient["frame_of_reference_uid"]
+    ds.Manufacturer = "cordialrt phantom"
+    return ds
+
+
+def _save(ds, file_path):
+    ds.save_as(file_path, write_like_original=False)
+    return file_path
+
+
+def _ellipse_mask(x_grid, y_grid, organ):
+    cx, cy = organ["center"]
+    ax, ay = organ["axes"]
+    return ((x_grid - cx) / ax) ** 2 + ((y_grid - cy) / ay) ** 2 <= 1
+
+
+def _ellipse_contour(organ, z, n_points=24):
+    cx, cy = organ["center"]
+    ax, ay = organ["axes"]
+    points = list()
+    for i in range(n_points):
+        angle = 2 * math.pi * i / n_points
+        points = points + [
+            round(cx + ax * math.cos(angle), 2),
+            round(cy + ay * math.sin(angle), 2),
+            round(z, 2),
+        ]
+    return points
+
+
+def _ladca_center(slice_index, n_slices):
+    """The LAD follows the anterior surface of the heart, turning slightly with z"""
+    angle = -math.pi / 2 + 0.6 * (slice_index / max(n_slices - 1, 1) - 0.5)
+    cx, cy = HEART["center"]
+    ax, ay = HEART["axes"]
+    return (cx + (ax - 6) * math.cos(angle), cy + (ay - 6) * math.sin(angle))
+
+
+def _heart_slices(n_slices):
+    """Slice indices containing the heart (the middle two thirds of the scan)"""
+    return range(n_slices // 6, n_slices - n_slices // 6)
+
+
+def write_ct_series(folder, patient, n_slices=40, matrix_size=128, pixel_spacing=3.0,
+                    slice_thickness=3.0, calcifications=True):
+    """Writes a CT series and returns a list of dicts with path, uid and z for each slice"""
+    series_uid = generate_uid()
+    origin = -pixel_spacing * (matrix_size - 1) / 2
+    coordinates = origin + pixel_spacing * np.arange(matrix_size)
+    x_grid, y_grid = np.meshgrid(coordinates, coordinates)
+
+    heart_slices = _heart_slices(n_slices)
+    slices = list()
+    for index in range(n_slices):
+        z = index * slice_thickness
+        hu = np.full((matrix_size, matrix_size), -1000, dtype=np.int16)
+        for organ in [BODY, LUNG_L, LUNG_R, BREAST_L, BREAST_R]:
+            hu[_ellipse_mask(x_grid, y_grid, organ)] = organ["hu"]
+        if index in heart_slices:
+            hu[_ellipse_mask(x_grid, y_grid, HEART)] = HEART["hu"]
+            if calcifications and index % 3 == 0:
+                cx, cy = _ladca_center(index, n_slices)
+                plaque = {"center": (cx, cy), "axes": (LADCA_RADIUS, LADCA_RADIUS)}
+                hu[_ellipse_mask(x_grid, y_grid, plaque)] = CALCIFICATION_HU
+
+        sop_uid = generate_uid()
+        file_path = os.path.join(folder, f"CT_{patient['patient_id']}_{index:04d}.dcm")
+        ds = _new_dataset(file_path, CT_IMAGE_STORAGE, sop_uid, patient, "CT")
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = index + 1
+        ds.ImageType = ["ORIGINAL", "PRIMARY", "AXIAL"]
+        ds.KVP = 120
+        ds.SoftwareVersions = "1.0"
+        ds.SliceThickness = slice_thickness
+        ds.ImagePositionPatient = [origin, origin, z]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.SliceLocation = z
+        ds.PixelSpacing = [pixel_spacing, pixel_spacing]
+        ds.Rows = matrix_size
+        ds.Columns = matrix_size
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.RescaleIntercept = -1024
+        ds.RescaleSlope = 1
+        ds.PixelData = (hu.astype(np.int32) + 1024).astype(np.uint16).tobytes()
+
+        slices.append({"path": _save(ds, file_path), "uid": sop_uid, "z": z})
+
+    return slices
+
+
+def write_structure_set(folder, patient, ct_slices):
+    """Writes an RTSTRUCT contouring the phantom organs on the CT slices. Returns (path, uid)"""
+    sop_uid = generate_uid()
+    file_path = os.path.join(folder, f"RS_{patient['patient_id']}.dcm")
+    ds = _new_dataset(file_path, RT_STRUCTURE_SET_STORAGE, sop_uid, patient, "RTSTRUCT")
+    ds.SeriesInstanceUID = generate_uid()
+    ds.StructureSetLabel = "Phantom"
+    ds.StructureSetDate = patient["study_date"]
+
+    contour_images = Sequence()
+    for ct_slice in ct_slices:
+        image = Dataset()
+        image.ReferencedSOPClassUID = CT_IMAGE_STORAGE
+        image.ReferencedSOPInstanceUID = ct_slice["uid"]
+        contour_images.append(image)
+
+    series = Dataset()
+    series.SeriesInstanceUID = patient["ct_series_uid"]
+    series.ContourImageSequence = contour_images
+    study = Dataset()
+    study.ReferencedSOPClassUID = "1.2.840.10008.3.1.2.3.1"
+    study.ReferencedSOPInstanceUID = patient["study_uid"]
+    study.RTReferencedSeriesSequence = Sequence([series])
+    frame = Dataset()
+    frame.FrameOfReferenceUID = patient["frame_of_reference_uid"]
+    frame.RTReferencedStudySequence = Sequence([study])
+    ds.ReferencedFrameOfReferenceSequence = Sequence([frame])
+
+    n_slices = len(ct_slices)
+    heart_slices = _heart_slices(n_slices)
+    rois = [
+        ("Heart", "ORGAN", lambda index: HEART if index in heart_slices else None),
+        ("LADCA", "ORGAN", lambda index: {
+            "center": _ladca_center(index, n_slices),
+            "axes": (LADCA_RADIUS, LADCA_RADIUS),
+        } if index in heart_slices else None),
+        ("Lung_L", "ORGAN", lambda index: LUNG_L),
+        ("Lung_R", "ORGAN", lambda index: LUNG_R),
+        ("CTV_breast_L", "CTV", lambda index: BREAST_L),
+        ("Body", "EXTERNAL", lambda index: BODY),
+    ]
+
+    ds.StructureSetROISequence = Sequence()
+    ds.ROIContourSequence = Sequence()
+    ds.RTROIObservationsSequence = Sequence()
+    for number, (name, roi_type, organ_on_slice) in enumerate(rois, start=1):
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ReferencedFrameOfReferenceUID = patient["frame_of_reference_uid"]
+        roi.ROIName = name
+        roi.ROIGenerationAlgorithm = "MANUAL"
+        ds.StructureSetROISequence.append(roi)
+
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ROIDisplayColor = [255, 0, 0]
+        roi_contour.ContourSequence = Sequence()
+        for index, ct_slice in enumerate(ct_slices):
+            organ = organ_on_slice(index)
+            if organ is None:
+                continue
+            image = Dataset()
+            image.ReferencedSOPClassUID = CT_IMAGE_STORAGE
+            image.ReferencedSOPInstanceUID = ct_slice["uid"]
+            contour = Dataset()
+            contour.ContourImageSequence = Sequence([image])
+            contour.ContourGeometricType = "CLOSED_PLANAR"
+            contour.ContourData = _ellipse_contour(organ, ct_slice["z"])
+            contour.NumberOfContourPoints = len(contour.ContourData) // 3
+            roi_contour.ContourSequence.append(contour)
+        ds.ROIContourSequence.append(roi_contour)
+
+        observation = Dataset()
+        observation.ObservationNumber = number
+        observation.ReferencedROINumber = number
+        observation.RTROIInterpretedType = roi_type
+        observation.ROIInterpreter = ""
+        ds.RTROIObservationsSequence.append(observation)
+
+    return (_save(ds, file_path), sop_uid)
+
+
+def write_plan(folder, patient, structure_uid, plan, file_prefix):
+    """Writes an RTPLAN with one fraction group referencing the structure set. Returns (path, uid)"""
+    sop_uid = generate_uid()
+    file_path = os.path.join(folder, f"{file_prefix}_{patient['patient_id']}.dcm")
+    ds = _new_dataset(file_path, RT_PLAN_STORAGE, sop_uid, patient, "RTPLAN")
+    ds.SeriesInstanceUID = generate_uid()
+    ds.RTPlanLabel = plan["label"]
+    ds.RTPlanDate = patient["study_date"]
+    ds.RTPlanGeometry = "PATIENT"
+    ds.ApprovalStatus = "APPROVED"
+
+    structure_reference = Dataset()
+    structure_reference.ReferencedSOPClassUID = RT_STRUCTURE_SET_STORAGE
+    structure_reference.ReferencedSOPInstanceUID = structure_uid
+    ds.ReferencedStructureSetSequence = Sequence([structure_reference])
+
+    dose_reference = Dataset()
+    dose_reference.DoseReferenceNumber = 1
+    dose_reference.DoseReferenceStructureType = "SITE"
+    dose_reference.DoseReferenceDescription = plan["label"]
+    dose_reference.DoseReferenceType = "TARGET"
+    dose_reference.TargetPrescriptionDose = plan["dose"]
+    ds.DoseReferenceSequence = Sequence([dose_reference])
+
+    fraction_group = Dataset()
+    fraction_group.FractionGroupNumber = 1
+    fraction_group.NumberOfFractionsPlanned = plan["fractions"]
+    fraction_group.NumberOfBeams = 0
+    fraction_group.NumberOfBrachyApplicationSetups = 0
+    ds.FractionGroupSequence = Sequence([fraction_group])
+
+    return (_save(ds, file_path), sop_uid)
+
+
+def write_dose(folder, patient, plan_uid, plan, ct_slices, file_prefix, matrix_size=64,
+               pixel_spacing=6.0, laterality="left", spread=60.0):
+    """Writes an RTDOSE for a plan with a dose blob on the treated breast. Returns (path, uid)"""
+    sop_uid = generate_uid()
+    file_path = os.path.join(folder, f"{file_prefix}_{patient['patient_id']}.dcm")
+    ds = _new_dataset(file_path, RT_DOSE_STORAGE, sop_uid, patient, "RTDOSE")
+    ds.SeriesInstanceUID = generate_uid()
+
+    origin = -pixel_spacing * (matrix_size - 1) / 2
+    coordinates = origin + pixel_spacing * np.arange(matrix_size)
+    x_grid, y_grid = np.meshgrid(coordinates, coordinates)
+    target = BREAST_L if laterality == "left" else BREAST_R
+    cx, cy = target["center"]
+    plane = plan["dose"] * np.exp(-((x_grid - cx) ** 2 + (y_grid - cy) ** 2) / (2 * spread ** 2))
+    plane[~_ellipse_mask(x_grid, y_grid, BODY)] = 0
+
+    z_positions = [ct_slice["z"] for ct_slice in ct_slices]
+    z_extent = max(z_positions[-1] - z_positions[0], 1.0)
+    z_middle = (z_positions[0] + z_positions[-1]) / 2
+    grid = np.stack([
+        plane * max(0.0, 1 - ((z - z_middle) / z_extent) ** 2) for z in z_positions
+    ])
+
+    dose_grid_scaling = 1e-4
+    ds.Rows = matrix_size
+    ds.Columns = matrix_size
+    ds.NumberOfFrames = len(z_positions)
+    ds.FrameIncrementPointer = 0x3004000C
+    ds.GridFrameOffsetVector = [z - z_positions[0] for z in z_positions]
+    ds.ImagePositionPatient = [origin, origin, z_positions[0]]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [pixel_spacing, pixel_spacing]
+    ds.SliceThickness = ""
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 32
+    ds.BitsStored = 32
+    ds.HighBit = 31
+    ds.PixelRepresentation = 0
+    ds.DoseUnits = "GY"
+    ds.DoseType = "PHYSICAL"
+    ds.DoseSummationType = "PLAN"
+    ds.DoseGridScaling = dose_grid_scaling
+    ds.PixelData = np.round(grid / dose_grid_scaling).astype(np.uint32).tobytes()
+
+    plan_reference = Dataset()
+    plan_reference.ReferencedSOPClassUID = RT_PLAN_STORAGE
+    plan_reference.ReferencedSOPInstanceUID = plan_uid
+    fraction_reference = Dataset()
+    fraction_reference.ReferencedFractionGroupNumber = 1
+    plan_reference.ReferencedFractionGroupSequence = Sequence([fraction_reference])
+    ds.ReferencedRTPlanSequence = Sequence([plan_reference])
+
+    return (_save(ds, file_path), sop_uid)
+
+
+def create_phantom_patient(folder, patient_id, n_slices=40, matrix_size=128, boost=True,
+                           laterality="left", calcifications=True):
+    """Writes a complete phantom patient to folder and returns a dict describing the files"""
+    os.makedirs(folder, exist_ok=True)
+    patient = {
+        "patient_id": patient_id,
+        "study_uid": generate_uid(),
+        "frame_of_reference_uid": generate_uid(),
+        "study_date": datetime.date.today().strftime("%Y%m%d"),
+    }
+
+    ct_slices = write_ct_series(folder, patient, n_slices=n_slices,
+                                matrix_size=matrix_size, calcifications=calcifications)
+    patient["ct_series_uid"] = pydicom.dcmread(
+        ct_slices[0]["path"], stop_before_pixels=True
+    ).SeriesInstanceUID
+
+    structure_path, structure_uid = write_structure_set(folder, patient, ct_slices)
+    plans = [MAIN_PLAN, BOOST_PLAN] if boost else [MAIN_PLAN]
+
+    plan_files = list()
+    dose_files = list()
+    for index, plan in enumerate(plans):
+        plan_path, plan_uid = write_plan(folder, patient, structure_uid, plan, f"RP{index}")
+        dose_path, dose_uid = write_dose(
+            folder, patient, plan_uid, plan, ct_slices, f"RD{index}",
+            matrix_size=matrix_size // 2, pixel_spacing=6.0,
+            laterality=laterality, spread=60.0 if index == 0 else 30.0,
+        )
+        plan_files.append({"path": plan_path, "uid": plan_uid, "label": plan["label"]})
+        dose_files.append({"path": dose_path, "uid": dose_uid})
+
+    return {
+        "patient_id": patient_id,
+        "folder": folder,
+        "study_uid": patient["study_uid"],
+        "cts": ct_slices,
+        "structure": {"path": structure_path, "uid": structure_uid},
+        "plans": plan_files,
+        "doses": dose_files,
+        "plan_names": [plan["label"] for plan in plans],
+        "main_reference_dose": MAIN_PLAN["dose"],
+        "boost_reference_dose": BOOST_PLAN["dose"] if boost else 0,
+    }
+
+
+def create_phantom_cohort(parent_folder, n_patients, centre="Centre 1", id_prefix="phantom",
+                          **kwargs):
+    """Writes n_patients phantom patients to parent_folder/centre/patient_id/ and returns
+    a list of the patient descriptions"""
+    patients = list()
+    for number in range(n_patients):
+        patient_id = f"{id_prefix}_{number:05d}"
+        folder = os.path.join(parent_folder, centre, patient_id)
+        laterality = "left" if number % 2 == 0 else "right"
+        patients.append(
+            create_phantom_patient(folder, patient_id, laterality=laterality, **kwargs)
+        )
+    return patients
@@ -0,0 +1,103 @@
+"""
+Long lived SQLite connections shared by all DatabaseCall objects. Each thread gets its own
+connection, which is opened on first use with the PRAGMAs set once. After a fork the child
+process opens new connections instead of using the ones inherited from the parent.
+"""
+
+import os
+import sqlite3
+import threading
+
+# Applied once to every new connection
+DEFAULT_PRAGMAS = {
+    "cache_size": -65536,  # 64 MB page cache
+    "temp_store": "MEMORY",
+    "busy_timeout": 60000,  # ms to wait for a lock held by another process before failing
+}
+
+# Added with concurrent_writes. Readers do not block the writer and the other way round in WAL
+# mode. WAL needs shared memory and does not work for a database on a network drive
+CONCURRENT_WRITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+}
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that keeps track of the DatabaseCall objects using it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Number of open DatabaseCall with blocks on this connection
+        self.users = 0
+        # Set while inside DatabaseCall.transaction()
+        self.transaction_open = False
+
+
+class ConnectionPool:
+    """initialise is called with the first connection opened in each process, e.g. to upgrade the schema.
+    Use concurrent_writes when several processes write to the database at the same time"""
+
+    def __init__(self, database_path, pragmas=None, initialise=None, concurrent_writes=False):
+        self.database_path = database_path
+        self.pragmas = dict(DEFAULT_PRAGMAS if pragmas is None else pragmas)
+        if concurrent_writes:
+            self.pragmas.update(CONCURRENT_WRITE_PRAGMAS)
+        self.initialise = initialise
+        self._lock = threading.Lock()
+        self._reset()
+
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        """Forget all connections. Connections inherited over a fork must not be used or closed"""
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._connections = list()
+        self._initialised = False
+
+    def connect(self):
+        connection = sqlite3.connect(
+            self.database_path, factory=PooledConnection, check_same_thread=False
+        )
+        for name, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    def connection(self):
+        """Returns the connection of the calling thread, opening it on first use"""
+        if self._pid != os.getpid():
+            # Forked without register_at_fork
+            self._reset()
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self.connect()
+            if self.initialise is not None and not self._initialised:
+                with self._lock:
+                    if not self._initialised:
+                        self.initialise(connection)
+                        self._initialised = True
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        """Close the connection of the calling thread"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            with self._lock:
+                self._connections.remove(connection)
+            connection.close()
+
+    def close_all(self):
+        """Close the connections of all threads in this process"""
+        with self._lock:
+            connections = self._connections
+            self._connections = list()
+        self._local = threading.local()
+        for connection in connections:
+            connection.close()
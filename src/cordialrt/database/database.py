@@ -2,26 +2,81 @@
 All functions interacting with the database. 
 """
 
+import itertools
+import os
 import sqlite3
 import datetime
-import glob
-import numpy as np
+from contextlib import contextmanager
 import pandas as pd
-from dicompylercore import dicomparser
+import pydicom
 import cordialrt.helpers.definitions
 import cordialrt.helpers.user_config
 import cordialrt.helpers.exceptions as crtex
+from cordialrt.database.connection_pool import ConnectionPool
+from cordialrt.database.schema import upgrade_connection
+from cordialrt.database.synonym_index import (
+    get_synonym_index,
+    invalidate_synonym_indexes,
+)
+from cordialrt.screen_files.base.folder_utilities import walk_dicom_folders
 
 user_config = cordialrt.helpers.user_config.read_user_config()
 USER_NAME = user_config["user"]
 DICOM_FOLDER_PATH = user_config["dicom_file_parent_folder"]
 DATABASE_PATH = user_config["database_path"]
+# Optional, set database_concurrent_writes=true when running extractions in parallel processes
+CONCURRENT_WRITES = user_config.get("database_concurrent_writes", "").lower() in ["true", "1", "yes"]
+
+
+DATA_POINT_COLUMNS = [
+    "data_extraction_id",
+    "patient_id",
+    "data_point_name",
+    "data_point_value_num",
+    "data_point_value_string",
+    "data_point_type",
+    "roi_standard_name",
+]
+
+ROI_MAP_COLUMNS = [
+    "treatment_id",
+    "standard_name",
+    "structure_number",
+    "structure_name",
+    "priority_count",
+    "laterality",
+    "reason",
+    "structure_file_path",
+    "structure_file_mtime",
+    "synonyms_fingerprint",
+]
+
+CT_SERIES_COLUMNS = [
+    "treatment_id",
+    "series_instance_uid",
+    "number_of_slices",
+    "tag_values",
+    "inconsistent_tags",
+    "files_signature",
+]
+
+# Filters on up to this many values are bound as parameters, longer lists go in a temp table
+BOUND_FILTER_LIMIT = 100
+# Numbers for unique temp table names. Temp tables belong to the connection, which is shared by all
+# DatabaseCall objects on a thread
+TEMP_TABLE_NUMBERS = itertools.count()
+
+# One connection per thread and process, shared by all DatabaseCall objects. The schema is
+# upgraded to the latest version the first time the database is used
+CONNECTION_POOL = ConnectionPool(
+    DATABASE_PATH, initialise=upgrade_connection, concurrent_writes=CONCURRENT_WRITES
+)
 
 
 class DatabaseCall:
     def __init__(self):
         try:
-            self.connection = sqlite3.connect(DATABASE_PATH)
+            self.connection = CONNECTION_POOL.connection()
             self.cursor = self.connection.cursor()
 
         except sqlite3.Error as err:
@@ -29,23 +84,62 @@ class DatabaseCall:
 
     def __enter__(self):
         # This ensure, whenever an object is created using "with"
-        self.connection = sqlite3.connect(DATABASE_PATH)
         self.cursor = self.connection.cursor()
+        self.connection.users = self.connection.users + 1
         return self
 
     def __exit__(self, exception_type, exception_val, trace):
         # once the with block is over, the __exit__ method would be called
-        # with that, you close the connnection
+        # The pooled connection stays open. Changes that were not committed are discarded when
+        # the outermost with block on the connection ends, as when the connection was closed
         try:
             self.cursor.close()
-            self.connection.close()
+            self.connection.users = self.connection.users - 1
+            if (
+                self.connection.users == 0
+                and not self.connection.transaction_open
+                and self.connection.in_transaction
+            ):
+                self.connection.rollback()
         except AttributeError:  # isn't closable
             print("Not closable.")
             return True  # exception handled successfully
 
+    @property
+    def in_transaction(self):
+        """True while inside transaction() on this connection, also from nested DatabaseCall objects"""
+        return self.connection.transaction_open
+
     # General dataabse functionality
+    @contextmanager
+    def transaction(self):
+        """Commit everything in the with block at once, or nothing if an exception is raised.
+        Nested blocks are part of the outer transaction"""
+        if self.in_transaction:
+            yield self
+            return
+
+        # Take the write lock at the start, so another process writing cannot make the
+        # transaction fail half way when it goes from reading to writing
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.transaction_open = True
+        try:
+            yield self
+            self.connection.commit()
+        except BaseException:
+            self.connection.rollback()
+            raise
+        finally:
+            self.connection.transaction_open = False
+
+    def commit(self):
+        """Commit unless inside transaction()"""
+        if not self.in_transaction:
+            self.connection.commit()
+
     def insert_row_in_table(self, table_name, column_names, row_data):
-        """Insert rows into the database and set edit_date and edit_user"""
+        """Insert rows into the database and set edit_date and edit_user. Returns the rowid"""
         try:
             column_names_string = ",".join(column_names)
             row_data = row_data + [datetime.datetime.now(), USER_NAME]
@@ -55,20 +149,43 @@ class DatabaseCall:
                             ({column_names_string}, edit_date, edit_user)
                             VALUES ({values_place_holder})"""
             self.cursor.execute(sql_string, row_data)
-            self.connection.commit()
+            self.commit()
+
+        except (sqlite3.IntegrityError, sqlite3.InterfaceError) as e:
+            raise crtex.SqlInsertFail(e)
+
+        return self.cursor.lastrowid
+
+    def insert_rows_in_table(self, table_name, column_names, rows, replace=False):
+        """Insert many rows with one executemany and a single commit, setting edit_date and edit_user.
+        Either all rows are inserted or none. With replace, rows violating a UNIQUE constraint
+        replace the existing rows"""
+        edit_date = datetime.datetime.now()
+        rows = [list(row) + [edit_date, USER_NAME] for row in rows]
+        if len(rows) == 0:
+            return
+
+        column_names_string = ",".join(column_names)
+        values_place_holder = ",".join(["?"] * (len(column_names) + 2))
+        insert = "INSERT OR REPLACE" if replace else "INSERT"
+        sql_string = f"""{insert} INTO {table_name}
+                        ({column_names_string}, edit_date, edit_user)
+                        VALUES ({values_place_holder})"""
+        try:
+            self.cursor.executemany(sql_string, rows)
+            self.commit()
 
         except (sqlite3.IntegrityError, sqlite3.InterfaceError) as e:
+            if not self.in_transaction:
+                self.connection.rollback()
             raise crtex.SqlInsertFail(e)
 
     # Treatment collection
     def create_treatment_collection(self, collection_name):
         """Creates new treatment collectio. Returns collection_id"""
-        self.insert_row_in_table(
+        collection_id = self.insert_row_in_table(
             "treatment_collections", ["collection_name"], [collection_name]
         )
-
-        sql_string = "SELECT MAX(collection_id) FROM treatment_collections"
-        collection_id = self.cursor.execute(sql_string).fetchone()[0]
         return collection_id
 
     def get_treatments_from_collection(
@@ -83,23 +200,138 @@ class DatabaseCall:
         sql_string = "SELECT * FROM treatments WHERE collection_id = ?"
         variables = [collection_id]
 
-        if departments is not None:
-            string_departments = ", ".join(
-                f'"{department}"' for department in departments
+        with self.temp_filters() as temp_tables:
+            sql_filter, filter_variables = self.treatment_filters(
+                departments, exclude_patients, select_patients, temp_tables=temp_tables
             )
-            sql_string = f"{sql_string} AND treatment_place IN ({string_departments})"
 
-        if exclude_patients is not None:
-            string_ids = ", ".join(f'"{id}"' for id in exclude_patients)
-            sql_string = f"{sql_string} AND patient_id NOT IN ({string_ids})"
+            # Keep the insertion order, which the indexes would otherwise change
+            sql_string = f"{sql_string}{sql_filter} ORDER BY treatment_id"
+            treatments = self.cursor.execute(
+                sql_string, variables + filter_variables
+            ).fetchall()
+
+            return treatments
+
+    def temp_filter_table(self, values):
+        """Creates a TEMP table with a unique name and one column, value, holding the values. Used to filter
+        with a join on large lists of ids instead of building long IN (...) strings. Returns the table name"""
+        table_name = f"temp.filter_{next(TEMP_TABLE_NUMBERS)}"
+        # The inserts open a transaction. Commit it unless the caller already had one open, so a later
+        # transaction() still starts with BEGIN IMMEDIATE and no work of the caller is committed here
+        transaction_was_open = self.connection.in_transaction
+        self.cursor.execute(f"CREATE TABLE {table_name} (value PRIMARY KEY)")
+        self.cursor.executemany(
+            f"INSERT OR IGNORE INTO {table_name} VALUES (?)",
+            [[value] for value in values],
+        )
+        if not transaction_was_open:
+            self.connection.commit()
+        return table_name
+
+    def drop_temp_tables(self, temp_tables):
+        for table_name in temp_tables:
+            self.cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+        temp_tables.clear()
+
+    @contextmanager
+    def temp_filters(self):
+        """Yields a list for filter_condition to add the temp tables it makes to. The tables are dropped
+        when the block ends, also when a generator using them is closed"""
+        temp_tables = list()
+        try:
+            yield temp_tables
+        finally:
+            self.drop_temp_tables(temp_tables)
+
+    def filter_condition(self, column, values, temp_tables, exclude=False):
+        """Returns (sql_condition, variables) for column IN values. Short lists are bound as parameters,
+        long lists are loaded in a temp table, whose name is added to the temp_tables list from
+        temp_filters(). Use exclude for NOT IN"""
+        operator = "NOT IN" if exclude else "IN"
+        values = list(values)
+
+        if len(values) <= BOUND_FILTER_LIMIT:
+            place_holders = ", ".join(["?"] * len(values))
+            return (f"{column} {operator} ({place_holders})", values)
+
+        if temp_tables is None:
+            raise ValueError(
+                f"Filtering on more than {BOUND_FILTER_LIMIT} values needs temp_tables from temp_filters()"
+            )
+        table = self.temp_filter_table(values)
+        temp_tables.append(table)
+        return (f"{column} {operator} (SELECT value FROM {table})", [])
 
-        if select_patients is not None:
-            string_ids = ", ".join(f'"{id}"' for id in select_patients)
-            sql_string = f"{sql_string} AND patient_id IN ({string_ids})"
+    def treatment_filters(
+        self,
+        departments=None,
+        exclude_patients=None,
+        select_patients=None,
+        prefix="",
+        temp_tables=None,
+    ):
+        """Returns (sql_string, variables) with the AND conditions for the department and patient filters
+        of the treatments table. prefix is the table alias, e.g. "t.". temp_tables as in filter_condition"""
+        conditions = [
+            (f"{prefix}treatment_place", departments, False),
+            (f"{prefix}patient_id", exclude_patients, True),
+            (f"{prefix}patient_id", select_patients, False),
+        ]
+
+        sql_string = ""
+        variables = list()
+        for column, values, exclude in conditions:
+            if values is None:
+                continue
+            condition, condition_variables = self.filter_condition(
+                column, values, temp_tables, exclude=exclude
+            )
+            sql_string = f"{sql_string} AND {condition}"
+            variables.extend(condition_variables)
+
+        return (sql_string, variables)
+
+    def get_treatments_with_files_from_collection(
+        self,
+        collection_id,
+        departments=None,
+        exclude_patients=None,
+        select_patients=None,
+        treatment_limit=None,
+    ):
+        """Returns a list of (treatment_row, file_rows) for the treatments in a collection, fetched with one joined
+        query. Filters as in get_treatments_from_collection. Use treatment_limit for the first treatments only"""
+        with self.temp_filters() as temp_tables:
+            sql_filter, variables = self.treatment_filters(
+                departments, exclude_patients, select_patients, temp_tables=temp_tables
+            )
+            sql_where = f"collection_id = ?{sql_filter}"
+            variables = [collection_id] + variables
+
+            sql_limit = ""
+            if treatment_limit is not None:
+                sql_limit = "LIMIT ?"
+                variables.append(treatment_limit)
+
+            sql_string = f"""SELECT t.*, d.* FROM
+                                (SELECT * FROM treatments WHERE {sql_where} ORDER BY treatment_id {sql_limit}) AS t
+                            LEFT JOIN dicom_files AS d ON d.treatment_id = t.treatment_id
+                            ORDER BY t.treatment_id, d.dicom_file_id"""
+            rows = self.cursor.execute(sql_string, variables).fetchall()
+            number_of_treatment_columns = len(
+                self.cursor.execute("PRAGMA table_info(treatments)").fetchall()
+            )
 
-        treatments = self.cursor.execute(sql_string, variables).fetchall()
+            treatments = dict()
+            for row in rows:
+                treatment_row = row[:number_of_treatment_columns]
+                file_row = row[number_of_treatment_columns:]
+                file_rows = treatments.setdefault(treatment_row[0], (treatment_row, list()))[1]
+                if file_row[0] is not None:
+                    file_rows.append(file_row)
 
-        return treatments
+            return list(treatments.values())
 
     def get_patient_id_from_collection(
         self,
@@ -112,48 +344,61 @@ class DatabaseCall:
         sql_string = "SELECT patient_id FROM treatments WHERE collection_id = ?"
         variables = [collection_id]
 
-        if centres is not None:
-            string_centres = ", ".join(f'"{centre}"' for centre in centres)
-            sql_string = f"{sql_string} AND treatment_place in ({string_centres})"
-
-        if exclude_patients is not None:
-            string_ids = ", ".join(f'"{id}"' for id in exclude_patients)
-            sql_string = f"{sql_string} AND patient_id NOT IN ({string_ids})"
+        with self.temp_filters() as temp_tables:
+            sql_filter, filter_variables = self.treatment_filters(
+                centres, exclude_patients, temp_tables=temp_tables
+            )
 
-        patient_ids = self.cursor.execute(sql_string, variables).fetchall()
+            sql_string = f"{sql_string}{sql_filter} ORDER BY treatment_id"
+            patient_ids = self.cursor.execute(
+                sql_string, variables + filter_variables
+            ).fetchall()
 
-        patient_id_lst = []
-        for id in patient_ids:
-            patient_id_lst.append(id[0])
+            patient_id_lst = []
+            for id in patient_ids:
+                patient_id_lst.append(id[0])
 
-        return patient_id_lst
+            return patient_id_lst
 
     # Treatments
     def delete_treatment_from_collection(self, patient_ids, collection_id):
         """Delete treatments and associated files from a treatment collection"""
 
-        string_ids = ", ".join(f'"{id}"' for id in patient_ids)
-        sql_string = f"SELECT treatment_id FROM treatments WHERE collection_id = {collection_id} AND patient_id IN ({string_ids})"
-
-        treatment_ids = self.cursor.execute(sql_string).fetchall()
-
-        list_treat_ids = list()
-        for treatment_id in treatment_ids:
-            list_treat_ids.append(treatment_id[0])
-
-        string_treat_ids = ", ".join(f'"{id}"' for id in list_treat_ids)
-
-        sql_delete_files = (
-            f"DELETE FROM dicom_files WHERE treatment_id IN ({string_treat_ids})"
-        )
-        self.cursor.execute(sql_delete_files)
-        print(sql_delete_files)
-
-        sql_delete_treat = f"DELETE FROM treatments WHERE treatment_id IN ({string_treat_ids}) and collection_id = {collection_id}"
-        print(sql_delete_treat)
-        self.cursor.execute(sql_delete_treat)
-
-        self.connection.commit()
+        with self.temp_filters() as temp_tables:
+            condition, variables = self.filter_condition(
+                "patient_id", patient_ids, temp_tables
+            )
+            sql_treatment_ids = (
+                f"SELECT treatment_id FROM treatments WHERE collection_id = ? AND {condition}"
+            )
+            variables = [collection_id] + variables
+
+            with self.transaction():
+                sql_delete_files = (
+                    f"DELETE FROM dicom_files WHERE treatment_id IN ({sql_treatment_ids})"
+                )
+                number_of_files = self.cursor.execute(sql_delete_files, variables).rowcount
+
+                sql_delete_roi_map = (
+                    f"DELETE FROM roi_map WHERE treatment_id IN ({sql_treatment_ids})"
+                )
+                self.cursor.execute(sql_delete_roi_map, variables)
+
+                sql_delete_ct_series = (
+                    f"DELETE FROM ct_series WHERE treatment_id IN ({sql_treatment_ids})"
+                )
+                self.cursor.execute(sql_delete_ct_series, variables)
+
+                sql_delete_treat = (
+                    f"DELETE FROM treatments WHERE collection_id = ? AND {condition}"
+                )
+                number_of_treatments = self.cursor.execute(
+                    sql_delete_treat, variables
+                ).rowcount
+
+            print(
+                f"Deleted {number_of_treatments} treatments and {number_of_files} files from collection {collection_id}"
+            )
 
     def add_new_treatment_to_collection_from_plan_names(
         self,
@@ -171,54 +416,55 @@ class DatabaseCall:
         Use the study_uid if the patient obejct contains multiple studies. Returns sucess: True/False, error_log
         """
 
-        self.insert_row_in_table(
-            "treatments",
-            [
-                "collection_id",
-                "patient_id",
-                "treatment_place",
-                "main_dose_scale_factor",
-                "boost_dose_scale_factor",
-                "main_reference_dose",
-                "boost_reference_dose",
-            ],
-            [
-                collection_id,
-                patient.id,
-                treatment_place,
-                main_dose_scale_factor,
-                boost_dose_scale_factor,
-                main_reference_dose,
-                boost_reference_dose,
-            ],
-        )
-
-        sql_string = "SELECT MAX(treatment_id) FROM treatments"
-        treatment_id = self.cursor.execute(sql_string).fetchone()[0]
+        # The treatment and all its files are committed together
+        with self.transaction():
+            treatment_id = self.insert_row_in_table(
+                "treatments",
+                [
+                    "collection_id",
+                    "patient_id",
+                    "treatment_place",
+                    "main_dose_scale_factor",
+                    "boost_dose_scale_factor",
+                    "main_reference_dose",
+                    "boost_reference_dose",
+                ],
+                [
+                    collection_id,
+                    patient.id,
+                    treatment_place,
+                    main_dose_scale_factor,
+                    boost_dose_scale_factor,
+                    main_reference_dose,
+                    boost_reference_dose,
+                ],
+            )
 
-        status, error_log = self.add_files_to_treatment_from_plan_names(
-            patient, treatment_id, plan_names, study_uid
-        )
+            status, error_log = self.add_files_to_treatment_from_plan_names(
+                patient, treatment_id, plan_names, study_uid
+            )
         return (status, error_log)
 
     # Files
     def get_file_paths_from_treatment(self, treatment_id):
         """Returns DICOM file information for a treatment"""
-        sql_string = "SELECT * FROM dicom_files WHERE treatment_id = ?"
+        sql_string = "SELECT * FROM dicom_files WHERE treatment_id = ? ORDER BY dicom_file_id"
         file_rows = self.cursor.execute(sql_string, [treatment_id]).fetchall()
 
         return file_rows
 
     def add_files_to_treatment(self, treatment_id, files, file_type):
+        rows = list()
         for uid, file in files.items():
             global_path = file["path"][len(DICOM_FOLDER_PATH) :]
             global_path = global_path.replace("\\", "/")
+            rows.append([treatment_id, global_path, file_type, uid])
 
-            self.insert_row_in_table(
-                "dicom_files",
-                ["treatment_id", "file_path", "file_type", "file_uid"],
-                [treatment_id, global_path, file_type, uid],
-            )
+        self.insert_rows_in_table(
+            "dicom_files",
+            ["treatment_id", "file_path", "file_type", "file_uid"],
+            rows,
+        )
 
     def add_files_to_treatment_from_plan_names(
         self, patient, treatment_id, plan_names, study_uid=None
@@ -226,6 +472,8 @@ class DatabaseCall:
         """Add all data from the patient related to the plan names specified to the treatment. Returns sucess: True/False, error_log"""
         error_log = list()
         plan_infos = dict()
+        # Plan -> structure -> CT and dose -> plan links from the screening
+        graph = patient.uid_graph
 
         if study_uid is None:
             for uid, study in patient.studies.items():
@@ -239,15 +487,7 @@ class DatabaseCall:
             plans = main_study.plans
 
         for uid, plan in plans.items():
-            plan_structure_uids = set()
-            for structure_reference in plan["data_set"].ReferencedStructureSetSequence:
-                if (
-                    structure_reference.ReferencedSOPClassUID.name
-                    == "RT Structure Set Storage"
-                ):
-                    plan_structure_uids.add(
-                        structure_reference.ReferencedSOPInstanceUID
-                    )
+            plan_structure_uids = set(graph.plan_structures.get(uid, tuple()))
 
             plan_infos[plan["data_set"].RTPlanLabel] = {
                 "uid": uid,
@@ -256,7 +496,6 @@ class DatabaseCall:
             }
 
         structure_uids = set()
-        plan_uids = set()
 
         plans_out = dict()
         structures_out = dict()
@@ -267,7 +506,6 @@ class DatabaseCall:
             structure_uids = structure_uids.union(
                 plan_infos[plan_name]["structure_uid"]
             )
-            plan_uids.add(plan_infos[plan_name]["uid"])
             plans_out[plan_infos[plan_name]["uid"]] = main_study.plans[
                 plan_infos[plan_name]["uid"]
             ]
@@ -285,90 +523,74 @@ class DatabaseCall:
 
         elif len(structure_uids) == 1:
             structure_uid = structure_uids.pop()
-            try:
-                structure_out = main_study.structures[structure_uid]
-            except KeyError:  # if structure not in main_study look in other studies
-                for study_uid_key, study in patient.studies.items():
-                    for struct_uid_key, structure_data in study.structures.items():
-                        if struct_uid_key == structure_uid:
-                            structure_out = structure_data
+            structure_out = main_study.structures.get(structure_uid)
+            # if structure not in main_study look in other studies
+            if structure_out is None and structure_uid in graph.structure_cts:
+                structure_out = graph.files[structure_uid]
+            if structure_out is None:
+                error_log.append(
+                    f"Missing structure file for {patient.id} , structure uid: {structure_uid}"
+                )
+                return (False, error_log)
 
             structures_out[structure_uid] = structure_out
 
             # check if at least one ct file
-            images = (
-                structure_out["data_set"]
-                .ReferencedFrameOfReferenceSequence[0]
-                .RTReferencedStudySequence[0]
-                .RTReferencedSeriesSequence[0]
-                .ContourImageSequence
-            )
-            if len(images) == 0:
+            ct_uids = graph.cts_for_structure(structure_uid)
+            if len(ct_uids) == 0:
                 error_log.append(f"No CT files for {patient.id} , plan {plan_names}")
                 return (False, error_log)
 
-            for image in images:
-                if image.ReferencedSOPClassUID.name == "CT Image Storage":
-                    try:
-                        cts_out[image.ReferencedSOPInstanceUID] = main_study.cts[
-                            image.ReferencedSOPInstanceUID
-                        ]
-                    except KeyError:
-                        error_log.append(
-                            f"Missing CT file for {patient.id} , CT uid: {image.ReferencedSOPInstanceUID}"
-                        )
+            for ct_uid in ct_uids:
+                try:
+                    cts_out[ct_uid] = main_study.cts[ct_uid]
+                except KeyError:
+                    error_log.append(
+                        f"Missing CT file for {patient.id} , CT uid: {ct_uid}"
+                    )
 
-            for uid, dose in main_study.doses.items():
-                for reference in dose["data_set"].ReferencedRTPlanSequence:
-                    if (
-                        reference.ReferencedSOPClassUID.name == "RT Plan Storage"
-                        and reference.ReferencedSOPInstanceUID in plan_uids
-                    ):
-                        doses_out[uid] = dose
+            for uid in graph.doses_for_plans(plans_out):
+                if uid in main_study.doses:
+                    doses_out[uid] = main_study.doses[uid]
 
             # Check if at least one dose file
             if len(doses_out) == 0:
                 error_log.append(f"No dose_files for {patient.id} , plan {plan_names}")
                 return (False, error_log)
 
-        self.add_files_to_treatment(treatment_id, plans_out, "plan")
-        self.add_files_to_treatment(treatment_id, structures_out, "structure")
-        self.add_files_to_treatment(treatment_id, doses_out, "dose")
-        self.add_files_to_treatment(treatment_id, cts_out, "ct")
+        with self.transaction():
+            self.add_files_to_treatment(treatment_id, plans_out, "plan")
+            self.add_files_to_treatment(treatment_id, structures_out, "structure")
+            self.add_files_to_treatment(treatment_id, doses_out, "dose")
+            self.add_files_to_treatment(treatment_id, cts_out, "ct")
 
         return (True, error_log)
 
     def delete_sum_dose_files(self, patient_ids, collection_id):
         """Delete sum dose files and references in db"""
 
-        string_ids = ", ".join(f'"{id}"' for id in patient_ids)
-        sql_string = f"SELECT treatment_id FROM treatments WHERE collection_id = {collection_id} AND patient_id IN ({string_ids})"
-        treatment_ids = self.cursor.execute(sql_string).fetchall()
-
-        list_treat_ids = list()
-        for treatment_id in treatment_ids:
-            list_treat_ids.append(treatment_id[0])
-
-        string_treat_ids = ", ".join(f'"{id}"' for id in list_treat_ids)
-
-        sql_delete_files = f'DELETE FROM dicom_files WHERE file_type = "sum_dose" AND treatment_id IN ({string_treat_ids})'
-        self.cursor.execute(sql_delete_files)
-        print(sql_delete_files)
+        with self.temp_filters() as temp_tables:
+            condition, variables = self.filter_condition(
+                "patient_id", patient_ids, temp_tables
+            )
+            sql_delete_files = f"""DELETE FROM dicom_files WHERE file_type = "sum_dose" AND treatment_id IN
+                                   (SELECT treatment_id FROM treatments WHERE collection_id = ? AND {condition})"""
+            number_of_files = self.cursor.execute(
+                sql_delete_files, [collection_id] + variables
+            ).rowcount
+            print(f"Deleted {number_of_files} sum dose files from collection {collection_id}")
 
-        self.connection.commit()
+            self.commit()
 
     # Synonyms
     def create_synonym_collection(self, synonym_collection_name):
         """Creates new synonym collection. Returns synonym_collection_id"""
 
-        self.insert_row_in_table(
+        collection_id = self.insert_row_in_table(
             "synonym_collections",
             ["synonym_collection_name"],
             [synonym_collection_name],
         )
-        sql_string = "SELECT MAX(synonym_collection_id) FROM synonym_collections"
-
-        collection_id = self.cursor.execute(sql_string).fetchone()[0]
         return collection_id
 
     def associate_synonym_collection_with_treatment_colection(
@@ -380,6 +602,7 @@ class DatabaseCall:
             ["synonym_collection_id", "treatment_collection_id"],
             [synonym_collection_id, treatment_collection_id],
         )
+        invalidate_synonym_indexes()
 
     def add_synoym_to_synonym_colection(
         self,
@@ -401,6 +624,7 @@ class DatabaseCall:
             ],
             [synonym_collection_id, synonym, standard_name, laterality, priority_count],
         )
+        invalidate_synonym_indexes()
 
     def get_synonym_collection_ids_for_treatment_colection(
         self, treatment_collection_id
@@ -414,40 +638,23 @@ class DatabaseCall:
 
         return synonym_collection_ids
 
+    def get_synonym_index(self, treatment_collection_id):
+        """Returns the SynonymIndex of all synonyms linked to the treatment collection. It is loaded
+        once per process and reloaded after the synonyms are changed"""
+        return get_synonym_index(self.cursor, treatment_collection_id)
+
     def get_synonyms_from_standard_name(
         self, standard_name, treatment_collection_id, priority=None
     ):
+        synonym_index = self.get_synonym_index(treatment_collection_id)
+        entries = synonym_index.synonyms_for_standard_name(standard_name)
 
-        synonym_collection_ids = (
-            self.get_synonym_collection_ids_for_treatment_colection(
-                treatment_collection_id
-            )
-        )
-        rows = list()
-
-        for synonym_collection_id in synonym_collection_ids:
-            if priority is None:
-                sql_string = "SELECT synonym FROM synonyms WHERE standard_name = ? AND synonym_collection_id = ?"
-                synonyms = self.cursor.execute(
-                    sql_string, [standard_name, synonym_collection_id]
-                ).fetchall()
-
-                for synonym in synonyms:
-                    rows.append(synonym[0])
-
-            elif priority is True:
-                sql_string = "SELECT synonym, priority_count, laterality FROM synonyms WHERE standard_name = ? AND synonym_collection_id = ?"
-                synonyms = self.cursor.execute(
-                    sql_string, [standard_name, synonym_collection_id]
-                ).fetchall()
-
-                for synonym in synonyms:
-                    rows.append(synonym)
-
-        return list(set(rows))
+        if priority is True:
+            return [tuple(entry) for entry in entries]
+        return [entry.synonym for entry in entries]
 
     def get_all_synonym_data_from_synonym_collection(self, synonym_collection_id):
-        sql_string = "SELECT * FROM synonyms WHERE synonym_collection_id = ?"
+        sql_string = "SELECT * FROM synonyms WHERE synonym_collection_id = ? ORDER BY rowid"
         synonyms = self.cursor.execute(sql_string, [synonym_collection_id]).fetchall()
         return synonyms
 
@@ -461,61 +668,48 @@ class DatabaseCall:
         all_synonyms = self.cursor.execute(
             sql_string, [synonym_collection_id]
         ).fetchall()
-        synonyms = [f[0] for f in all_synonyms]
+        synonyms = set(f[0] for f in all_synonyms)
 
-        n = 0
-        for roi in rois_counted:
-            roi_name = roi_names[n]
+        rows = list()
+        for count, roi_name in zip(rois_counted, roi_names):
             if roi_name in synonyms:
-                count = roi
-                sql_string = "SELECT priority_count FROM synonyms WHERE synonym = ? AND synonym_collection_id = ?"
-                priority = self.cursor.execute(
-                    sql_string, [roi_name, synonym_collection_id]
-                ).fetchone()[0]
-
-                if priority == None:
-                    sql_string = "UPDATE synonyms SET priority_count = ? WHERE synonym = ? AND synonym_collection_id = ?"
-                    self.connection.execute(
-                        sql_string, [count, roi_name, synonym_collection_id]
-                    )
-                    self.connection.commit()
+                rows.append([count, roi_name, synonym_collection_id])
 
-                else:
-                    sql_string = "UPDATE synonyms SET priority_count = priority_count + ? WHERE synonym = ? AND synonym_collection_id "
-                    self.connection.execute(
-                        sql_string, [count, roi_name, synonym_collection_id]
-                    )
-                    self.connection.commit()
-
-            n = n + 1
+        # A missing priority_count is set to the count, otherwise the count is added
+        sql_string = "UPDATE synonyms SET priority_count = IFNULL(priority_count, 0) + ? WHERE synonym = ? AND synonym_collection_id = ?"
+        with self.transaction():
+            self.cursor.executemany(sql_string, rows)
+        invalidate_synonym_indexes()
         print(
             f"Updated prioritisation in synonyms fo synonym_collection {synonym_collection_id}"
         )
 
     # Structure collection
     def create_structure_collection(self, collection_name):
-        self.insert_row_in_table(
+        collection_id = self.insert_row_in_table(
             "structure_collections", ["structure_collection_name"], [collection_name]
         )
-        sql_string = "SELECT MAX(structure_collection_id) FROM structure_collections"
-        collection_id = self.cursor.execute(sql_string).fetchone()[0]
         return collection_id
 
     def new_structure_collection_from_folder(self, collection_name, folder_path):
-        """Create a new structure collection by adding all structure files in a folder orgnaised with > center names > patient_ids"""
-        collection_id = self.create_structure_collection(collection_name)
-
-        file_paths = list()
-        center_folders = glob.glob(f"{folder_path}/*")
-        print(f"{folder_path}/*")
-        print(center_folders)
-        for center_folder in center_folders:
-            patient_folders = glob.glob(f"{center_folder}/*")
-            for patient_folder in patient_folders:
-                file_paths = glob.glob(f"{patient_folder}/*.dcm")
-                for file_path in file_paths:
-                    dataset = dicomparser.DicomParser(file_path)
-                    if dataset.ds.Modality == "RTSTRUCT":
+        """Create a new structure collection by adding all structure files in a folder orgnaised with > center names > patient_ids.
+        Returns the collection_id"""
+        # The collection and all its files are committed together
+        with self.transaction():
+            collection_id = self.create_structure_collection(collection_name)
+            structure_rows = list()
+
+            # One walk over the folders, listing the DICOM files on the way. Only the patient
+            # folders, two levels below folder_path, are read
+            for patient_folder, files in walk_dicom_folders(folder_path):
+                relative_folder = os.path.relpath(patient_folder, folder_path)
+                if len(os.path.normpath(relative_folder).split(os.sep)) != 2:
+                    continue
+                for file_path, _, _ in files:
+                    dataset = pydicom.dcmread(
+                        file_path, stop_before_pixels=True, specific_tags=["Modality"]
+                    )
+                    if dataset.get("Modality") == "RTSTRUCT":
                         file_path = file_path.replace("\\\\", "/")
                         file_path = file_path.replace("\\", "/")
                         file_path = file_path[len(DICOM_FOLDER_PATH) :]
@@ -523,23 +717,21 @@ class DatabaseCall:
                     else:
                         continue
 
-                    # insert dicom filed in DB
-                    self.insert_row_in_table(
+                    # insert dicom filed in DB and keep the id for the structure row
+                    dicom_file_id = self.insert_row_in_table(
                         "dicom_files",
                         ["file_type", "file_path"],
                         ["augmented_struct", file_path],
                     )
+                    structure_rows.append([collection_id, patient_id, dicom_file_id])
 
-                    # find ID of the file we just inserted
-                    sql_string = "SELECT MAX(dicom_file_id) FROM dicom_files WHERE file_type = 'augmented_struct'"
-                    dicom_file_id = self.cursor.execute(sql_string).fetchone()[0]
-
-                    # insert new structure in DB
-                    self.insert_row_in_table(
-                        "structures",
-                        ["structure_collection_id", "patient_id", "dicom_file_id"],
-                        [collection_id, patient_id, dicom_file_id],
-                    )
+            # insert new structures in DB
+            self.insert_rows_in_table(
+                "structures",
+                ["structure_collection_id", "patient_id", "dicom_file_id"],
+                structure_rows,
+            )
+        return collection_id
 
     def get_structures_from_collection(
         self,
@@ -553,23 +745,27 @@ class DatabaseCall:
         sql_string = "SELECT * FROM structures WHERE structure_collection_id = ?"
         variables = [structure_collection_id]
 
-        if departments is not None:
-            string_departments = ", ".join(
-                f'"{department}"' for department in departments
+        with self.temp_filters() as temp_tables:
+            # structures has no treatment_place, the department is that of the patient's treatments
+            if departments is not None:
+                condition, filter_variables = self.filter_condition(
+                    "treatment_place", departments, temp_tables
+                )
+                sql_string = f"{sql_string} AND patient_id IN (SELECT patient_id FROM treatments WHERE {condition})"
+                variables.extend(filter_variables)
+
+            sql_filter, filter_variables = self.treatment_filters(
+                exclude_patients=exclude_patients,
+                select_patients=select_patients,
+                temp_tables=temp_tables,
             )
-            sql_string = f"{sql_string} AND treatment_place IN ({string_departments})"
-
-        if exclude_patients is not None:
-            string_ids = ", ".join(f'"{id}"' for id in exclude_patients)
-            sql_string = f"{sql_string} AND patient_id NOT IN ({string_ids})"
+            sql_string = f"{sql_string}{sql_filter}"
+            variables.extend(filter_variables)
 
-        if select_patients is not None:
-            string_ids = ", ".join(f'"{id}"' for id in select_patients)
-            sql_string = f"{sql_string} AND patient_id IN ({string_ids})"
+            sql_string = f"{sql_string} ORDER BY structure_id"
+            structures = self.cursor.execute(sql_string, variables).fetchall()
 
-        structures = self.cursor.execute(sql_string, variables).fetchall()
-
-        return structures
+            return structures
 
     def get_augmented_structure_paths_for_patient(
         self, patient_id, structure_collection_id=None
@@ -577,44 +773,105 @@ class DatabaseCall:
         """If structure_collection_id == None, all augmented structures for patient will be returned"""
 
         structure_path_collection_name = list()
-        sql_string = "SELECT dicom_file_id, structure_collection_id FROM structures WHERE patient_id =?"
+        sql_string = """SELECT d.file_path, s.structure_collection_id FROM structures AS s
+                        JOIN dicom_files AS d ON d.dicom_file_id = s.dicom_file_id
+                        WHERE s.patient_id = ?"""
         variables = [patient_id]
 
-        if structure_collection_id == None:
-            pass
-        else:
-            sql_string = sql_string + "AND structure_collection_id == ?"
+        if structure_collection_id is not None:
+            sql_string = f"{sql_string} AND s.structure_collection_id = ?"
             variables.append(structure_collection_id)
 
-        dicom_file_rows = self.cursor.execute(sql_string, variables).fetchall()
-
-        for dicom_file_row in dicom_file_rows:
-            dicom_file_id = dicom_file_row[0]
-            sql_string = f"SELECT file_path FROM dicom_files WHERE dicom_file_id = {dicom_file_id}"
-            dicom_file_path = self.cursor.execute(sql_string).fetchone()
-
+        sql_string = f"{sql_string} ORDER BY s.structure_id"
+        for file_path, collection_id in self.cursor.execute(sql_string, variables):
             structure_path_collection_name = structure_path_collection_name + [
-                dicom_file_path[0],
-                dicom_file_row[1],
+                file_path,
+                collection_id,
             ]
 
         return structure_path_collection_name
 
+    # ROI map
+    def save_roi_map_rows(self, rows):
+        """Insert or replace rows in roi_map, one per treatment and standard name. Each row is a
+        list of values for ROI_MAP_COLUMNS"""
+        self.insert_rows_in_table("roi_map", ROI_MAP_COLUMNS, rows, replace=True)
+
+    def get_roi_map_row(self, treatment_id, standard_name):
+        """Returns the roi_map row of the treatment and standard name as a dict, None if not mapped"""
+        column_names_string = ", ".join(ROI_MAP_COLUMNS)
+        sql_string = f"SELECT {column_names_string} FROM roi_map WHERE treatment_id = ? AND standard_name = ?"
+        row = self.cursor.execute(sql_string, [treatment_id, standard_name]).fetchone()
+        if row is None:
+            return None
+        return dict(zip(ROI_MAP_COLUMNS, row))
+
+    def get_roi_map_from_collection(self, treatment_collection_id, standard_names=None):
+        """Returns {(treatment_id, standard_name): row dict} for the treatments in the collection"""
+        column_names_string = ", ".join(f"rm.{column}" for column in ROI_MAP_COLUMNS)
+        sql_string = f"""SELECT {column_names_string} FROM roi_map AS rm
+                         JOIN treatments AS t ON t.treatment_id = rm.treatment_id
+                         WHERE t.collection_id = ?"""
+        variables = [treatment_collection_id]
+
+        with self.temp_filters() as temp_tables:
+            if standard_names is not None:
+                condition, filter_variables = self.filter_condition(
+                    "rm.standard_name", standard_names, temp_tables
+                )
+                sql_string = f"{sql_string} AND {condition}"
+                variables.extend(filter_variables)
+
+            roi_map = dict()
+            for row in self.cursor.execute(sql_string, variables).fetchall():
+                row = dict(zip(ROI_MAP_COLUMNS, row))
+                roi_map[(row["treatment_id"], row["standard_name"])] = row
+            return roi_map
+
+    def delete_roi_map_from_collection(self, treatment_collection_id, standard_names=None):
+        """Delete the roi_map rows of the treatments in the collection, e.g. to rebuild it from scratch"""
+        sql_string = """DELETE FROM roi_map WHERE treatment_id IN
+                        (SELECT treatment_id FROM treatments WHERE collection_id = ?)"""
+        variables = [treatment_collection_id]
+
+        with self.temp_filters() as temp_tables:
+            if standard_names is not None:
+                condition, filter_variables = self.filter_condition(
+                    "standard_name", standard_names, temp_tables
+                )
+                sql_string = f"{sql_string} AND {condition}"
+                variables.extend(filter_variables)
+
+            self.cursor.execute(sql_string, variables)
+            self.commit()
+
+    # CT series
+    def save_ct_series_row(self, row):
+        """Insert or replace the ct_series row of a treatment, a list of values for CT_SERIES_COLUMNS"""
+        self.insert_rows_in_table("ct_series", CT_SERIES_COLUMNS, [row], replace=True)
+
+    def get_ct_series_row(self, treatment_id):
+        """Returns the ct_series row of the treatment as a dict, None if not saved"""
+        column_names_string = ", ".join(CT_SERIES_COLUMNS)
+        sql_string = f"SELECT {column_names_string} FROM ct_series WHERE treatment_id = ?"
+        row = self.cursor.execute(sql_string, [treatment_id]).fetchone()
+        if row is None:
+            return None
+        return dict(zip(CT_SERIES_COLUMNS, row))
+
     # Data extraction
     def create_dataset(self, dataset_name, treatment_collection_id):
-        self.insert_row_in_table(
+        dataset_id = self.insert_row_in_table(
             "datasets",
             ["dataset_name", "treatment_collection_id"],
             [dataset_name, treatment_collection_id],
         )
-        sql_string = "SELECT MAX(dataset_id) FROM datasets"
-        dataset_id = self.cursor.execute(sql_string).fetchone()[0]
         return dataset_id
 
     def new_data_extraction(self, dataset_id):
-        self.insert_row_in_table("data_extractions", ["dataset_id"], [dataset_id])
-        sql_string = "SELECT MAX(data_extraction_id) FROM data_extractions"
-        data_extraction_id = self.cursor.execute(sql_string).fetchone()[0]
+        data_extraction_id = self.insert_row_in_table(
+            "data_extractions", ["dataset_id"], [dataset_id]
+        )
         return data_extraction_id
 
     def insert_data_point(
@@ -627,100 +884,214 @@ class DatabaseCall:
         data_point_type,
         roi_standard_name,
     ):
-        self.insert_row_in_table(
-            "data_points",
-            [
-                "data_extraction_id",
-                "patient_id",
-                "data_point_name",
-                "data_point_value_num",
-                "data_point_value_string",
-                "data_point_type",
-                "roi_standard_name",
-            ],
+        self.insert_data_points(
+            data_extraction_id,
             [
-                data_extraction_id,
-                patient_id,
-                data_point_name,
-                data_point_value_num,
-                data_point_value_string,
-                data_point_type,
-                roi_standard_name,
+                [
+                    patient_id,
+                    data_point_name,
+                    data_point_value_num,
+                    data_point_value_string,
+                    data_point_type,
+                    roi_standard_name,
+                ]
             ],
         )
 
+    def insert_data_points(self, data_extraction_id, rows):
+        """Insert many data points in one transaction. Each row is [patient_id, data_point_name,
+        data_point_value_num, data_point_value_string, data_point_type, roi_standard_name]"""
+        self.insert_rows_in_table(
+            "data_points",
+            DATA_POINT_COLUMNS,
+            [[data_extraction_id] + list(row) for row in rows],
+        )
+
         # delete datapoints that are the same but from erlier extractions (mabye keep the latest 2)
 
     def get_dataset_treatment_collection_id(self, dataset_id):
-        sql_string = f"SELECT treatment_collection_id FROM datasets WHERE dataset_id={dataset_id}"
-        return self.cursor.execute(sql_string).fetchone()
+        sql_string = "SELECT treatment_collection_id FROM datasets WHERE dataset_id = ?"
+        return self.cursor.execute(sql_string, [dataset_id]).fetchone()
 
-    def get_dataset_as_dataframe(
-        self, dataset_id, select_data_points=False, select_patient_ids=False
+    def latest_data_points_sql(
+        self, dataset_id, select_data_points=False, select_patient_ids=False, temp_tables=None
     ):
-        """Returns a pandas data frame containing all data_points that have been extracted. Specific
-        data point or patient_ids can be provided as lists to limit the output"""
-
-        data_points = list()
-        sql_string_add = ""
-
-        if select_data_points != False:
-            string_data_points = ", ".join(
-                f'"{select_data_point}"' for select_data_point in select_data_points
-            )
-            sql_string_add = (
-                f"{sql_string_add} AND data_point_name IN ({string_data_points})"
+        """Returns (sql_string, variables) selecting patient_id, data_point_name and the values of the latest
+        data point for each patient and data point name in the dataset. Newer extractions win. temp_tables
+        as in filter_condition"""
+        sql_where = "de.dataset_id = ?"
+        variables = [dataset_id]
+
+        if select_data_points:
+            condition, filter_variables = self.filter_condition(
+                "dp.data_point_name", select_data_points, temp_tables
             )
+            sql_where = f"{sql_where} AND {condition}"
+            variables.extend(filter_variables)
 
-        if select_patient_ids != False:
-            string_patient_ids = ", ".join(
-                f'"{select_patient_id}"' for select_patient_id in select_patient_ids
+        if select_patient_ids:
+            condition, filter_variables = self.filter_condition(
+                "dp.patient_id", select_patient_ids, temp_tables
             )
-            sql_string = f"{sql_string_add} AND patient_id IN ({string_patient_ids})"
-
-        sql_string = f"SELECT data_extraction_id FROM data_extractions WHERE dataset_id={dataset_id}"
-        data_extraction_ids = self.cursor.execute(sql_string).fetchall()
-
-        for data_extraction_id in data_extraction_ids:
-            sql_string = f"SELECT * FROM data_points WHERE data_extraction_id={data_extraction_id[0]} {sql_string_add}"
-
-            data_points_extraction = self.cursor.execute(sql_string).fetchall()
-            data_points = data_points + data_points_extraction
-
+            sql_where = f"{sql_where} AND {condition}"
+            variables.extend(filter_variables)
+
+        sql_string = f"""SELECT patient_id, data_point_name, data_point_value_num, data_point_value_string
+                        FROM (
+                            SELECT dp.patient_id, dp.data_point_name, dp.data_point_value_num,
+                                dp.data_point_value_string,
+                                ROW_NUMBER() OVER (
+                                    PARTITION BY dp.patient_id, dp.data_point_name
+                                    ORDER BY dp.data_extraction_id DESC, dp.data_point_id DESC
+                                ) AS latest
+                            FROM data_points AS dp
+                            JOIN data_extractions AS de ON de.data_extraction_id = dp.data_extraction_id
+                            WHERE {sql_where}
+                        )
+                        WHERE latest = 1"""
+        return (sql_string, variables)
+
+    @staticmethod
+    def pivot_data_points(rows, columns=None):
+        """Wide dataframe with a row per patient from (patient_id, data_point_name, value_num, value_string)
+        rows. A data point gets a column for the numbers and/or the strings it has. columns is the list of
+        (value column, data_point_name) to return, by default those with at least one value"""
         df = pd.DataFrame(
-            data_points,
+            rows,
             columns=[
-                "data_point_id",
-                "data_extraction_id",
                 "patient_id",
                 "data_point_name",
                 "data_point_value_num",
                 "data_point_value_string",
-                "data_point_type",
-                "roi_standard_name",
-                "edit_date",
-                "edit_user",
             ],
         )
-
-        df = df.sort_values(["patient_id", "data_extraction_id"], ascending=False)
-        df = df.drop_duplicates(["patient_id", "data_point_name"])
-
-        df_small = df[
-            [
-                "patient_id",
-                "data_point_name",
-                "data_point_value_num",
-                "data_point_value_string",
-            ]
-        ]
-        df_pivot = pd.pivot_table(
-            df_small,
+        df_pivot = df.pivot(
+            index="patient_id",
+            columns="data_point_name",
             values=["data_point_value_num", "data_point_value_string"],
-            index=["patient_id"],
-            columns=["data_point_name"],
-            aggfunc=np.max,
-        )  # Use max as there is only one row and it handles both numbers and strings
+        )
+        if columns is None:
+            df_pivot = df_pivot.dropna(axis=1, how="all")
+        else:
+            df_pivot = df_pivot.reindex(columns=pd.MultiIndex.from_tuples(columns))
+        df_pivot = df_pivot.dropna(axis=0, how="all")
 
         df_pivot = df_pivot.droplevel(0, axis=1)
         return df_pivot
+
+    def get_dataset_as_dataframe(
+        self, dataset_id, select_data_points=False, select_patient_ids=False
+    ):
+        """Returns a pandas data frame containing all data_points that have been extracted. Specific
+        data point or patient_ids can be provided as lists to limit the output"""
+        with self.temp_filters() as temp_tables:
+            sql_string, variables = self.latest_data_points_sql(
+                dataset_id, select_data_points, select_patient_ids, temp_tables
+            )
+            rows = self.cursor.execute(sql_string, variables).fetchall()
+            return self.pivot_data_points(rows)
+
+    def get_dataset_columns(
+        self, dataset_id, select_data_points=False, select_patient_ids=False
+    ):
+        """Returns the columns of the wide dataset as (value_column, data_point_name), numbers before
+        strings as in the pivot. value_column is data_point_value_num or data_point_value_string"""
+        with self.temp_filters() as temp_tables:
+            sql_string, variables = self.latest_data_points_sql(
+                dataset_id, select_data_points, select_patient_ids, temp_tables
+            )
+            columns_sql = f"""SELECT data_point_name, COUNT(data_point_value_num), COUNT(data_point_value_string)
+                            FROM ({sql_string}) GROUP BY data_point_name ORDER BY data_point_name"""
+            name_counts = self.cursor.execute(columns_sql, variables).fetchall()
+            return [
+                ("data_point_value_num", name) for name, count, _ in name_counts if count > 0
+            ] + [
+                ("data_point_value_string", name)
+                for name, _, count in name_counts
+                if count > 0
+            ]
+
+    def get_dataset_patient_centres(self, dataset_id):
+        """Returns {patient_id: treatment_place} for the treatment collection of the dataset"""
+        sql_string = """SELECT patient_id, MIN(treatment_place) FROM treatments
+                        WHERE collection_id = (SELECT treatment_collection_id FROM datasets WHERE dataset_id = ?)
+                        GROUP BY patient_id"""
+        return dict(self.cursor.execute(sql_string, [dataset_id]).fetchall())
+
+    def iter_dataset_rows(
+        self,
+        dataset_id,
+        select_data_points=False,
+        select_patient_ids=False,
+        chunk_size=100000,
+    ):
+        """Yields lists of up to chunk_size rows of the latest data points in tall format:
+        (patient_id, data_point_name, data_point_value_num, data_point_value_string, centre), ordered by
+        centre and patient. The centre is the treatment_place in the dataset's treatment collection"""
+        with self.temp_filters() as temp_tables:
+            sql_string, variables = self.latest_data_points_sql(
+                dataset_id, select_data_points, select_patient_ids, temp_tables
+            )
+            sql_string = f"""SELECT l.patient_id, l.data_point_name, l.data_point_value_num,
+                                l.data_point_value_string, c.centre
+                            FROM ({sql_string}) AS l
+                            LEFT JOIN (
+                                SELECT patient_id, MIN(treatment_place) AS centre FROM treatments
+                                WHERE collection_id = (SELECT treatment_collection_id FROM datasets WHERE dataset_id = ?)
+                                GROUP BY patient_id
+                            ) AS c ON c.patient_id = l.patient_id
+                            ORDER BY c.centre, l.patient_id, l.data_point_name"""
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(sql_string, variables + [dataset_id])
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if len(rows) == 0:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+
+    def iter_dataset_chunks(
+        self,
+        dataset_id,
+        select_data_points=False,
+        select_patient_ids=False,
+        chunk_size=1000,
+    ):
+        """Yields the dataset as wide data frames of chunk_size patients, so large datasets can be exported
+        without loading all data points. All chunks have the same columns as get_dataset_as_dataframe"""
+        with self.temp_filters() as temp_tables:
+            sql_string, variables = self.latest_data_points_sql(
+                dataset_id, select_data_points, select_patient_ids, temp_tables
+            )
+
+            columns = self.get_dataset_columns(
+                dataset_id, select_data_points, select_patient_ids
+            )
+
+            # One pass over the latest data points ordered by patient, pivoted chunk_size patients at a
+            # time. A patient filter per chunk is not pushed into the window subquery, so each chunk
+            # would read the whole dataset
+            sql_string = f"{sql_string} ORDER BY patient_id, data_point_name"
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(sql_string, variables)
+                rows = list()
+                number_of_patients = 0
+                while True:
+                    fetched_rows = cursor.fetchmany(10000)
+                    if len(fetched_rows) == 0:
+                        break
+                    for row in fetched_rows:
+                        if len(rows) == 0 or row[0] != rows[-1][0]:
+                            if number_of_patients == chunk_size:
+                                yield self.pivot_data_points(rows, columns)
+                                rows = list()
+                                number_of_patients = 0
+                            number_of_patients = number_of_patients + 1
+                        rows.append(row)
+                if len(rows) > 0:
+                    yield self.pivot_data_points(rows, columns)
+            finally:
+                cursor.close()
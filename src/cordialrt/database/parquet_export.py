@@ -0,0 +1,243 @@
+"""
+Columnar export of datasets, screening and CAC results to Parquet. Files are written in hive
+partitioned folders, e.g. folder/dataset_id=3/centre=Aarhus/part-0.parquet, which pandas and pyarrow
+read back as one table with dataset_id and centre as columns. Only the partitions and columns asked
+for are read:
+
+    pd.read_parquet(folder, columns=["patient_id", "heart_mean"], filters=[("centre", "=", "Aarhus")])
+
+Requires pyarrow, installed with the parquet extra: pip install cordialrt[parquet]
+"""
+
+import datetime
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import cordialrt.database.database as rtdb
+from cordialrt.screen_files.sinks import SUMMARY_COLUMNS
+
+# Partition value used when the centre of a patient is unknown
+UNKNOWN_PARTITION = "unknown"
+
+
+def import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet export requires pyarrow: pip install cordialrt[parquet]") from e
+    return (pa, pq)
+
+
+def partition_value(value):
+    """Folder safe string for a partition value"""
+    if value is None or value == "":
+        return UNKNOWN_PARTITION
+    return str(value).replace("/", "_").replace("\\", "_")
+
+
+def partition_folder(folder, partitions):
+    """Folder for the partitions, a list of (name, value), e.g. [("dataset_id", 3), ("centre", "Aarhus")]"""
+    path = folder
+    for name, value in partitions:
+        path = os.path.join(path, f"{name}={partition_value(value)}")
+    return path
+
+
+def time_stamp():
+    return datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S_%f")
+
+
+class PartitionedWriter:
+    """Streams pyarrow tables with the same schema to one Parquet file per partition. Each write adds a
+    row group to the file of its partition, the files are complete when the writer is closed"""
+
+    def __init__(self, folder, schema, file_name="part-0.parquet"):
+        self.pa, self.pq = import_pyarrow()
+        self.folder = folder
+        self.schema = schema
+        self.file_name = file_name
+        # partition folder: ParquetWriter
+        self.writers = dict()
+        self.rows_written = 0
+
+    def write(self, table, partitions):
+        path = partition_folder(self.folder, partitions)
+        writer = self.writers.get(path)
+        if writer is None:
+            os.makedirs(path, exist_ok=True)
+            writer = self.pq.ParquetWriter(os.path.join(path, self.file_name), self.schema)
+            self.writers[path] = writer
+        writer.write_table(table)
+        self.rows_written = self.rows_written + table.num_rows
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.close()
+
+
+def plain_value(value):
+    """Converts numpy scalars, tuples and pydicom multi values to plain python values pyarrow can read"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return [plain_value(item) for item in value.tolist()]
+    if isinstance(value, (list, tuple)) or type(value).__name__ == "MultiValue":
+        return [plain_value(item) for item in value]
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def data_frame_to_table(data_frame):
+    """pyarrow table of a data frame. Object columns pyarrow can not read as they are, e.g. lists of mixed
+    numpy types, are converted to plain python values, and to strings if that is not enough"""
+    pa, _ = import_pyarrow()
+    arrays = list()
+    for column in data_frame.columns:
+        values = data_frame[column]
+        try:
+            array = pa.array(values, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            plain = [plain_value(value) for value in values]
+            try:
+                array = pa.array(plain, from_pandas=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+                array = pa.array([None if value is None else str(value) for value in plain])
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=[str(column) for column in data_frame.columns])
+
+
+def export_dataset_tall(dataset_id, folder, select_data_points=False, select_patient_ids=False,
+                        chunk_size=100000):
+    """Streams the latest data points of the dataset to folder/dataset_id=N/centre=X/part-0.parquet with
+    one row per patient and data point. An earlier export of the dataset is replaced.
+    Returns the number of rows written"""
+    pa, _ = import_pyarrow()
+    schema = pa.schema([
+        ("patient_id", pa.string()),
+        ("data_point_name", pa.string()),
+        ("data_point_value_num", pa.float64()),
+        ("data_point_value_string", pa.string()),
+    ])
+    remove_partition(folder, [("dataset_id", dataset_id)])
+
+    with PartitionedWriter(folder, schema) as writer:
+        with rtdb.DatabaseCall() as db:
+            for rows in db.iter_dataset_rows(dataset_id, select_data_points, select_patient_ids,
+                                             chunk_size=chunk_size):
+                # Rows are ordered by centre, write each run of a centre as one table
+                start = 0
+                while start < len(rows):
+                    centre = rows[start][4]
+                    end = start
+                    while end < len(rows) and rows[end][4] == centre:
+                        end = end + 1
+                    table = pa.Table.from_arrays([
+                        pa.array([str(row[0]) for row in rows[start:end]], pa.string()),
+                        pa.array([row[1] for row in rows[start:end]], pa.string()),
+                        pa.array([None if row[2] is None else float(row[2]) for row in rows[start:end]],
+                                 pa.float64()),
+                        pa.array([None if row[3] is None else str(row[3]) for row in rows[start:end]],
+                                 pa.string()),
+                    ], schema=schema)
+                    writer.write(table, [("dataset_id", dataset_id), ("centre", centre)])
+                    start = end
+
+    print(f"Exported {writer.rows_written} data points of dataset {dataset_id} to {folder}")
+    return writer.rows_written
+
+
+def wide_column_names(columns):
+    """Column names of the wide dataset. A data point with both numbers and strings gets a _string column"""
+    numeric_names = set(name for value_column, name in columns if value_column == "data_point_value_num")
+    names = list()
+    for value_column, name in columns:
+        if value_column == "data_point_value_string" and name in numeric_names:
+            name = f"{name}_string"
+        names.append(name)
+    return names
+
+
+def export_dataset_wide(dataset_id, folder, select_data_points=False, select_patient_ids=False,
+                        chunk_size=1000):
+    """Writes the dataset as in get_dataset_as_dataframe, one row per patient and one column per data point,
+    to folder/dataset_id=N/centre=X/part-0.parquet. Patients are read chunk_size at a time. An earlier
+    export of the dataset is replaced. Returns the number of patients written"""
+    pa, _ = import_pyarrow()
+    remove_partition(folder, [("dataset_id", dataset_id)])
+
+    with rtdb.DatabaseCall() as db:
+        columns = db.get_dataset_columns(dataset_id, select_data_points, select_patient_ids)
+        names = wide_column_names(columns)
+        centres = db.get_dataset_patient_centres(dataset_id)
+
+        fields = [("patient_id", pa.string())]
+        for (value_column, _), name in zip(columns, names):
+            if value_column == "data_point_value_num":
+                fields.append((name, pa.float64()))
+            else:
+                fields.append((name, pa.string()))
+        schema = pa.schema(fields)
+
+        with PartitionedWriter(folder, schema) as writer:
+            for chunk in db.iter_dataset_chunks(dataset_id, select_data_points, select_patient_ids,
+                                                chunk_size=chunk_size):
+                chunk.columns = names
+                chunk = chunk.reset_index()
+                chunk["patient_id"] = chunk["patient_id"].astype(str)
+                for (value_column, _), name in zip(columns, names):
+                    if value_column == "data_point_value_num":
+                        chunk[name] = chunk[name].astype(float)
+                    else:
+                        chunk[name] = [None if pd.isna(value) else str(value) for value in chunk[name]]
+
+                chunk_centres = chunk["patient_id"].map(centres).fillna(UNKNOWN_PARTITION)
+                for centre, part in chunk.groupby(chunk_centres, sort=False):
+                    table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+                    writer.write(table, [("dataset_id", dataset_id), ("centre", centre)])
+
+    print(f"Exported {writer.rows_written} patients of dataset {dataset_id} to {folder}")
+    return writer.rows_written
+
+
+def remove_partition(folder, partitions):
+    path = partition_folder(folder, partitions)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+
+
+def export_table(data_frame, folder, partitions, name=None):
+    """Writes a data frame to one new Parquet file in the partition folder, e.g. the screening or CAC
+    results of a centre with partitions [("centre", centre)]. Earlier files are kept, so results of
+    several runs are read back together. Returns the path of the file"""
+    _, pq = import_pyarrow()
+    path = partition_folder(folder, partitions)
+    os.makedirs(path, exist_ok=True)
+    # The random suffix keeps files of exports made at the same time, e.g. from several processes, apart
+    file_path = os.path.join(path, f"{name or 'part'}_{time_stamp()}_{uuid.uuid4().hex[:8]}.parquet")
+    pq.write_table(data_frame_to_table(data_frame), file_path)
+    return file_path
+
+
+def export_screening(data_frame, folder, centre):
+    """Writes the summary columns of an open_dicom_files data frame to folder/centre=X/"""
+    columns = [column for column in SUMMARY_COLUMNS if column in data_frame.columns]
+    summary = data_frame[columns].copy()
+    summary["patient_id"] = summary["patient_id"].astype(str)
+    if "plan_names" in summary.columns:
+        summary["plan_names"] = [[str(name) for name in names] for names in summary["plan_names"]]
+    return export_table(summary, folder, [("centre", centre)], name="screening")
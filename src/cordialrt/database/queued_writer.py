@@ -0,0 +1,137 @@
+"""
+A single writer thread for inserts made by many worker processes. The workers put rows on a
+multiprocessing queue through a QueuedRows object, and the writer thread in the main process inserts
+them in batches, one transaction per table in each batch. Only one process then writes to the
+database, so the workers never wait for each other's write locks.
+
+    with QueuedWriter() as writer:
+        with ProcessPoolExecutor(initializer=init_worker, initargs=(writer.client(),)) as executor:
+            ...
+
+Inserts that need the new id (create_dataset, new_data_extraction, ...) are made directly with a
+DatabaseCall before the work is handed out.
+"""
+
+import multiprocessing
+import queue
+import sqlite3
+import threading
+import time
+
+import cordialrt.database.database as rtdb
+import cordialrt.helpers.exceptions as crtex
+
+
+class QueuedRows:
+    """The worker side of a QueuedWriter. Can be pickled and passed to worker processes when they are
+    created, e.g. as initargs of a process pool"""
+
+    def __init__(self, rows_queue):
+        self.queue = rows_queue
+
+    def insert_rows_in_table(self, table_name, column_names, rows):
+        rows = [list(row) for row in rows]
+        if len(rows) > 0:
+            self.queue.put((table_name, tuple(column_names), rows))
+
+    def insert_data_points(self, data_extraction_id, rows):
+        """As DatabaseCall.insert_data_points"""
+        self.insert_rows_in_table(
+            "data_points",
+            rtdb.DATA_POINT_COLUMNS,
+            [[data_extraction_id] + list(row) for row in rows],
+        )
+
+
+class QueuedWriter:
+    """Inserts rows from the queue, at most batch_size rows in each transaction. A batch is written when
+    it is full or flush_interval seconds after its first rows arrived"""
+
+    def __init__(self, rows_queue=None, batch_size=5000, flush_interval=1.0):
+        self.queue = multiprocessing.Queue() if rows_queue is None else rows_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        # (table_name, error) for batches that could not be inserted
+        self.errors = list()
+        self._thread = None
+
+    def client(self):
+        return QueuedRows(self.queue)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="QueuedWriter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Writes the rows left on the queue and stops the writer thread. Returns the number of rows written.
+        Raises SqlInsertFail if any batch could not be inserted, the failed batches are listed in errors"""
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if len(self.errors) > 0:
+            table_name, error = self.errors[0]
+            raise crtex.SqlInsertFail(
+                f"QueuedWriter: {len(self.errors)} batches failed, the first in {table_name}: {error}"
+            )
+        return self.rows_written
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exception_type, exception_val, trace):
+        self.stop()
+
+    def _next_batch(self):
+        """Blocks for the first item, then collects items until the batch is full or the interval has
+        passed. Returns (items, stop)"""
+        item = self.queue.get()
+        if item is None:
+            return (list(), True)
+
+        items = [item]
+        number_of_rows = len(item[2])
+        deadline = time.monotonic() + self.flush_interval
+        while number_of_rows < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return (items, True)
+            items.append(item)
+            number_of_rows = number_of_rows + len(item[2])
+        return (items, False)
+
+    def _write(self, db, items):
+        # Rows for the same table and columns are inserted with one executemany
+        tables = dict()
+        for table_name, column_names, rows in items:
+            tables.setdefault((table_name, column_names), list()).extend(rows)
+
+        for (table_name, column_names), rows in tables.items():
+            try:
+                with db.transaction():
+                    db.insert_rows_in_table(table_name, list(column_names), rows)
+                self.rows_written = self.rows_written + len(rows)
+            except (crtex.SqlInsertFail, sqlite3.Error) as e:
+                print(f"QueuedWriter: insert in {table_name} failed: {e}")
+                self.errors.append((table_name, e))
+
+    def _run(self):
+        try:
+            with rtdb.DatabaseCall() as db:
+                stop = False
+                while not stop:
+                    items, stop = self._next_batch()
+                    if len(items) > 0:
+                        self._write(db, items)
+        except Exception as e:
+            # Recorded so stop raises it instead of the rows being lost silently
+            print(f"QueuedWriter: writer thread failed: {e}")
+            self.errors.append((None, e))
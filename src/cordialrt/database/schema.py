@@ -0,0 +1,229 @@
+"""
+Versioned schema of the cordialrt database. The version is kept in PRAGMA user_version and
+upgrade_database runs the migrations that are missing, so an existing database is upgraded in
+place and a new database is created with the latest schema. Migrations only add tables and
+indexes, data is never changed.
+"""
+
+import sqlite3
+
+TABLES = {
+    "treatment_collections": """CREATE TABLE IF NOT EXISTS "treatment_collections" (
+        "collection_id"	INTEGER NOT NULL UNIQUE,
+        "collection_name"	TEXT NOT NULL,
+        "edit_date"	TEXT NOT NULL,
+        "edit_user"	TEXT NOT NULL,
+        PRIMARY KEY("collection_id" AUTOINCREMENT)
+    )""",
+    "structure_collections": """CREATE TABLE IF NOT EXISTS "structure_collections" (
+        "structure_collection_id"	INTEGER NOT NULL UNIQUE,
+        "structure_collection_name"	TEXT,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("structure_collection_id")
+    )""",
+    "dicom_files": """CREATE TABLE IF NOT EXISTS "dicom_files" (
+        "dicom_file_id"	INTEGER NOT NULL UNIQUE,
+        "treatment_id"	INTEGER,
+        "file_type"	TEXT NOT NULL,
+        "file_path"	TEXT NOT NULL,
+        "file_uid"	TEXT,
+        "edit_date"	TEXT NOT NULL,
+        "edit_user"	TEXT,
+        PRIMARY KEY("dicom_file_id" AUTOINCREMENT)
+    )""",
+    "structures": """CREATE TABLE IF NOT EXISTS "structures" (
+        "structure_id"	INTEGER UNIQUE,
+        "structure_collection_id"	INTEGER,
+        "dicom_file_id"	INTEGER,
+        "patient_id"	TEXT,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("structure_id")
+    )""",
+    "treatments": """CREATE TABLE IF NOT EXISTS "treatments" (
+        "treatment_id"	INTEGER NOT NULL UNIQUE,
+        "patient_id"	TEXT NOT NULL,
+        "collection_id"	TEXT NOT NULL,
+        "treatment_place"	TEXT,
+        "main_dose_scale_factor"	NUMERIC,
+        "main_reference_dose"	NUMERIC,
+        "boost_reference_dose"	NUMERIC,
+        "boost_dose_scale_factor"	NUMERIC,
+        "edit_date"	TEXT NOT NULL,
+        "edit_user"	TEXT,
+        PRIMARY KEY("treatment_id" AUTOINCREMENT)
+    )""",
+    "synonyms": """CREATE TABLE IF NOT EXISTS "synonyms" (
+        "synonym_collection_id"	INTEGER,
+        "standard_name"	TEXT,
+        "synonym"	TEXT,
+        "laterality"	TEXT,
+        "priority_count"	INTEGER,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT
+    )""",
+    "synonyms_for_treatment_collections": """CREATE TABLE IF NOT EXISTS "synonyms_for_treatment_collections" (
+        "synonym_collection_id"	INTEGER,
+        "treatment_collection_id"	INTEGER,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT
+    )""",
+    "synonym_collections": """CREATE TABLE IF NOT EXISTS "synonym_collections" (
+        "synonym_collection_id"	INTEGER UNIQUE,
+        "synonym_collection_name"	TEXT,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("synonym_collection_id" AUTOINCREMENT)
+    )""",
+    "datasets": """CREATE TABLE IF NOT EXISTS "datasets" (
+        "dataset_id"	INTEGER NOT NULL UNIQUE,
+        "dataset_name"	TEXT,
+        "treatment_collection_id"	INTEGER,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("dataset_id" AUTOINCREMENT)
+    )""",
+    "data_extractions": """CREATE TABLE IF NOT EXISTS "data_extractions" (
+        "data_extraction_id"	INTEGER NOT NULL UNIQUE,
+        "dataset_id"	INTEGER,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("data_extraction_id" AUTOINCREMENT)
+    )""",
+    "data_points": """CREATE TABLE IF NOT EXISTS "data_points" (
+        "data_point_id"	INTEGER NOT NULL UNIQUE,
+        "data_extraction_id"	INTEGER,
+        "patient_id"	TEXT,
+        "data_point_name"	TEXT,
+        "data_point_value_num"	NUMERIC,
+        "data_point_value_string"	TEXT,
+        "data_point_type"	TEXT,
+        "roi_standard_name"	TEXT,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("data_point_id" AUTOINCREMENT)
+    )""",
+}
+
+# Added in version 3. The structure chosen for each ROI standard name of a treatment, see
+# cordialrt.analysis.roi_map. structure_number is NULL if no synonym was found in the structure file
+ROI_MAP_TABLE = """CREATE TABLE IF NOT EXISTS "roi_map" (
+        "roi_map_id"	INTEGER NOT NULL UNIQUE,
+        "treatment_id"	INTEGER NOT NULL,
+        "standard_name"	TEXT NOT NULL,
+        "structure_number"	INTEGER,
+        "structure_name"	TEXT,
+        "priority_count"	INTEGER,
+        "laterality"	TEXT,
+        "reason"	TEXT NOT NULL,
+        "structure_file_path"	TEXT,
+        "structure_file_mtime"	INTEGER,
+        "synonyms_fingerprint"	TEXT,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("roi_map_id" AUTOINCREMENT),
+        UNIQUE("treatment_id", "standard_name")
+    )"""
+
+# Added in version 4. Header tags of the CT series of a treatment, see cordialrt.analysis.ct_series.
+# tag_values and inconsistent_tags are JSON. files_signature changes when the CT files change
+CT_SERIES_TABLE = """CREATE TABLE IF NOT EXISTS "ct_series" (
+        "ct_series_id"	INTEGER NOT NULL UNIQUE,
+        "treatment_id"	INTEGER NOT NULL UNIQUE,
+        "series_instance_uid"	TEXT,
+        "number_of_slices"	INTEGER,
+        "tag_values"	TEXT,
+        "inconsistent_tags"	TEXT,
+        "files_signature"	TEXT,
+        "edit_date"	TEXT,
+        "edit_user"	TEXT,
+        PRIMARY KEY("ct_series_id" AUTOINCREMENT)
+    )"""
+
+# Covering indexes for the queries run for every treatment, roi and data point
+INDEXES = {
+    "treatments_collection": "treatments (collection_id, treatment_place, patient_id)",
+    "treatments_patient": "treatments (patient_id, collection_id)",
+    "dicom_files_treatment": "dicom_files (treatment_id, file_type, file_path)",
+    "synonyms_standard_name": "synonyms (standard_name, synonym_collection_id, synonym, priority_count, laterality)",
+    "synonyms_collection_synonym": "synonyms (synonym_collection_id, synonym)",
+    "synonyms_for_treatment_collection": "synonyms_for_treatment_collections (treatment_collection_id, synonym_collection_id)",
+    "structures_patient": "structures (patient_id, structure_collection_id, dicom_file_id)",
+    "data_extractions_dataset": "data_extractions (dataset_id, data_extraction_id)",
+    "data_points_extraction": "data_points (data_extraction_id, patient_id, data_point_name)",
+}
+
+
+def create_tables(cursor):
+    for table_name, sql_string in TABLES.items():
+        cursor.execute(sql_string)
+
+
+def create_indexes(cursor):
+    for index_name, columns in INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {columns}")
+    cursor.execute("ANALYZE")
+
+
+def create_roi_map(cursor):
+    cursor.execute(ROI_MAP_TABLE)
+
+
+def create_ct_series(cursor):
+    cursor.execute(CT_SERIES_TABLE)
+
+
+# Version: function upgrading the schema from the version before
+MIGRATIONS = {
+    1: create_tables,
+    2: create_indexes,
+    3: create_roi_map,
+    4: create_ct_series,
+}
+SCHEMA_VERSION = max(MIGRATIONS.keys())
+
+
+def get_schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def upgrade_connection(connection, target_version=SCHEMA_VERSION):
+    """Runs the missing migrations on an open connection, each in its own transaction.
+    Returns the schema version of the database"""
+    version = get_schema_version(connection)
+    if version >= target_version:
+        return version
+
+    for migration_version in sorted(MIGRATIONS.keys()):
+        if migration_version <= version:
+            continue
+        if migration_version > target_version:
+            break
+        cursor = connection.cursor()
+        try:
+            # Take the write lock before checking, another process may be upgrading too
+            cursor.execute("BEGIN IMMEDIATE")
+            upgrade = get_schema_version(connection) < migration_version
+            if upgrade:
+                MIGRATIONS[migration_version](cursor)
+                cursor.execute(f"PRAGMA user_version = {migration_version}")
+            connection.commit()
+        except sqlite3.Error:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+        if upgrade:
+            print(f"Database schema upgraded to version {migration_version}")
+
+    return get_schema_version(connection)
+
+
+def upgrade_database(database_path, target_version=SCHEMA_VERSION):
+    """Upgrade the database file to the target version, creating it if it does not exist"""
+    connection = sqlite3.connect(database_path)
+    try:
+        return upgrade_connection(connection, target_version)
+    finally:
+        connection.close()
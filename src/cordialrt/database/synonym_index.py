@@ -0,0 +1,101 @@
+"""
+In-memory index of the synonyms linked to a treatment collection. The synonyms of all synonym
+collections associated with the treatment collection are loaded in one query and kept per process
+until the synonyms are changed through a DatabaseCall, so matching the ROI names of a structure set
+takes one dictionary lookup per name instead of a database query per ROI.
+"""
+
+import hashlib
+import threading
+from collections import namedtuple
+
+# Missing laterality and priority_count are stored as "x" and 0, as used when sorting synonyms
+SynonymEntry = namedtuple("SynonymEntry", ["synonym", "priority_count", "laterality"])
+
+SYNONYM_INDEX_SQL = """SELECT s.synonym, s.standard_name, s.priority_count, s.laterality
+                       FROM synonyms_for_treatment_collections AS sftc
+                       JOIN synonyms AS s ON s.synonym_collection_id = sftc.synonym_collection_id
+                       WHERE sftc.treatment_collection_id = ?
+                       ORDER BY s.synonym_collection_id, s.rowid"""
+
+
+class SynonymIndex:
+    def __init__(self, treatment_collection_id):
+        self.treatment_collection_id = treatment_collection_id
+        # lower-cased synonym: {standard_name: SynonymEntry}
+        self.synonyms = dict()
+
+    @classmethod
+    def from_cursor(cls, cursor, treatment_collection_id):
+        index = cls(treatment_collection_id)
+        rows = cursor.execute(SYNONYM_INDEX_SQL, [treatment_collection_id]).fetchall()
+        for synonym, standard_name, priority_count, laterality in rows:
+            index.add(synonym, standard_name, priority_count, laterality)
+        return index
+
+    def add(self, synonym, standard_name, priority_count=None, laterality=None):
+        if synonym is None:
+            return
+        entry = SynonymEntry(
+            synonym,
+            0 if priority_count is None else priority_count,
+            "x" if laterality is None else laterality,
+        )
+        standard_names = self.synonyms.setdefault(synonym.lower(), dict())
+        # A synonym found in more than one synonym collection keeps the highest priority_count
+        current = standard_names.get(standard_name)
+        if current is None or entry.priority_count > current.priority_count:
+            standard_names[standard_name] = entry
+
+    def lookup(self, roi_name, standard_name):
+        """Returns the SynonymEntry if roi_name is a synonym of standard_name, otherwise None"""
+        standard_names = self.synonyms.get(roi_name.lower())
+        if standard_names is None:
+            return None
+        return standard_names.get(standard_name)
+
+    def standard_names(self, roi_name):
+        """Returns {standard_name: SynonymEntry} for all standard names roi_name is a synonym of"""
+        return self.synonyms.get(roi_name.lower(), dict())
+
+    def synonyms_for_standard_name(self, standard_name):
+        return [
+            standard_names[standard_name]
+            for standard_names in self.synonyms.values()
+            if standard_name in standard_names
+        ]
+
+    def fingerprint(self, standard_name):
+        """Hash of the synonyms of standard_name, changes when a synonym, priority or laterality changes"""
+        entries = sorted(self.synonyms_for_standard_name(standard_name), key=lambda entry: entry.synonym)
+        return hashlib.sha1(repr(entries).encode()).hexdigest()
+
+    def __len__(self):
+        return len(self.synonyms)
+
+
+# treatment_collection_id: SynonymIndex, shared by all threads in the process
+_INDEXES = dict()
+_LOCK = threading.Lock()
+# Increased on every invalidation, so an index loaded while the synonyms changed is not cached
+_generation = 0
+
+
+def get_synonym_index(cursor, treatment_collection_id):
+    """Returns the cached index of the treatment collection, loading it with the cursor on first use"""
+    index = _INDEXES.get(treatment_collection_id)
+    if index is None:
+        generation = _generation
+        index = SynonymIndex.from_cursor(cursor, treatment_collection_id)
+        with _LOCK:
+            if generation == _generation:
+                _INDEXES[treatment_collection_id] = index
+    return index
+
+
+def invalidate_synonym_indexes():
+    """Forget all cached indexes, they are reloaded on next use"""
+    global _generation
+    with _LOCK:
+        _generation = _generation + 1
+        _INDEXES.clear()
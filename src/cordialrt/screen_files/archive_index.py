@@ -0,0 +1,135 @@
+"""Archive wide index of DICOM files keyed by SOPInstanceUID. Finds the files that are collected more than
+once (in the same or in different folders) and the references to files that were never collected, across
+all patients in one pass over the archive and before anything is added to the database."""
+
+from collections import namedtuple
+
+import pandas as pd
+
+from cordialrt.screen_files.base.folder_utilities import (
+    load_dicom_files_in_folder,
+    walk_dicom_folders,
+)
+from cordialrt.screen_files.base.uid_graph import UidGraph
+from cordialrt.screen_files.catalog import ScreeningCatalog
+
+# One copy of a file in the archive. content_hash is None unless hashing was requested
+FileLocation = namedtuple("FileLocation", ["path", "folder", "content_hash"])
+
+
+class ArchiveIndex:
+    def __init__(self):
+        # SOPInstanceUID: [FileLocation] in the order the copies were found
+        self.locations = dict()
+        # UID links between the first copy of each file
+        self.graph = UidGraph()
+
+    def add_file(self, path, header, folder=None, content_hash=None):
+        """Add a file from its DicomHeader (or Dataset). Files without a SOPInstanceUID are ignored"""
+        uid = header.SOPInstanceUID
+        if uid is None:
+            return
+        self.locations.setdefault(uid, list()).append(FileLocation(path, folder, content_hash))
+        self.graph.add_file(
+            uid,
+            {"path": path, "data_set": header},
+            header.PatientID,
+            header.StudyInstanceUID,
+            header.Modality,
+        )
+
+    def duplicates(self):
+        """Returns a dict of SOPInstanceUID: [FileLocation] for the files found more than once"""
+        duplicates = dict()
+        for uid, locations in self.locations.items():
+            if len(locations) > 1:
+                duplicates[uid] = locations
+        return duplicates
+
+    @staticmethod
+    def identical_copies(locations):
+        """True if all copies have the same content hash, None if a copy was not hashed"""
+        hashes = set(location.content_hash for location in locations)
+        if None in hashes:
+            return None
+        return len(hashes) == 1
+
+    def duplicate_paths(self, identical_only=False):
+        """Paths of the extra copies of each duplicated file (all but the first found). With
+        identical_only only copies with the same content hash as the first copy are included"""
+        paths = list()
+        for uid, locations in self.duplicates().items():
+            first = locations[0]
+            for location in locations[1:]:
+                if identical_only and (
+                    location.content_hash is None or location.content_hash != first.content_hash
+                ):
+                    continue
+                paths.append(location.path)
+        return paths
+
+    def duplicates_dataframe(self):
+        rows = list()
+        for uid, locations in self.duplicates().items():
+            patient_id, study_id, modality = self.graph.file_info[uid]
+            identical = self.identical_copies(locations)
+            for location in locations:
+                rows.append(
+                    {
+                        "sop_instance_uid": uid,
+                        "patient_id": patient_id,
+                        "modality": modality,
+                        "path": location.path,
+                        "folder": location.folder,
+                        "content_hash": location.content_hash,
+                        "identical": identical,
+                    }
+                )
+        columns = ["sop_instance_uid", "patient_id", "modality", "path", "folder", "content_hash",
+                   "identical"]
+        return pd.DataFrame(rows, columns=columns)
+
+    def dangling_references_dataframe(self):
+        columns = ["patient_id", "modality", "uid", "path", "missing_modality", "missing_uid"]
+        return pd.DataFrame(self.graph.missing_references(), columns=columns)
+
+    def report(self):
+        """Prints a summary and returns the duplicates and dangling references dataframes"""
+        duplicates = self.duplicates_dataframe()
+        dangling_references = self.dangling_references_dataframe()
+        print(f"Files in archive: {len(self.locations)} unique SOPInstanceUIDs")
+        print(f"Duplicated files: {duplicates.sop_instance_uid.nunique()} "
+              f"({len(self.duplicate_paths())} extra copies)")
+        print(f"Dangling references: {len(dangling_references)} "
+              f"in {dangling_references.uid.nunique()} files")
+        return (duplicates, dangling_references)
+
+
+def build_archive_index(parent_folder, catalog=None, hash_contents=False, detect_dicom=False):
+    """Reads the screening header of every DICOM file below parent_folder in one pass and returns an
+    ArchiveIndex. Use hash_contents to also hash the file contents, which tells true copies from files
+    that only share a SOPInstanceUID. With a ScreeningCatalog only new or changed files are read and
+    hashed, unchanged files use the header and hash stored from earlier runs. Hashing always goes through
+    a catalog, the default ScreeningCatalog is used if none is given."""
+    if hash_contents and catalog is None:
+        catalog = ScreeningCatalog()
+
+    index = ArchiveIndex()
+    counter = 0
+
+    for folder, files in walk_dicom_folders(parent_folder, detect_dicom=detect_dicom,
+                                            with_stat=catalog is not None):
+        hashes = dict() if hash_contents else None
+        if catalog is not None:
+            headers = catalog.load_folder(folder, files, hashes=hashes)
+        else:
+            headers = load_dicom_files_in_folder(folder, header_only=True, files=files)
+
+        for path, header in headers.items():
+            index.add_file(path, header, folder, None if hashes is None else hashes.get(path))
+
+        counter = counter + 1
+        if counter % 100 == 0:
+            print(f"{counter} folders indexed")
+
+    return index
@@ -3,14 +3,38 @@ import pydicom
 import numpy as np
 import glob
 
+from cordialrt.screen_files.base.uid_graph import UidGraph
+
+# Study attribute holding the files of each modality. Other modalities go in other_files
+MODALITY_ATTRIBUTES = {
+    'CT': 'cts',
+    'RTPLAN': 'plans',
+    'RTDOSE': 'doses',
+    'RTSTRUCT': 'structures',
+}
+
 class Patient:
     """Patient class holding all treatment data related to that patient_id """
     def __init__(self, patient_id):
         self.patient_id = patient_id
         self.studies = dict()
+        self._uid_graph = None
 
     def add_study(self, study):
         self.studies[study.study_id] = study
+        self._uid_graph = None
+
+    def build_uid_graph(self):
+        """Builds the UidGraph of the UID links between the files in all studies of the patient"""
+        self._uid_graph = UidGraph.from_patient(self)
+        return(self._uid_graph)
+
+    @property
+    def uid_graph(self):
+        """UidGraph of the patient. Built on first use and rebuilt if a study is added"""
+        if getattr(self, '_uid_graph', None) is None:
+            self.build_uid_graph()
+        return(self._uid_graph)
 
     @property
     def id (self):
@@ -39,6 +63,7 @@ class Study:
         self.structures = dict()
         self.doses = dict()  
         self.other_files = dict() 
+        self.duplicate_files = list()
 
     @property 
     def one_plan (self):
@@ -61,37 +86,20 @@ class Study:
         else:    
             return(None)
     
+    def add_dicom_file(self, path, dicom_file):
+        """Add a file to the dict for its modality. Returns False and records the path in duplicate_files
+        if a file with the same SOPInstanceUID is already in the study"""
+        files = getattr(self, MODALITY_ATTRIBUTES.get(dicom_file.Modality, 'other_files'))
+        if dicom_file.SOPInstanceUID in files:
+            self.duplicate_files.append(path)
+            return(False)
+        files[dicom_file.SOPInstanceUID] = {'path' : path, 'data_set': dicom_file}
+        return(True)
+
     def load_dicom_files(self, dicom_files):
         for path, dicom_file in dicom_files.items():
             if dicom_file.StudyInstanceUID == self.study_id:
-
-                if dicom_file.Modality == 'CT':
-                    if dicom_file.SOPInstanceUID in self.cts.keys():
-                        print('CT already in study')
-                    else:
-                        self.cts[dicom_file.SOPInstanceUID] = {'path' : path, 'data_set': dicom_file}          
-                elif dicom_file.Modality == 'RTPLAN':
-                    if dicom_file.SOPInstanceUID in self.plans.keys():
-                        print('Plan already in study')
-                    else: 
-                        self.plans[dicom_file.SOPInstanceUID] = {'path' : path, 'data_set': dicom_file}    
-                elif dicom_file.Modality == 'RTDOSE':
-                    if dicom_file.SOPInstanceUID in self.doses.keys():
-                        print('Dose already in study')
-                    else:    
-                        self.doses[dicom_file.SOPInstanceUID] = {'path' : path, 'data_set': dicom_file}      
-                elif dicom_file.Modality == 'RTSTRUCT':
-                    if dicom_file.SOPInstanceUID in self.structures.keys():
-                        print('Struct already in study')
-                    else:    
-                        self.structures[dicom_file.SOPInstanceUID] = {'path' : path, 'data_set': dicom_file}       
-                else:
-                    if dicom_file.SOPInstanceUID in self.other_files.keys():
-                        print('Other file already in study')
-                    else:    
-                        self.other_files[dicom_file.SOPInstanceUID] = {'path' : path, 'data_set': dicom_file}    
-            else: 
-                pass   
+                self.add_dicom_file(path, dicom_file)
                  
         return(None)
 
@@ -108,3 +116,17 @@ class Study:
             if plan.RTPlanLabel == plan_name:
                 plans.append(plan)
         return plans
+
+
+def group_dicom_files(dicom_files):
+    """Groups files by PatientID, StudyInstanceUID and modality in a single pass.
+    Returns a dict of patient_id: {study_id: Study} in the order the ids are first seen"""
+    patients = dict()
+    for path, dicom_file in dicom_files.items():
+        studies = patients.setdefault(dicom_file.PatientID, dict())
+        study = studies.get(dicom_file.StudyInstanceUID)
+        if study is None:
+            study = Study(dicom_file.StudyInstanceUID)
+            studies[dicom_file.StudyInstanceUID] = study
+        study.add_dicom_file(path, dicom_file)
+    return(patients)
@@ -1,10 +1,20 @@
 """Functions for dealing with folders and files"""
 
 import glob
+import hashlib
 import os
 import pydicom
 from pydicom.errors import InvalidDicomError
-from collections import deque
+from collections import deque, namedtuple
+
+from cordialrt.screen_files.base.structures import DicomHeader
+
+DICOM_PREAMBLE_LENGTH = 128
+DICOM_PREFIX = b"DICM"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# A DICOM file found when walking the folders. size and mtime_ns are None unless stat data was requested
+DicomFileEntry = namedtuple("DicomFileEntry", ["path", "size", "mtime_ns"])
 
 
 def list_files_in_folder(path):
@@ -14,11 +24,70 @@ def list_files_in_folder(path):
     return None
 
 
-def fast_scandir(dir):
-    subfolders = [f.path for f in os.scandir(dir) if f.is_dir()]
-    for dir in list(subfolders):
-        subfolders.extend(fast_scandir(dir))
-    return subfolders
+def is_dicom_file(file_path):
+    """Checks for the 128 byte preamble followed by the DICM prefix"""
+    try:
+        with open(file_path, "rb") as dicom_file:
+            dicom_file.seek(DICOM_PREAMBLE_LENGTH)
+            return dicom_file.read(len(DICOM_PREFIX)) == DICOM_PREFIX
+    except OSError:
+        return False
+
+
+def file_content_hash(file_path):
+    """SHA-256 hex digest of the file content, read in blocks"""
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def dicom_file_entries(dir_entries, detect_dicom=False, with_stat=False):
+    """Returns a DicomFileEntry for each DICOM file among os.DirEntry objects. Files ending in .dcm are
+    always included, other files only with detect_dicom and a DICOM preamble. The stat data is taken
+    from the DirEntry, which is cached from the directory listing on Windows and network shares"""
+    files = list()
+    for entry in dir_entries:
+        if not entry.is_file():
+            continue
+        if entry.name.lower().endswith(".dcm") or (
+            detect_dicom and is_dicom_file(entry.path)
+        ):
+            if with_stat:
+                stat = entry.stat()
+                files.append(DicomFileEntry(entry.path, stat.st_size, stat.st_mtime_ns))
+            else:
+                files.append(DicomFileEntry(entry.path, None, None))
+    return files
+
+
+def list_dicom_files_in_folder(folder_path, detect_dicom=False, with_stat=False):
+    """Returns a sorted list of DicomFileEntry for the DICOM files in a folder (not recursive)"""
+    with os.scandir(folder_path) as dir_entries:
+        entries = sorted(dir_entries, key=lambda entry: entry.name)
+    return dicom_file_entries(entries, detect_dicom, with_stat)
+
+
+def walk_dicom_folders(parent_folder, detect_dicom=False, with_stat=False, include_parent=False):
+    """Walks all folders below parent_folder in a single pass and yields (folder, [DicomFileEntry])
+    for each folder, depth first in sorted order. The parent folder itself is only included with
+    include_parent"""
+    folders = [parent_folder]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as dir_entries:
+                entries = sorted(dir_entries, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Could not read folder {folder}: {e}")
+            continue
+
+        subfolders = [entry.path for entry in entries if entry.is_dir()]
+        folders.extend(reversed(subfolders))
+
+        if include_parent or folder != parent_folder:
+            yield (folder, dicom_file_entries(entries, detect_dicom, with_stat))
 
 
 def folder_file_prefix_status(folder_path):
@@ -39,14 +108,29 @@ def folder_file_prefix_status(folder_path):
     return prefix_file_paths
 
 
-def load_dicom_files_in_folder(folder_path):
-    dicom_file_paths = glob.glob(folder_path + "*.dcm")
+def load_dicom_files_in_folder(
+    folder_path, header_only=False, catalog=None, files=None, detect_dicom=False
+):
+    """Returns a dict with file path as key and the DICOM data as value. With header_only
+    only the screening tags are read and stored as DicomHeader records instead of Datasets.
+    If a ScreeningCatalog is given, only new or changed files are read (implies header_only).
+    files is a list of DicomFileEntry from walk_dicom_folders, if None the folder is listed"""
+    if files is None:
+        files = list_dicom_files_in_folder(
+            folder_path, detect_dicom=detect_dicom, with_stat=catalog is not None
+        )
+
+    if catalog is not None:
+        return catalog.load_folder(folder_path, files)
     # dicom_files = deque()
     dicom_files = dict()
 
-    for file_path in dicom_file_paths:
+    for file_path, _, _ in files:
         try:
-            dicom_file = pydicom.dcmread(file_path, stop_before_pixels=True)
+            if header_only:
+                dicom_file = DicomHeader.read(file_path)
+            else:
+                dicom_file = pydicom.dcmread(file_path, stop_before_pixels=True)
             dicom_files[file_path] = dicom_file
         except InvalidDicomError:
             print(f"File not valid DICOM: {file_path}")
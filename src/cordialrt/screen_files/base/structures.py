@@ -2,8 +2,26 @@
 
 import pydicom
 
+# Tags read from each file in header only screening
+SCREENING_TAGS = [
+    "PatientID",
+    "StudyInstanceUID",
+    "SeriesInstanceUID",
+    "SOPInstanceUID",
+    "SOPClassUID",
+    "Modality",
+    "StudyDate",
+    "RTPlanLabel",
+    "ApprovalStatus",
+    "FractionGroupSequence",
+    "ReferencedStructureSetSequence",
+    "ReferencedRTPlanSequence",
+    "ReferencedFrameOfReferenceSequence",
+]
+
+
 class DicomFile:
-    def __init__(self, file_path, dicom_dataset = None):     
+    def __init__(self, file_path, dicom_dataset = None):
         self.file_path = file_path
         if dicom_dataset is not None:
             self.data_set = dicom_dataset
@@ -14,4 +32,123 @@ class DicomFile:
         else:
             print("No path for DICOM")
 
-    
\ No newline at end of file
+
+class DicomHeader:
+    """Compact record of the header values used by the screening and the UID linkage. Can be used
+    in place of a pydicom Dataset in Study, Patient and when adding files to a treatment"""
+
+    __slots__ = (
+        "PatientID",
+        "StudyInstanceUID",
+        "SeriesInstanceUID",
+        "SOPInstanceUID",
+        "SOPClassUID",
+        "Modality",
+        "StudyDate",
+        "RTPlanLabel",
+        "ApprovalStatus",
+        "fractions_planned",
+        "referenced_structure_uids",
+        "referenced_plan_uids",
+        "referenced_ct_uids",
+    )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    @classmethod
+    def from_dataset(cls, data_set):
+        """Create a record from a pydicom Dataset"""
+        return cls(
+            PatientID=_string(data_set.get("PatientID")),
+            StudyInstanceUID=_string(data_set.get("StudyInstanceUID")),
+            SeriesInstanceUID=_string(data_set.get("SeriesInstanceUID")),
+            SOPInstanceUID=_string(data_set.get("SOPInstanceUID")),
+            SOPClassUID=_string(data_set.get("SOPClassUID")),
+            Modality=_string(data_set.get("Modality")),
+            StudyDate=_string(data_set.get("StudyDate")),
+            RTPlanLabel=_string(data_set.get("RTPlanLabel")),
+            ApprovalStatus=_string(data_set.get("ApprovalStatus")),
+            fractions_planned=fractions_planned(data_set),
+            referenced_structure_uids=referenced_structure_uids(data_set),
+            referenced_plan_uids=referenced_plan_uids(data_set),
+            referenced_ct_uids=referenced_ct_uids(data_set),
+        )
+
+    @classmethod
+    def read(cls, file_path):
+        """Read only the screening tags from a DICOM file"""
+        data_set = pydicom.dcmread(
+            file_path, stop_before_pixels=True, specific_tags=SCREENING_TAGS
+        )
+        return cls.from_dataset(data_set)
+
+    def __repr__(self):
+        return f"DicomHeader({self.Modality}, {self.SOPInstanceUID})"
+
+
+def _string(value):
+    """Plain str for pydicom values so the records stay small and picklable"""
+    if value is None:
+        return None
+    return str(value)
+
+
+# Accessors working on both pydicom Datasets and DicomHeader records
+
+
+def fractions_planned(data_set):
+    """Number of fractions planned in the first fraction group of a plan (None if not a plan)"""
+    if isinstance(data_set, DicomHeader):
+        return data_set.fractions_planned
+    try:
+        return int(data_set.FractionGroupSequence[0].NumberOfFractionsPlanned)
+    except (AttributeError, IndexError, TypeError):
+        return None
+
+
+def referenced_structure_uids(data_set):
+    """UIDs of the structure sets referenced by a plan"""
+    if isinstance(data_set, DicomHeader):
+        return data_set.referenced_structure_uids
+
+    structure_uids = list()
+    for reference in data_set.get("ReferencedStructureSetSequence", []):
+        if reference.ReferencedSOPClassUID.name == "RT Structure Set Storage":
+            structure_uids.append(str(reference.ReferencedSOPInstanceUID))
+    return tuple(structure_uids)
+
+
+def referenced_plan_uids(data_set):
+    """UIDs of the plans referenced by a dose"""
+    if isinstance(data_set, DicomHeader):
+        return data_set.referenced_plan_uids
+
+    plan_uids = list()
+    for reference in data_set.get("ReferencedRTPlanSequence", []):
+        if reference.ReferencedSOPClassUID.name == "RT Plan Storage":
+            plan_uids.append(str(reference.ReferencedSOPInstanceUID))
+    return tuple(plan_uids)
+
+
+def referenced_ct_uids(data_set):
+    """UIDs of the CT images referenced by the first series of a structure set"""
+    if isinstance(data_set, DicomHeader):
+        return data_set.referenced_ct_uids
+
+    try:
+        images = (
+            data_set.ReferencedFrameOfReferenceSequence[0]
+            .RTReferencedStudySequence[0]
+            .RTReferencedSeriesSequence[0]
+            .ContourImageSequence
+        )
+    except (AttributeError, IndexError):
+        return tuple()
+
+    ct_uids = list()
+    for image in images:
+        if image.ReferencedSOPClassUID.name == "CT Image Storage":
+            ct_uids.append(str(image.ReferencedSOPInstanceUID))
+    return tuple(ct_uids)
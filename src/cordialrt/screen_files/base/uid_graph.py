@@ -0,0 +1,146 @@
+""" Index of the DICOM UID linkage between screened files: plan -> structure set, structure set -> CT
+series and images and dose -> plan, with the reverse links. Built once per patient during screening so
+treatment assembly and reference checks are dict lookups instead of nested loops over the studies."""
+
+from cordialrt.screen_files.base.structures import (
+    referenced_ct_uids,
+    referenced_plan_uids,
+    referenced_structure_uids,
+)
+
+
+class UidGraph:
+    def __init__(self):
+        # SOPInstanceUID: the {'path', 'data_set'} dict from the study
+        self.files = dict()
+        # SOPInstanceUID: (patient_id, study_id, modality)
+        self.file_info = dict()
+
+        self.plan_structures = dict()
+        self.structure_cts = dict()
+        self.dose_plans = dict()
+        self.ct_series = dict()
+
+        # Reverse links
+        self.structure_plans = dict()
+        self.plan_doses = dict()
+
+    @classmethod
+    def from_patient(cls, patient):
+        graph = cls()
+        graph.add_patient(patient)
+        return graph
+
+    @classmethod
+    def from_patients(cls, patients):
+        """Archive wide graph for a list of screened patients"""
+        graph = cls()
+        for patient in patients:
+            graph.add_patient(patient)
+        return graph
+
+    def add_patient(self, patient):
+        for study_id, study in patient.studies.items():
+            self.add_study(study, patient.patient_id)
+
+    def add_study(self, study, patient_id=None):
+        for modality, files in [
+            ("CT", study.cts),
+            ("RTPLAN", study.plans),
+            ("RTDOSE", study.doses),
+            ("RTSTRUCT", study.structures),
+            ("OTHER", study.other_files),
+        ]:
+            for uid, file in files.items():
+                self.add_file(uid, file, patient_id, study.study_id, modality)
+
+    def add_file(self, uid, file, patient_id=None, study_id=None, modality=None):
+        """Add a {'path', 'data_set'} file dict. Returns False if the SOPInstanceUID is already in the graph"""
+        if uid in self.files:
+            # Duplicates across studies keep the first file, as in the studies
+            return False
+        if modality is None:
+            modality = file["data_set"].Modality
+        self.files[uid] = file
+        self.file_info[uid] = (patient_id, study_id, modality)
+        data_set = file["data_set"]
+
+        if modality == "CT":
+            self.ct_series[uid] = getattr(data_set, "SeriesInstanceUID", None)
+        elif modality == "RTPLAN":
+            structure_uids = referenced_structure_uids(data_set)
+            self.plan_structures[uid] = structure_uids
+            for structure_uid in structure_uids:
+                self.structure_plans.setdefault(structure_uid, list()).append(uid)
+        elif modality == "RTDOSE":
+            plan_uids = referenced_plan_uids(data_set)
+            self.dose_plans[uid] = plan_uids
+            for plan_uid in plan_uids:
+                self.plan_doses.setdefault(plan_uid, list()).append(uid)
+        elif modality == "RTSTRUCT":
+            self.structure_cts[uid] = referenced_ct_uids(data_set)
+        return True
+
+    # Lookups
+    def study_of(self, uid):
+        """Study id of the file with the SOPInstanceUID (None if not screened)"""
+        info = self.file_info.get(uid)
+        return None if info is None else info[1]
+
+    def structures_for_plans(self, plan_uids):
+        structure_uids = set()
+        for plan_uid in plan_uids:
+            structure_uids.update(self.plan_structures.get(plan_uid, tuple()))
+        return structure_uids
+
+    def cts_for_structure(self, structure_uid):
+        return self.structure_cts.get(structure_uid, tuple())
+
+    def ct_series_for_structure(self, structure_uid):
+        """Series UIDs of the screened CT images referenced by the structure set"""
+        series_uids = set()
+        for ct_uid in self.cts_for_structure(structure_uid):
+            if ct_uid in self.ct_series:
+                series_uids.add(self.ct_series[ct_uid])
+        return series_uids
+
+    def doses_for_plans(self, plan_uids):
+        dose_uids = list()
+        for plan_uid in plan_uids:
+            for dose_uid in self.plan_doses.get(plan_uid, list()):
+                if dose_uid not in dose_uids:
+                    dose_uids.append(dose_uid)
+        return dose_uids
+
+    # Reports
+    def missing_references(self):
+        """Returns a list of dicts for every referenced file that was not screened"""
+        missing = list()
+        links = [
+            ("RTPLAN", self.plan_structures, "RTSTRUCT"),
+            ("RTSTRUCT", self.structure_cts, "CT"),
+            ("RTDOSE", self.dose_plans, "RTPLAN"),
+        ]
+        for modality, references, referenced_modality in links:
+            for uid, referenced_uids in references.items():
+                for referenced_uid in referenced_uids:
+                    if referenced_uid not in self.files:
+                        missing.append(
+                            {
+                                "patient_id": self.file_info[uid][0],
+                                "modality": modality,
+                                "uid": uid,
+                                "path": self.files[uid]["path"],
+                                "missing_modality": referenced_modality,
+                                "missing_uid": referenced_uid,
+                            }
+                        )
+        return missing
+
+    def plans_sharing_structure(self):
+        """Returns a dict of structure uid: [plan uids] for structure sets referenced by more than one plan"""
+        shared = dict()
+        for structure_uid, plan_uids in self.structure_plans.items():
+            if len(plan_uids) > 1:
+                shared[structure_uid] = list(plan_uids)
+        return shared
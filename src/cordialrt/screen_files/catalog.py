@@ -0,0 +1,209 @@
+"""Persistent catalog of screened DICOM files. The catalog is a SQLite file next to the database and
+stores the screening header of every file with its size and modification time, so a new screening only
+has to parse files that are new or have changed since the last run. The content hash of a file is
+also kept, so it is only computed again when the size or modification time changes."""
+
+import datetime
+import os
+import sqlite3
+
+from pydicom.errors import InvalidDicomError
+
+import cordialrt.helpers.user_config
+from cordialrt.screen_files.base.folder_utilities import file_content_hash
+from cordialrt.screen_files.base.structures import DicomHeader
+
+CATALOG_FILE_NAME = "screening_catalog.db"
+
+# DicomHeader attributes holding tuples of UIDs. Stored as backslash separated strings.
+MULTI_VALUE_COLUMNS = [
+    "referenced_structure_uids",
+    "referenced_plan_uids",
+    "referenced_ct_uids",
+]
+
+# Column order of screened_files
+CATALOG_COLUMNS = (
+    ["file_path", "folder_path", "file_size", "file_mtime", "valid"]
+    + list(DicomHeader.__slots__)
+    + ["edit_date", "content_hash"]
+)
+
+
+def default_catalog_path():
+    """The catalog is placed in the same folder as the database from the user config"""
+    user_config = cordialrt.helpers.user_config.read_user_config()
+    database_folder = os.path.dirname(user_config["database_path"])
+    return os.path.join(database_folder, CATALOG_FILE_NAME)
+
+
+class ScreeningCatalog:
+    """Catalog of screened files keyed by path, size and mtime. Only the path is kept on the object,
+    so it can be passed to worker processes when screening in parallel."""
+
+    def __init__(self, catalog_path=None):
+        if catalog_path is None:
+            catalog_path = default_catalog_path()
+        self.catalog_path = catalog_path
+        self.create_tables()
+
+    def connect(self):
+        # Worker processes may write to the catalog at the same time, so wait for locks
+        return sqlite3.connect(self.catalog_path, timeout=60)
+
+    def create_tables(self):
+        header_columns = ", ".join(f"{name} TEXT" for name in DicomHeader.__slots__)
+        sql_string = f"""CREATE TABLE IF NOT EXISTS screened_files (
+                            file_path TEXT PRIMARY KEY,
+                            folder_path TEXT NOT NULL,
+                            file_size INTEGER NOT NULL,
+                            file_mtime INTEGER NOT NULL,
+                            valid INTEGER NOT NULL,
+                            {header_columns},
+                            edit_date TEXT,
+                            content_hash TEXT)"""
+        with self.connect() as connection:
+            connection.execute(sql_string)
+            # Catalogs created before content hashes were added
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(screened_files)")]
+            if "content_hash" not in columns:
+                connection.execute("ALTER TABLE screened_files ADD COLUMN content_hash TEXT")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS screened_files_folder ON screened_files (folder_path)"
+            )
+        connection.close()
+
+    @staticmethod
+    def header_to_row(header):
+        row = list()
+        for name in DicomHeader.__slots__:
+            value = getattr(header, name)
+            if name in MULTI_VALUE_COLUMNS and value is not None:
+                value = "\\".join(value)
+            row.append(value)
+        return row
+
+    @staticmethod
+    def row_to_header(row):
+        values = dict(zip(DicomHeader.__slots__, row))
+        for name in MULTI_VALUE_COLUMNS:
+            if values[name] is None or values[name] == "":
+                values[name] = tuple()
+            else:
+                values[name] = tuple(values[name].split("\\"))
+        if values["fractions_planned"] is not None:
+            values["fractions_planned"] = int(values["fractions_planned"])
+        return DicomHeader(**values)
+
+    def load_folder(self, folder_path, files, hashes=None):
+        """Returns a dict of file path: DicomHeader for the files in a folder. Files that are
+        unchanged since the last screening are read from the catalog, all others are parsed and
+        the catalog is updated. Files no longer in the folder are removed from the catalog.
+        files is a list of paths or DicomFileEntry, whose size and mtime are used if present.
+        If a dict is given as hashes, it is filled with file path: content hash for the valid
+        files. Hashes are only computed for files that are new, changed or not hashed before."""
+        folder_path = os.path.normpath(folder_path)
+        header_columns = ", ".join(DicomHeader.__slots__)
+
+        connection = self.connect()
+        try:
+            sql_string = f"""SELECT file_path, file_size, file_mtime, valid, content_hash, {header_columns}
+                            FROM screened_files WHERE folder_path = ?"""
+            catalog_rows = dict()
+            for row in connection.execute(sql_string, [folder_path]):
+                catalog_rows[row[0]] = row
+
+            dicom_files = dict()
+            new_rows = list()
+            hash_updates = list()
+            for file in files:
+                if isinstance(file, str):
+                    file_path, file_size, file_mtime = file, None, None
+                else:
+                    file_path, file_size, file_mtime = file
+                if file_size is None or file_mtime is None:
+                    try:
+                        stat = os.stat(file_path)
+                    except FileNotFoundError:
+                        continue
+                    file_size, file_mtime = stat.st_size, stat.st_mtime_ns
+
+                # Normalised like the folder path, so lookups match whatever separators the files were listed with
+                catalog_path = os.path.normpath(file_path)
+                catalog_row = catalog_rows.pop(catalog_path, None)
+                if (
+                    catalog_row is not None
+                    and catalog_row[1] == file_size
+                    and catalog_row[2] == file_mtime
+                ):
+                    if catalog_row[3]:
+                        dicom_files[file_path] = self.row_to_header(catalog_row[5:])
+                        if hashes is not None:
+                            content_hash = catalog_row[4]
+                            if content_hash is None:
+                                content_hash = file_content_hash(file_path)
+                                hash_updates.append([content_hash, catalog_path])
+                            hashes[file_path] = content_hash
+                    continue
+
+                try:
+                    header = DicomHeader.read(file_path)
+                    valid = 1
+                    dicom_files[file_path] = header
+                except (InvalidDicomError, OSError):
+                    print(f"File not valid DICOM: {file_path}")
+                    header = DicomHeader()
+                    valid = 0
+
+                content_hash = None
+                if hashes is not None and valid:
+                    content_hash = file_content_hash(file_path)
+                    hashes[file_path] = content_hash
+
+                new_rows.append(
+                    [catalog_path, folder_path, file_size, file_mtime, valid]
+                    + self.header_to_row(header)
+                    + [datetime.datetime.now(), content_hash]
+                )
+
+            with connection:
+                if len(new_rows) > 0:
+                    place_holders = ",".join(["?"] * len(CATALOG_COLUMNS))
+                    connection.executemany(
+                        f"""INSERT OR REPLACE INTO screened_files ({", ".join(CATALOG_COLUMNS)})
+                            VALUES ({place_holders})""",
+                        new_rows,
+                    )
+                connection.executemany(
+                    "UPDATE screened_files SET content_hash = ? WHERE file_path = ?",
+                    hash_updates,
+                )
+                # Whatever is left was deleted from the folder since the last screening
+                connection.executemany(
+                    "DELETE FROM screened_files WHERE file_path = ?",
+                    [[file_path] for file_path in catalog_rows.keys()],
+                )
+        finally:
+            connection.close()
+
+        return dicom_files
+
+    def load_all(self):
+        """Returns a dict of folder path: {file path: DicomHeader} for all valid files in the catalog"""
+        header_columns = ", ".join(DicomHeader.__slots__)
+        sql_string = f"""SELECT folder_path, file_path, {header_columns} FROM screened_files
+                        WHERE valid = 1 ORDER BY folder_path, file_path"""
+        folders = dict()
+        connection = self.connect()
+        try:
+            for row in connection.execute(sql_string):
+                folders.setdefault(row[0], dict())[row[1]] = self.row_to_header(row[2:])
+        finally:
+            connection.close()
+        return folders
+
+    def clear(self):
+        """Remove all files from the catalog, forcing a full screening next time"""
+        with self.connect() as connection:
+            connection.execute("DELETE FROM screened_files")
+        connection.close()
@@ -4,119 +4,199 @@ we assume only has DICOM data for one patient"""
 import time
 import os
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from functools import partial
+from itertools import islice
 
 import pandas as pd
 
-from cordialrt.screen_files.base.core import Study, Patient
-from cordialrt.screen_files.base.folder_utilities import fast_scandir, load_dicom_files_in_folder
+from cordialrt.screen_files.base.core import Patient, group_dicom_files
+from cordialrt.screen_files.base.folder_utilities import load_dicom_files_in_folder, walk_dicom_folders
 
 def clear_print_output():
     os.system( 'cls' )
 
-def patient_ids_in_dicom_files(dicom_files):
-    patient_ids = list()
-    for path, dicom_file in dicom_files.items():
-        patient_ids.append(dicom_file.PatientID)
+def screen_patient_folder(path, header_only = False, catalog = None, files = None, detect_dicom = False):
+    """ Screens the DICOM files in one patient folder. Returns a Patient object (None if the folder
+    failed the checks) and a list of error messages for the folder. Use header_only to keep compact 
+    DicomHeader records instead of full pydicom Datasets in the studies. files are the DicomFileEntry 
+    of the folder if already listed by walk_dicom_folders."""
+    dicom_files = load_dicom_files_in_folder(path, header_only = header_only, catalog = catalog, files = files,
+                                             detect_dicom = detect_dicom)
+    # All studies are built in one pass over the files
+    studies_by_patient = group_dicom_files(dicom_files)
+    patient_ids = list(studies_by_patient.keys())
+    error_messages = list()
+    patient = None
+
+    if len(patient_ids) == 1:
+        studies = studies_by_patient[patient_ids[0]]
+        if len(studies) == 0: 
+            error_messages.append(f'{patient_ids[0]} : No studies in folder {path}')                
+        else:
+            patient = Patient(patient_ids[0])            
+            for study_id, study in studies.items():
+                patient.add_study(study)
+                if len(study.duplicate_files) > 0:
+                    error_messages.append(f'{patient_ids[0]} : Files already in study {study_id} in folder {path}: '
+                                          f'{study.duplicate_files}')
+            # Build the UID links while the files are at hand (and in the worker when screening in parallel)
+            patient.build_uid_graph()
+    elif len(patient_ids) == 0:
+        error_messages.append(f'No patient id found in folder {path}') 
+    else:
+        error_messages.append(f'{patient_ids} : Multipe patient_ids found in folder {path}') 
 
-    patient_ids = list(dict.fromkeys(patient_ids))
-    return(patient_ids)
+    return(patient, error_messages)
 
-def study_ids_in_dicom_files(dicom_files):
-    study_ids = list()
-    for path, dicom_file in dicom_files.items():
-        study_ids.append(dicom_file.StudyInstanceUID)
+def patient_summary_row(patient):
+    """ Returns a dict with the number of files of each type and the plan names for a screened patient"""
+    number_of_plans = 0 
+    number_of_cts = 0 
+    number_of_structures = 0
+    number_of_doses = 0
+    plan_names = list()
+
+    for uid, study in patient.studies.items():
+        number_of_plans = number_of_plans + len(study.plans)
+        number_of_cts = number_of_cts + len(study.cts)
+        number_of_structures  = number_of_structures + len(study.structures)
+        number_of_doses  = number_of_doses  + len(study.doses)
+
+        for key, plan in study.plans.items():
+            plan = plan['data_set']
+            plan_names.append(plan.RTPlanLabel)
+
+    row = {
+        'patient_id': patient.patient_id,
+        'number_of_studies': len(patient.studies),
+        'number_of_plans': number_of_plans,
+        'number_of_cts': number_of_cts,
+        'number_of_structures': number_of_structures,
+        'number_of_doses': number_of_doses,
+        'plan_names': plan_names,
+    }
+    return(row)
+
+def screened_patients_dataframe(ok_patients):
+    """ Returns a dataframe with a summary row and the patient object for each screened patient"""
+    rows = list()
+    for patient in ok_patients:
+        row = patient_summary_row(patient)
+        row['patient_object'] = patient
+        rows.append(row)
+
+    columns = ['patient_id', 'number_of_studies', 'number_of_plans', 'number_of_cts', 'number_of_structures',
+               'number_of_doses', 'plan_names', 'patient_object']
+    data_frame = pd.DataFrame(rows, columns = columns)
+    return(data_frame)
+
+def uid_link_report(data_frame):
+    """ Returns two dataframes from the UID graphs of the screened patients: the references to files that were
+    not found in the patient folders, and the structure sets shared by more than one plan"""
+    missing_rows = list()
+    shared_rows = list()
+    for patient in data_frame['patient_object']:
+        graph = patient.uid_graph
+        missing_rows.extend(graph.missing_references())
+        for structure_uid, plan_uids in graph.plans_sharing_structure().items():
+            shared_rows.append({
+                'patient_id': patient.patient_id,
+                'structure_uid': structure_uid,
+                'plan_uids': plan_uids,
+                'plan_names': [graph.files[uid]['data_set'].RTPlanLabel for uid in plan_uids],
+            })
+
+    missing_references = pd.DataFrame(missing_rows, columns = ['patient_id', 'modality', 'uid', 'path',
+                                                               'missing_modality', 'missing_uid'])
+    shared_structures = pd.DataFrame(shared_rows, columns = ['patient_id', 'structure_uid', 'plan_uids',
+                                                             'plan_names'])
+    return(missing_references, shared_structures)
+
+def folders_to_screen(parent_folder, max_no_folders = None, folder_paths = False, detect_dicom = False,
+                      with_stat = False):
+    """ Yields (folder, files) for the patient folders to screen. Folders below parent_folder are found in a 
+    single walk that also lists their DICOM files. For folder_paths, files is None and the folder is listed 
+    when it is screened."""
+    if not parent_folder: 
+        folders = ((folder, None) for folder in folder_paths)
+    else:
+        folders = walk_dicom_folders(parent_folder, detect_dicom = detect_dicom, with_stat = with_stat)
+
+    if max_no_folders:
+        folders = islice(folders, max_no_folders)
+    return(folders)
+
+def screen_folder_item(folder_item, header_only = False, catalog = None, detect_dicom = False):
+    """ Screens a (folder, files) item from folders_to_screen"""
+    folder, files = folder_item
+    return(screen_patient_folder(folder, header_only = header_only, catalog = catalog, files = files,
+                                 detect_dicom = detect_dicom))
+
+def ordered_pool_map(executor, function, items, max_pending):
+    """ Like executor.map, but only keeps max_pending folders in flight so finished results do not pile up 
+    in memory when the consumer is slower than the pool. Results are yielded in the order of items."""
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def iter_screened_patients(parent_folder, max_no_folders = None, folder_paths = False, workers = None,
+                           header_only = False, catalog = None, sink = None, detect_dicom = False):
+    """ Generator version of open_dicom_files. Yields a Patient object (None if the folder failed the checks)
+    and the error messages for each folder as soon as the folder is screened, in folder order. If a sink from
+    cordialrt.screen_files.sinks is given, the summary row of each patient is written to it and the sink is
+    closed when the generator finishes. Use detect_dicom to include DICOM files without a .dcm extension."""
+    folders = folders_to_screen(parent_folder, max_no_folders, folder_paths, detect_dicom = detect_dicom,
+                                with_stat = catalog is not None)
+    screen_folder = partial(screen_folder_item, header_only = header_only, catalog = catalog,
+                            detect_dicom = detect_dicom)
+    counter = 0
 
-    study_ids = list(dict.fromkeys(study_ids))
-    return(study_ids)
+    with ExitStack() as stack:
+        if sink is not None:
+            stack.callback(sink.close)
 
-def open_dicom_files(parent_folder, max_no_folders = None, folder_paths = False):
+        if workers is None or workers <= 1:
+            results = map(screen_folder, folders)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers = workers))
+            results = ordered_pool_map(executor, screen_folder, folders, max_pending = 4 * workers)
+
+        for patient, folder_error_messages in results: 
+            counter = counter +1
+            if counter % 100 == 0:
+                print(f'{counter} folders screened')
+            if sink is not None and patient is not None:
+                sink.write(patient_summary_row(patient))
+            yield(patient, folder_error_messages)
+
+def open_dicom_files(parent_folder, max_no_folders = None, folder_paths = False, workers = None,
+                     header_only = False, catalog = None, detect_dicom = False):
     """ Main function to screen dicom files. Returns a dataframe  with patient obejcts that was open correctly and a
-    lists of folders that failed checks."""
+    lists of folders that failed checks. Use workers > 1 to screen the patient folders in a process pool. The 
+    output is in folder order regardless of the number of workers. Use header_only to only read the tags needed
+    for screening and linkage, which keeps memory use low for large archives. Provide a ScreeningCatalog from
+    cordialrt.screen_files.catalog to only parse files that are new or changed since the last screening. 
+    Use detect_dicom to also include DICOM files without a .dcm extension (checks the DICM preamble)."""
     
     start_time = time.time()
     print(start_time)
     ok_patients = deque()
     error_messages = list()
-    counter = 0
 
-    if not parent_folder: 
-        folders = folder_paths
-    else:
-        if max_no_folders:
-            folders = fast_scandir(parent_folder)[0:max_no_folders]
-        else:
-            folders = fast_scandir(parent_folder)        
-
-    for path in folders: 
-        counter = counter +1
-        if counter in list(range(0,2100,100)):
-            print(f'{counter}/{len(folders)}')
-        dicom_files = load_dicom_files_in_folder(path+ '\\')
-        study_ids = study_ids_in_dicom_files(dicom_files)
-        patient_ids = patient_ids_in_dicom_files(dicom_files)
-        data = dict()
-
-        if len(patient_ids) == 1:
-            patient = Patient(patient_ids[0])            
-            if len(study_ids) == 0: 
-                error_messages .append(f'{patient_ids[0]} : No studies in folder {path}')                
-            else:
-                ok_patients.append(patient)
-                for study_id in study_ids:
-                    study = Study(study_id)
-                    study.load_dicom_files(dicom_files)
-                    patient.add_study(study)
-        elif len(patient_ids) == 0:
-            error_messages.append(f'No patient id found in folder {path}') 
-        else:
-            error_messages.append(f'{patient_ids} : Multipe patient_ids found in folder {path}') 
-
-  
-    # Create Data Frame
-    ok_patient_ids = list()
-    number_of_studies = list()
-    number_of_plans = list()
-    number_of_cts = list()
-    number_of_structures = list()
-    number_of_doses = list()
-    plan_names = list()
-    patient_objects = list()
+    for patient, folder_error_messages in iter_screened_patients(parent_folder, max_no_folders, folder_paths,
+                                                                  workers = workers, header_only = header_only,
+                                                                  catalog = catalog, detect_dicom = detect_dicom):
+        if patient is not None:
+            ok_patients.append(patient)
+        error_messages.extend(folder_error_messages)
 
-    for patient in ok_patients:
-        ok_patient_ids.append(patient.patient_id)
-        number_of_plans_counter = 0 
-        number_of_cts_counter = 0 
-        number_of_structures_counter = 0
-        number_of_doses_counter = 0
-        patient_plan_names = list()
-        patient_objects.append(patient)
-
-        for uid, study in patient.studies.items():
-            number_of_plans_counter = number_of_plans_counter + len(study.plans)
-            number_of_cts_counter = number_of_cts_counter + len(study.cts)
-            number_of_structures_counter  = number_of_structures_counter + len(study.structures)
-            number_of_doses_counter  = number_of_doses_counter  + len(study.doses)
-
-            for key, plan in study.plans.items():
-                plan = plan['data_set']
-                patient_plan_names.append(plan.RTPlanLabel)
-            
-        plan_names.append(patient_plan_names)
-        number_of_cts.append(number_of_cts_counter)
-        number_of_plans.append(number_of_plans_counter)
-        number_of_structures.append(number_of_structures_counter)
-        number_of_doses.append(number_of_doses_counter)
-        number_of_studies.append(len(patient.studies))
-
-    data['patient_id'] = ok_patient_ids
-    data['number_of_studies'] = number_of_studies
-    data['number_of_plans'] = number_of_plans
-    data['number_of_cts'] = number_of_cts
-    data['number_of_structures'] = number_of_structures
-    data['number_of_doses'] = number_of_doses
-    data['plan_names'] = plan_names
-    data['patient_object'] = patient_objects
-    data_frame = pd.DataFrame(data)
+    data_frame = screened_patients_dataframe(ok_patients)
 
     print("--- %s seconds ---" % (time.time() - start_time))        
     return(data_frame, error_messages)       
@@ -1,10 +1,12 @@
 import numpy as np
 
+from cordialrt.screen_files.base.structures import fractions_planned
+
 def planned_fractions(patient):
     plan_fractions = list()
     if len(patient.studies) == 1:     
         for uid, plan in patient.one_study.plans.items():
-            plan_fractions.append([plan['data_set'].RTPlanLabel, plan['data_set'].FractionGroupSequence[0].NumberOfFractionsPlanned])
+            plan_fractions.append([plan['data_set'].RTPlanLabel, fractions_planned(plan['data_set'])])
         return(plan_fractions)
     
 def fractions_main_plan(planned_fractions):
@@ -23,7 +25,7 @@ def get_plan_info(patient):
         for plan_uid, plan in study.plans.items():
             plan_info = {
                 'plan_name': plan['data_set'].RTPlanLabel,
-                'fractions': plan['data_set'].FractionGroupSequence[0].NumberOfFractionsPlanned,
+                'fractions': fractions_planned(plan['data_set']),
                 'plan_date': str(plan['data_set'].StudyDate),
                 'approve': plan['data_set'].ApprovalStatus,
                 'study_uid': study_uid,
@@ -0,0 +1,122 @@
+"""Sinks for writing the screening summary rows while the screening is still running. Used with
+dicom_files_dataframe.iter_screened_patients"""
+
+import csv
+import os
+
+import pandas as pd
+
+SUMMARY_COLUMNS = [
+    "patient_id",
+    "number_of_studies",
+    "number_of_plans",
+    "number_of_cts",
+    "number_of_structures",
+    "number_of_doses",
+    "plan_names",
+]
+
+
+class DataFrameSink:
+    """Collects the summary rows in a pandas DataFrame, which is grown in blocks of flush_every rows"""
+
+    def __init__(self, flush_every=500):
+        self.flush_every = flush_every
+        self.rows = list()
+        self.blocks = list()
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.blocks.append(pd.DataFrame(self.rows, columns=SUMMARY_COLUMNS))
+            self.rows = list()
+
+    def close(self):
+        self.flush()
+
+    @property
+    def data_frame(self):
+        """The rows written so far"""
+        self.flush()
+        if len(self.blocks) == 0:
+            return pd.DataFrame(columns=SUMMARY_COLUMNS)
+        if len(self.blocks) > 1:
+            self.blocks = [pd.concat(self.blocks, ignore_index=True)]
+        return self.blocks[0]
+
+
+class CsvSink:
+    """Appends the summary rows to a csv file. Plan names are joined with ';'"""
+
+    def __init__(self, path, flush_every=100):
+        self.path = path
+        self.flush_every = flush_every
+        self.rows_since_flush = 0
+        write_header = not os.path.isfile(path) or os.path.getsize(path) == 0
+        self.file = open(path, "a", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=SUMMARY_COLUMNS)
+        if write_header:
+            self.writer.writeheader()
+
+    def write(self, row):
+        row = dict(row)
+        row["plan_names"] = ";".join(str(name) for name in row["plan_names"])
+        self.writer.writerow(row)
+        self.rows_since_flush = self.rows_since_flush + 1
+        if self.rows_since_flush >= self.flush_every:
+            self.file.flush()
+            self.rows_since_flush = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class ParquetSink:
+    """Writes the summary rows to a Parquet file, one row group per flush_every rows. Requires pyarrow"""
+
+    def __init__(self, path, flush_every=1000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("ParquetSink requires pyarrow: pip install pyarrow") from e
+
+        self.pa = pa
+        self.path = path
+        self.flush_every = flush_every
+        self.rows = list()
+        self.schema = pa.schema(
+            [("patient_id", pa.string())]
+            + [(name, pa.int64()) for name in SUMMARY_COLUMNS[1:-1]]
+            + [("plan_names", pa.list_(pa.string()))]
+        )
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            table = self.pa.Table.from_pylist(
+                [
+                    dict(row, patient_id=str(row["patient_id"]),
+                         plan_names=[str(name) for name in row["plan_names"]])
+                    for row in self.rows
+                ],
+                schema=self.schema,
+            )
+            self.writer.write_table(table)
+            self.rows = list()
+
+    def close(self):
+        if self.writer is not None:
+            self.flush()
+            self.writer.close()
+            self.writer = None